@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Generates a pair of synthetic blink.git and chromium.git bare repos.
+
+They are shaped like the real ones, as far as the automerger is concerned:
+  blink.git: a linear history touching a deep LayoutTests/ hierarchy, with lots
+      of .png files, git-svn-id footers and the branch-heads in config.py.
+  chromium.git: a third_party/ tree, a DEPS with webkit_* vars, a .gitignore
+      which lists /third_party/WebKit, Cr-Commit-Position footers and all the
+      chromium refs in config.py.
+The generation is deterministic (given the options) and done via git
+fast-import, so that repos with ~1M objects take a few minutes.
+"""
+
+import optparse
+import os
+import random
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import config
+
+
+_START_TIME = 1400000000
+
+_DEPS = """vars = {
+  'webkit_trunk': 'https://chromium.googlesource.com/chromium/blink.git',
+  'webkit_revision': '%(webkit_revision)s',
+  'v8_revision': 'abcdef',
+}
+
+deps = {
+  'src/third_party/WebKit':
+    Var('webkit_trunk') + '@' + Var('webkit_revision'),
+  'src/v8': 'https://chromium.googlesource.com/v8/v8.git@abcdef',
+}
+"""
+
+_GITIGNORE = '/out\n/third_party/WebKit\n/third_party/v8\n'
+
+
+class _FastImport(object):
+  """Streams commits into git fast-import."""
+  def __init__(self, git_dir):
+    subprocess.check_call(['git', 'init', '-q', '--bare', git_dir])
+    self._proc = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                  stdin=subprocess.PIPE, cwd=git_dir)
+    self._git_dir = git_dir
+
+  def Commit(self, ref, timestamp, message, changes):
+    """|changes| is a list of (path, data), data=None removes the file."""
+    out = ['commit %s\n' % ref,
+           'committer Synthetic <synthetic@example.com> %d +0000\n' % timestamp,
+           'data %d\n%s\n' % (len(message), message)]
+    for path, data in changes:
+      if data is None:
+        out.append('D %s\n' % path)
+      else:
+        out.append('M 100644 inline %s\ndata %d\n%s\n' % (
+            path, len(data), data))
+    out.append('\n')
+    self._proc.stdin.write(''.join(out))
+
+  def Reset(self, ref, from_ref):
+    self._proc.stdin.write('reset %s\nfrom %s\n\n' % (ref, from_ref))
+
+  def Close(self, repack=True):
+    self._proc.stdin.close()
+    assert self._proc.wait() == 0, 'git fast-import failed'
+    if repack:  # Like a real mirror (and unlike the fast-import packs).
+      subprocess.check_call(['git', 'repack', '-a', '-d', '-q'],
+                            cwd=self._git_dir)
+
+
+def _RandomPng(rng, size):
+  return '\x89PNG\r\n\x1a\n' + ('%0*x' % (size * 2, rng.getrandbits(size * 8))
+                                 ).decode('hex')
+
+
+def _MakeDirs(rng, root, num_dirs, max_depth):
+  """Returns a list of |num_dirs| random dirs under |root|, max_depth deep."""
+  dirs = [(root, 0)]
+  for i in xrange(num_dirs - 1):
+    parent, depth = rng.choice([d for d in dirs[-64:] if d[1] < max_depth] or
+                               [dirs[0]])
+    dirs.append(('%s/d%d' % (parent, i), depth + 1))
+  return [d[0] for d in dirs]
+
+
+def MakeBlink(git_dir, num_commits, num_dirs, max_depth, files_per_commit,
+              png_ratio, seed):
+  rng = random.Random(seed)
+  dirs = _MakeDirs(rng, 'LayoutTests', num_dirs, max_depth)
+  source_dirs = _MakeDirs(rng, 'Source', max(1, num_dirs // 4), 3)
+  blink_refs = sorted(set(b[1] for b in config.BRANCHES_TO_MERGE))
+  branch_refs = [r for r in blink_refs if r != 'refs/heads/master']
+  # Cut the branches from the last 20% of the history.
+  branch_points = dict(
+      (num_commits - 1 - (i + 1) * num_commits // (5 * (len(branch_refs) + 1)),
+       ref) for i, ref in enumerate(branch_refs))
+  files = []  # Paths of the existing files, for modifications and deletions.
+  fast_import = _FastImport(git_dir)
+  for i in xrange(num_commits):
+    changes = []
+    for j in xrange(rng.randint(1, files_per_commit)):
+      if files and rng.random() < 0.3:  # Modify or delete an existing file.
+        index = rng.randrange(len(files))
+        path = files[index]
+        if rng.random() < 0.2:
+          files[index] = files[-1]
+          files.pop()
+          changes.append((path, None))
+          continue
+      elif rng.random() < 0.9:
+        ext = '.png' if rng.random() < png_ratio else rng.choice(
+            ['-expected.txt', '.html', '.js'])
+        path = '%s/f%d%s' % (rng.choice(dirs), rng.randrange(1000), ext)
+        files.append(path)
+      else:
+        path = '%s/f%d.cpp' % (rng.choice(source_dirs), rng.randrange(100))
+      if path.endswith('.png'):
+        data = _RandomPng(rng, rng.randint(64, 2048))
+      else:
+        data = 'commit %d, change %d\n' % (i, j)
+      changes.append((path, data))
+    message = 'Synthetic commit %d\n\ngit-svn-id: %s@%d %s\n' % (
+        i, 'svn://svn.chromium.org/blink/trunk', 100000 + i,
+        'bbb929c8-8fbe-4397-9dbb-9b2b20218538')
+    fast_import.Commit('refs/heads/master', _START_TIME + i * 60, message,
+                       changes)
+    if i in branch_points:
+      ref = branch_points[i]
+      fast_import.Reset(ref, 'refs/heads/master')
+      svn_branch = ref.replace('refs/branch-heads/', 'branches/')
+      for k in xrange(3):  # A few cherry-picks on the branch.
+        message = 'Branch commit %d\n\ngit-svn-id: %s@%d %s\n' % (
+            k, 'svn://svn.chromium.org/blink/' + svn_branch, 200000 + i + k,
+            'bbb929c8-8fbe-4397-9dbb-9b2b20218538')
+        path = '%s/branch%d.png' % (rng.choice(dirs), k)
+        fast_import.Commit(ref, _START_TIME + i * 60 + k + 1, message,
+                           [(path, _RandomPng(rng, 128))])
+  fast_import.Close()
+
+
+def MakeChromium(git_dir, num_commits, num_files, seed):
+  rng = random.Random(seed)
+  dirs = (_MakeDirs(rng, 'third_party', max(1, num_files // 20), 3) +
+          _MakeDirs(rng, 'base', max(1, num_files // 40), 3) +
+          _MakeDirs(rng, 'content', max(1, num_files // 40), 3))
+  fast_import = _FastImport(git_dir)
+  for i in xrange(num_commits):
+    if i == 0:
+      changes = [('DEPS', _DEPS % {'webkit_revision': '1234'}),
+                 ('.gitignore', _GITIGNORE)]
+      changes += [('%s/f%d.cc' % (rng.choice(dirs), k), 'file %d\n' % k)
+                  for k in xrange(num_files)]
+    else:
+      changes = [('%s/f%d.cc' % (rng.choice(dirs), rng.randrange(num_files)),
+                  'commit %d\n' % i)]
+      if i % 5 == 0:
+        changes.append(('DEPS', _DEPS % {'webkit_revision': str(1234 + i)}))
+    message = 'Chromium commit %d\n\nCr-Commit-Position: %s@{#%d}\n' % (
+        i, 'refs/heads/master', 300000 + i)
+    fast_import.Commit('refs/heads/master', _START_TIME + i * 60, message,
+                       changes)
+  for chromium_ref in sorted(set(b[0] for b in config.BRANCHES_TO_MERGE)):
+    if chromium_ref != 'refs/heads/master':
+      fast_import.Reset(chromium_ref, 'refs/heads/master')
+  fast_import.Close()
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] output_dir')
+  parser.add_option('--blink-commits', type='int', default=2000)
+  parser.add_option('--layouttests-dirs', type='int', default=500,
+      help='Number of directories under LayoutTests (default: %default)')
+  parser.add_option('--max-depth', type='int', default=8,
+      help='Max depth of the LayoutTests directories (default: %default)')
+  parser.add_option('--files-per-commit', type='int', default=8,
+      help='Max files touched by each blink commit (default: %default)')
+  parser.add_option('--png-ratio', type='float', default=0.4,
+      help='Fraction of the new LayoutTests files which are .png '
+      '(default: %default)')
+  parser.add_option('--chromium-commits', type='int', default=50)
+  parser.add_option('--chromium-files', type='int', default=5000)
+  parser.add_option('--seed', type='int', default=0)
+  options, args = parser.parse_args()
+  if len(args) != 1:
+    parser.error('Expected the output dir')
+  out_dir = os.path.abspath(args[0])
+  blink_dir = os.path.join(out_dir, 'blink.git')
+  chromium_dir = os.path.join(out_dir, 'chromium.git')
+  assert not os.path.exists(blink_dir) and not os.path.exists(chromium_dir), (
+      'The output dir must not contain a blink.git nor a chromium.git')
+
+  print 'Generating %s' % blink_dir
+  MakeBlink(blink_dir, options.blink_commits, options.layouttests_dirs,
+            options.max_depth, options.files_per_commit, options.png_ratio,
+            options.seed)
+  print 'Generating %s' % chromium_dir
+  MakeChromium(chromium_dir, options.chromium_commits, options.chromium_files,
+               options.seed)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Micro-benchmarks of the per-object primitives of gitutils.
+
+They run on a corpus of tree and commit payloads, recorded once from a blink
+repo (--record-from) or, by default, from a synthetic one (see
+make_synthetic_repos.py, which is deterministic). Each benchmark reports the
+best time per object across --repeat runs.
+
+With --update-baselines the results are stored in the baselines file.
+Otherwise they are compared against it and the script fails (exit code 1) if
+any primitive got slower than its threshold. Baselines are meaningful only for
+the same corpus and machine: the corpus id is stored along with them. For this
+reason no baselines file is checked in: each machine records its own, by
+default next to the corpus (outside of the checkout).
+
+Example:
+  git checkout origin/master  # The reference revision.
+  benchmarks/microbench.py --update-baselines
+  git checkout my-change
+  benchmarks/microbench.py
+"""
+
+import hashlib
+import json
+import optparse
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import gitutils
+
+
+_DEFAULT_BASELINES = os.path.join(tempfile.gettempdir(),
+                                  'blink_microbench_baselines.json')
+_DEFAULT_CORPUS = os.path.join(tempfile.gettempdir(),
+                               'blink_microbench_corpus.bin')
+_SYNTHETIC_BLINK_COMMITS = 3000
+_MAX_TREES = 5000
+_MAX_COMMITS = 3000
+_MIN_SAMPLE_SECONDS = 0.5
+_CPU_THRESHOLD = 0.15  # Max slowdown of CPU bound benchmarks, as a fraction.
+_IO_THRESHOLD = 0.30  # Same, but for the (noisier) benchmarks doing I/O.
+
+
+def _Clock():
+  """CPU seconds used by the process, less noisy than wall time on busy
+  machines. The threads of GitLooseObjDB are accounted too."""
+  user, system = os.times()[0:2]
+  return user + system
+
+
+class _Corpus(object):
+  """The tree and commit payloads the benchmarks run on."""
+  def __init__(self, data):
+    self.id = hashlib.sha1(data).hexdigest()[0:12]
+    self.trees = []
+    self.commits = []
+    cursor = 0
+    while cursor < len(data):
+      nul = data.index('\x00', cursor)
+      objtype, objlen = data[cursor:nul].split()
+      cursor = nul + 1 + int(objlen)
+      payload = data[nul + 1:cursor]
+      (self.trees if objtype == 'tree' else self.commits).append(payload)
+
+  @staticmethod
+  def Record(git_dir, corpus_path):
+    """Samples trees and commits from |git_dir| into the corpus file."""
+    proc = subprocess.Popen(['git', 'rev-list', '--all', '--objects',
+                             '--filter=blob:none'], cwd=git_dir,
+                            stdout=subprocess.PIPE)
+    commits, trees = [], []
+    for line in proc.stdout:
+      line = line.rstrip('\n')
+      (commits if len(line) == 40 else trees).append(line[0:40].decode('hex'))
+    assert proc.wait() == 0, 'git rev-list failed'
+    # Sample evenly, to get trees from all the depths and the whole history.
+    trees = trees[::max(1, len(trees) // _MAX_TREES)][0:_MAX_TREES]
+    commits = commits[::max(1, len(commits) // _MAX_COMMITS)][0:_MAX_COMMITS]
+    db = gitutils.GitReadonlyObjDB(git_dir)
+    out = []
+    for _, objtype, payload in db.ReadObjs(commits + trees):
+      out.append('%s %d\x00%s' % (objtype, len(payload), payload))
+    db.Close()
+    gitutils.WriteFileAtomic(corpus_path, zlib.compress(''.join(out)))
+    print 'Recorded %d commits and %d trees from %s into %s' % (
+        len(commits), len(trees), git_dir, corpus_path)
+
+  @staticmethod
+  def Load(corpus_path):
+    with open(corpus_path, 'rb') as f:
+      return _Corpus(zlib.decompress(f.read()))
+
+
+class _HashOnlyObjDB(gitutils._AbstractGitObjDB):
+  """Hashes the objects written, without storing them."""
+  def WriteObj(self, objtype, payload):
+    return hashlib.sha1('%s %d\x00%s' % (objtype, len(payload), payload)
+                        ).digest()
+
+
+# Each benchmark takes the corpus and returns a tuple (num_objects, run),
+# where run() executes one iteration and returns the seconds it took.
+
+def _BenchParseTree(corpus):
+  def Run():
+    tstart = _Clock()
+    for payload in corpus.trees:
+      gitutils.ParseTree(payload)
+    return _Clock() - tstart
+  return len(corpus.trees), Run
+
+
+def _BenchTreeFind(corpus):
+  # Looks up an entry in the middle of each tree, like _RewriteOneTree() does
+  # for LayoutTests in the root trees.
+  lookups = []
+  for payload in corpus.trees:
+    entries = gitutils.ParseTree(payload)
+    if not entries:
+      continue
+    lookups.append((payload, entries[len(entries) // 2][1]))
+
+  def Run():
+    tstart = _Clock()
+    for payload, fname in lookups:
+      gitutils.TreeView(payload).Find(fname)
+    return _Clock() - tstart
+  return len(lookups), Run
+
+
+def _BenchTreeSortKey(corpus):
+  trees = [gitutils.ParseTree(payload) for payload in corpus.trees]
+
+  def Run():
+    tstart = _Clock()
+    for entries in trees:
+      sorted(entries, key=gitutils._GitTreeEntryGetSortKey)
+    return _Clock() - tstart
+  return sum(len(entries) for entries in trees), Run
+
+
+def _BenchWriteTree(corpus):
+  trees = [gitutils.ParseTree(payload) for payload in corpus.trees]
+  db = _HashOnlyObjDB()
+
+  def Run():
+    tstart = _Clock()
+    for entries in trees:
+      db.WriteTree(entries)
+    return _Clock() - tstart
+  return len(trees), Run
+
+
+def _BenchTreeEdit(corpus):
+  # Removes the first entry and adds a new one, like the png filtering does.
+  edits = []
+  for payload in corpus.trees:
+    if not payload:
+      continue  # The empty tree.
+    mode, fname, sha1 = gitutils.ParseTree(payload)[0]
+    edits.append((payload, [(mode, fname + '.new', sha1)], [fname]))
+
+  def Run():
+    tstart = _Clock()
+    for payload, upserts, removals in edits:
+      gitutils.TreeView(payload).Edit(upserts, removals)
+    return _Clock() - tstart
+  return len(edits), Run
+
+
+def _BenchCommitParse(corpus):
+  def Run():
+    tstart = _Clock()
+    for payload in corpus.commits:
+      gitutils.Commit(payload)
+    return _Clock() - tstart
+  return len(corpus.commits), Run
+
+
+def _BenchCommitPayload(corpus):
+  commits = [gitutils.Commit(payload) for payload in corpus.commits]
+
+  def Run():
+    tstart = _Clock()
+    for commit in commits:
+      commit.payload  # pylint: disable=W0104
+    return _Clock() - tstart
+  return len(commits), Run
+
+
+def _ObjsWithSha1s(corpus):
+  objs = [('tree', p) for p in corpus.trees]
+  objs += [('commit', p) for p in corpus.commits]
+  db = _HashOnlyObjDB()
+  return [(objtype, payload, db.WriteObj(objtype, payload))
+          for objtype, payload in objs]
+
+
+def _BenchVerifyObject(corpus):
+  objs = _ObjsWithSha1s(corpus)
+
+  def Run():
+    tstart = _Clock()
+    for objtype, payload, sha1 in objs:
+      assert gitutils.VerifyObject(objtype, payload, sha1)
+    return _Clock() - tstart
+  return len(objs), Run
+
+
+def _BenchLooseWrite(corpus):
+  objs = _ObjsWithSha1s(corpus)
+
+  def Run():
+    objdir = tempfile.mkdtemp(prefix='microbench-')
+    try:
+      db = gitutils.GitLooseObjDB(objdir)
+      tstart = _Clock()
+      for objtype, payload, _ in objs:
+        db.WriteObj(objtype, payload)
+      db.Close()
+      return _Clock() - tstart
+    finally:
+      shutil.rmtree(objdir)
+  return len(objs), Run
+
+
+def _BenchLooseRead(corpus):
+  objs = _ObjsWithSha1s(corpus)
+
+  def Run():
+    objdir = tempfile.mkdtemp(prefix='microbench-')
+    try:
+      db = gitutils.GitLooseObjDB(objdir)
+      for objtype, payload, _ in objs:
+        db.WriteObj(objtype, payload)
+      db.Close()
+      db = gitutils.GitLooseObjDB(objdir)  # Nothing pending in memory.
+      tstart = _Clock()
+      for _, _, sha1 in objs:
+        db.ReadObj(sha1)
+      return _Clock() - tstart
+    finally:
+      shutil.rmtree(objdir)
+  return len(objs), Run
+
+
+# (name, function, max slowdown vs the baseline).
+_BENCHMARKS = [
+    ('ParseTree', _BenchParseTree, _CPU_THRESHOLD),
+    ('TreeView.Find', _BenchTreeFind, _CPU_THRESHOLD),
+    ('_GitTreeEntryGetSortKey', _BenchTreeSortKey, _CPU_THRESHOLD),
+    ('WriteTree', _BenchWriteTree, _CPU_THRESHOLD),
+    ('TreeView.Edit', _BenchTreeEdit, _CPU_THRESHOLD),
+    ('Commit.__init__', _BenchCommitParse, _CPU_THRESHOLD),
+    ('Commit.payload', _BenchCommitPayload, _CPU_THRESHOLD),
+    ('VerifyObject', _BenchVerifyObject, _CPU_THRESHOLD),
+    ('GitLooseObjDB.WriteObj', _BenchLooseWrite, _IO_THRESHOLD),
+    ('GitLooseObjDB.ReadObj', _BenchLooseRead, _IO_THRESHOLD),
+]
+
+
+def RunBenchmarks(corpus, repeat, name_filter=None):
+  """Returns a dict {benchmark name: best nanoseconds per object}."""
+  results = {}
+  for name, bench, _ in _BENCHMARKS:
+    if name_filter and not re.search(name_filter, name):
+      continue
+    num_objs, run = bench(corpus)
+    best = None
+    for _ in xrange(repeat):
+      # Iterates enough for the clock resolution to be irrelevant.
+      seconds, objs = 0, 0
+      while seconds < _MIN_SAMPLE_SECONDS:
+        seconds += run()
+        objs += num_objs
+      if best is None or seconds / objs < best:
+        best = seconds / objs
+    results[name] = best * 1e9
+    print '%-26s %10.0f ns/obj  (%d objs)' % (name, results[name], num_objs)
+  return results
+
+
+def CheckRegressions(results, baselines, threshold_override=None):
+  """Prints the comparison. Returns the names of the regressed benchmarks."""
+  regressions = []
+  print ''
+  print '%-26s %12s %12s %8s' % ('Benchmark', 'Baseline', 'Current', 'Delta')
+  for name, _, threshold in _BENCHMARKS:
+    if name not in results or name not in baselines:
+      continue
+    if threshold_override is not None:
+      threshold = threshold_override
+    delta = results[name] / baselines[name] - 1
+    regressed = delta > threshold
+    print '%-26s %12.0f %12.0f %+7.1f%% %s' % (
+        name, baselines[name], results[name], delta * 100,
+        'REGRESSION (> %+.0f%%)' % (threshold * 100) if regressed else '')
+    if regressed:
+      regressions.append(name)
+  return regressions
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--corpus', default=_DEFAULT_CORPUS,
+      help='The corpus file. Recorded if it does not exist (default: '
+      '%default)')
+  parser.add_option('--record-from', metavar='GIT_DIR',
+      help='(Re-)record the corpus from this repo, e.g. a blink mirror. By '
+      'default the corpus is recorded from a synthetic repo.')
+  parser.add_option('--baselines', default=_DEFAULT_BASELINES,
+      help='The baselines file (default: %default)')
+  parser.add_option('--update-baselines', action='store_true',
+      help='Store the results as the new baselines, instead of checking them')
+  parser.add_option('--repeat', type='int', default=5,
+      help='Runs of each benchmark, the best one is taken (default: %default)')
+  parser.add_option('--threshold', type='float',
+      help='Max slowdown (e.g. 0.1 = 10%%) allowed for all the benchmarks. By '
+      'default %.2f for the CPU-bound ones, %.2f for the ones doing I/O.' % (
+          _CPU_THRESHOLD, _IO_THRESHOLD))
+  parser.add_option('--filter', metavar='REGEX',
+      help='Run only the benchmarks matching REGEX')
+  options, _ = parser.parse_args()
+
+  if options.record_from:
+    _Corpus.Record(os.path.abspath(options.record_from), options.corpus)
+  elif not os.path.exists(options.corpus):
+    import make_synthetic_repos
+    tmp_dir = tempfile.mkdtemp(prefix='microbench-')
+    try:
+      blink_dir = os.path.join(tmp_dir, 'blink.git')
+      make_synthetic_repos.MakeBlink(
+          blink_dir, _SYNTHETIC_BLINK_COMMITS, num_dirs=500, max_depth=8,
+          files_per_commit=8, png_ratio=0.4, seed=0)
+      _Corpus.Record(blink_dir, options.corpus)
+    finally:
+      shutil.rmtree(tmp_dir)
+  corpus = _Corpus.Load(options.corpus)
+  print 'Corpus %s: %d trees, %d commits' % (corpus.id, len(corpus.trees),
+                                            len(corpus.commits))
+
+  results = RunBenchmarks(corpus, options.repeat, options.filter)
+
+  if options.update_baselines:
+    baselines = {}
+    if os.path.exists(options.baselines):
+      with open(options.baselines) as f:
+        baselines = json.load(f)
+      if baselines.get('corpus') != corpus.id:
+        baselines = {}  # Results for different corpora are not comparable.
+    baselines.setdefault('results', {}).update(results)
+    baselines.update({'corpus': corpus.id,
+                      'python': platform.python_version(),
+                      'machine': platform.node()})
+    with open(options.baselines, 'w') as f:
+      json.dump(baselines, f, indent=2, sort_keys=True)
+    print '\nBaselines written to %s' % options.baselines
+    return 0
+
+  if not os.path.exists(options.baselines):
+    print '\nNo baselines in %s, run with --update-baselines first' % (
+        options.baselines)
+    return 1
+  with open(options.baselines) as f:
+    baselines = json.load(f)
+  if baselines['corpus'] != corpus.id:
+    print '\nThe baselines were recorded on a different corpus (%s)' % (
+        baselines['corpus'])
+    return 1
+  regressions = CheckRegressions(results, baselines['results'],
+                                 options.threshold)
+  if regressions:
+    print '\nFAILED: %s got slower than their thresholds' % (
+        ', '.join(regressions))
+    return 1
+  print '\nNo regressions'
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Runs chromium_blink_merge.py end-to-end on local repos and reports its perf.
+
+The repos are either generated (see make_synthetic_repos.py) or passed via
+--repos. For each phase of the run (clone, planning, trees, commits, merge)
+the report contains its duration, the peak RSS (summed over the whole process
+tree, sampled) and the bytes written to new_objects. The throughput of the
+two rewrite phases is taken from the "Rewrote ..." lines of the output.
+
+Example:
+  benchmarks/run_benchmark.py --work-dir /tmp/bench --blink-commits 5000 \
+      --json /tmp/bench.json -- --writer=loose
+"""
+
+import json
+import optparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import capacity_plan
+
+
+_SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                            os.pardir))
+_RSS_SAMPLING_SECONDS = 0.2
+
+# (name, regex of the first output line of the phase), in order.
+_PHASES = [
+    ('clone', None),
+    ('plan', re.compile(r'^Rewriting blink history')),
+    ('trees', re.compile(r'^Phase 1/2')),
+    ('commits', re.compile(r'^Phase 2/2')),
+    ('merge', re.compile(r'^-{10,}$')),  # The end of the rewrite.
+]
+_REWROTE_RE = re.compile(
+    r'^Rewrote (\d+) (trees|commits) in \S+ \(([\d.]+) \w+/sec\)')
+
+
+def _ProcessTreeRss(pid):
+  """Returns the total RSS (bytes) of |pid| and all its descendants."""
+  children = {}  # ppid -> [pid]
+  rss_pages = {}
+  for entry in os.listdir('/proc'):
+    if not entry.isdigit():
+      continue
+    try:
+      with open('/proc/%s/stat' % entry) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    except IOError:
+      continue  # The process exited in the meanwhile.
+    children.setdefault(int(fields[1]), []).append(int(entry))
+    rss_pages[int(entry)] = int(fields[21])
+  total = 0
+  queue = [pid]
+  while queue:
+    p = queue.pop()
+    total += rss_pages.get(p, 0)
+    queue.extend(children.get(p, []))
+  return total * os.sysconf('SC_PAGE_SIZE')
+
+
+class _PhaseStats(object):
+  def __init__(self, name):
+    self.name = name
+    self.tstart = time.time()
+    self.tend = None
+    self.peak_rss = 0
+    self.new_objects_bytes_start = 0
+    self.new_objects_bytes = 0
+    self.rate = None  # Objects/sec, from the "Rewrote" lines.
+    self.num_objects = None
+
+  def ToDict(self):
+    return {'name': self.name,
+            'seconds': round(self.tend - self.tstart, 3),
+            'peak_rss_bytes': self.peak_rss,
+            'bytes_written': self.new_objects_bytes,
+            'num_objects': self.num_objects,
+            'objects_per_sec': self.rate}
+
+
+def RunMerge(work_dir, repos_dir, merge_args, verbose=False):
+  """Runs the merge in |work_dir|. Returns a list of _PhaseStats."""
+  new_objects_dir = os.path.join(work_dir, 'new_objects')
+  cmd = [sys.executable, '-u',
+         os.path.join(_SCRIPTS_DIR, 'chromium_blink_merge.py'),
+         '--blink-url', os.path.join(repos_dir, 'blink.git'),
+         '--chromium-url', os.path.join(repos_dir, 'chromium.git')]
+  cmd += merge_args
+  proc = subprocess.Popen(cmd, cwd=work_dir, stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+  phases = [_PhaseStats(_PHASES[0][0])]
+  done = threading.Event()
+
+  def SampleRss():
+    while not done.is_set():
+      phase = phases[-1]
+      phase.peak_rss = max(phase.peak_rss, _ProcessTreeRss(proc.pid))
+      done.wait(_RSS_SAMPLING_SECONDS)
+  sampler = threading.Thread(target=SampleRss)
+  sampler.daemon = True
+  sampler.start()
+
+  def EndPhase(phase):
+    # Short phases might have been missed by the sampler.
+    phase.peak_rss = max(phase.peak_rss, _ProcessTreeRss(proc.pid))
+    phase.tend = time.time()
+    phase.new_objects_bytes = (capacity_plan.DirSize(new_objects_dir) -
+                               phase.new_objects_bytes_start)
+
+  output = []
+  for line in iter(proc.stdout.readline, ''):
+    output.append(line)
+    if verbose:
+      sys.stdout.write(line)
+    line = line.rstrip('\r\n')
+    match = _REWROTE_RE.match(line.lstrip('\r '))
+    if match:
+      phases[-1].num_objects = int(match.group(1))
+      phases[-1].rate = float(match.group(3))
+    next_phase = len(phases)
+    if next_phase < len(_PHASES) and _PHASES[next_phase][1].match(line):
+      EndPhase(phases[-1])
+      phase = _PhaseStats(_PHASES[next_phase][0])
+      phase.new_objects_bytes_start = capacity_plan.DirSize(new_objects_dir)
+      phases.append(phase)
+  proc.wait()
+  done.set()
+  sampler.join()
+  EndPhase(phases[-1])
+  if proc.returncode != 0:
+    sys.stderr.write(''.join(output[-50:]))
+    raise Exception('chromium_blink_merge.py failed (%d)' % proc.returncode)
+  return phases
+
+
+def PrintReport(phases):
+  print '%-10s %10s %12s %14s %10s %14s' % (
+      'Phase', 'Seconds', 'Peak RSS MB', 'Written MB', 'Objects', 'Objects/sec')
+  for phase in phases:
+    print '%-10s %10.1f %12.1f %14.1f %10s %14s' % (
+        phase.name, phase.tend - phase.tstart, phase.peak_rss / 1048576.0,
+        phase.new_objects_bytes / 1048576.0,
+        phase.num_objects if phase.num_objects is not None else '-',
+        '%.1f' % phase.rate if phase.rate is not None else '-')
+
+
+def main():
+  parser = optparse.OptionParser(
+      usage='%prog [options] [-- chromium_blink_merge.py options]')
+  parser.add_option('--work-dir', help='Where to run the merge. Its contents '
+      'are deleted.')
+  parser.add_option('--repos', help='Dir with the blink.git and chromium.git '
+      'to use. If omitted, they are generated in work-dir/repos.')
+  parser.add_option('--blink-commits', type='int', default=2000,
+      help='Size of the generated blink repo (default: %default)')
+  parser.add_option('--json', help='Also write the report to this file.')
+  parser.add_option('--verbose', '-v', action='store_true',
+      help='Print the output of the merge.')
+  options, merge_args = parser.parse_args()
+  if not options.work_dir:
+    parser.error('--work-dir is required')
+
+  work_dir = os.path.abspath(options.work_dir)
+  repos_dir = options.repos and os.path.abspath(options.repos)
+  if not repos_dir:
+    repos_dir = os.path.join(work_dir, 'repos')
+    if not os.path.exists(repos_dir):
+      subprocess.check_call(
+          [sys.executable,
+           os.path.join(os.path.dirname(__file__), 'make_synthetic_repos.py'),
+           '--blink-commits', str(options.blink_commits), repos_dir])
+  merge_dir = os.path.join(work_dir, 'merge')
+  if os.path.exists(merge_dir):
+    shutil.rmtree(merge_dir)
+  os.makedirs(merge_dir)
+
+  phases = RunMerge(merge_dir, repos_dir, merge_args, options.verbose)
+  PrintReport(phases)
+  if options.json:
+    report = {'args': merge_args, 'repos': repos_dir,
+              'phases': [p.ToDict() for p in phases]}
+    metrics_path = os.path.join(merge_dir, 'metrics.json')
+    if os.path.exists(metrics_path):  # The report of the merge itself.
+      with open(metrics_path) as f:
+        report['metrics'] = json.load(f)
+    with open(options.json, 'w') as f:
+      json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -2,250 +2,1133 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import hashlib
+import itertools
 import multiprocessing
+import multiprocessing.util
 import os
 import subprocess
 import sys
+import time
 import traceback
 
+import config
 import eta_estimator
 import gitutils
+import metrics
+import rewrite_rules
+import sha_arrays
+import shared_sha_table
+import translation_store
 
 
-# Set of extensions to strip out from the LayoutTest/ directory
-_BIN_EXTS = ({'.png'})
+# Default capacity of the tree translation table (see shared_sha_table). Each
+# slot takes 41 bytes of (lazily allocated) memory.
+DEFAULT_TREE_CACHE_SLOTS = 1 << 24
+
+# Default capacity of the commit translation table (same as above).
+DEFAULT_COMMIT_CACHE_SLOTS = 1 << 21
+
+# Above this load factor the lookups of the translation tables slow down (and
+# the tables can't grow): a warning suggests to make them bigger.
+MAX_CACHE_LOAD_FACTOR = 0.7
+
+# When RewriteBlinkHistory is given a |state_dir|, the translations are
+# checkpointed (roughly) every these many seconds.
+_CHECKPOINT_INTERVAL_SECONDS = 120
 
 # Global dir constants (set by RewriteBlinkHistory and read by subprocesses).
 class _DIRS:
   ROOT_DIR = None  # Blink git dir (the one containing objects/ refs/ etc.)
   NEWOBJS = None   # Where the new git objects (trees, blobs) will be stored.
 
+# Global options (set by RewriteBlinkHistory and read by subprocesses).
+class _OPTS:
+  READER = 'native'  # Key of gitutils.READONLY_OBJDB_CLASSES.
+  WRITER = 'pack'  # Key of gitutils.WRITABLE_OBJDB_CLASSES.
+  SCHEDULING = 'global'  # 'global', 'per-root' or 'diff' (see above).
+  VERIFY = 'deferred'  # One of gitutils.ObjectVerifier.MODES.
+  RULES = None  # The rewrite_rules.RuleSet deciding what to strip.
+
 # Per-process (i.e. initialized after spawn) instances of gitutils classes.
 class _GITDB:
-  ORIG = None  # An instance of GitReadonlyObjDB
-  NEW = None  # An instance of GitLooseObjDB
+  ORIG = None  # An instance of GitNativeObjDB or GitReadonlyObjDB
+  NEW = None  # An instance of GitPackObjDB or GitLooseObjDB
+
+# On-disk checkpoints of the translations (see RewriteBlinkHistory).
+class _STATE:
+  TREES = None  # A TranslationStore for _tree_cache.
+  COMMITS = None  # A TranslationStore for _commit_cache.
+  HEADS_PATH = None  # Text file of "branch orig_head rewritten_head" lines.
+  WHITELIST_PATH = None  # Binary SHA1s of _obj_whitelist.
+  # Binary SHA1s of the _obj_whitelist of the first run: the translations made
+  # by the runs in between used a whitelist between this and the one above.
+  FIRST_WHITELIST_PATH = None
+  RULES_PATH = None  # Fingerprint of the rules the translations were made with.
+
+# Background verification of the objects read, when _OPTS.VERIFY='deferred'.
+class _VERIFY:
+  QUEUE = None  # A multiprocessing.Queue of lists of SHA1s to verify.
+  NUM_VERIFIED = None  # A multiprocessing.Value.
+  NUM_FAILED = None  # A multiprocessing.Value.
+  PROCS = []  # The verifier processes.
+
+# All the SHA1s below are binary (see gitutils). Hex is used only for git
+# command lines, the files meant to be read by humans and the log messages.
+
+# Cross-process shared cache of rewritten trees (original SHA1 -> rewritten).
+# The trees below the root are keyed by their rule state as well (see
+# rewrite_rules.DirState.CacheKey). Pool workers access it directly, without
+# any IPC. Created by RewriteBlinkHistories, before forking them.
+_tree_cache = None
+
+# Translations made by the current pool worker since its last job completed.
+# They are checkpointed by the main process (see _RewriteTrees).
+_new_tree_translations = []
+
+# Cache of rewritten commits (original SHA1 -> rewritten SHA1). Only the main
+# process accesses it, it is a SharedShaTable just for the compact layout.
+_commit_cache = None
+
+# Blobs preserved by the keep_if_at_tip rules (a SortedShaSet).
+_obj_whitelist = sha_arrays.SortedShaSet()
 
-# Cross-process shared cache of rewritten trees.
-_tree_cache = multiprocessing.Manager().dict()
 
-# Whitelist of .png files to preserve across the rewrite.
-_obj_whitelist = set()
+def RewriteBlinkHistory(branch, blink_git_dir, new_obj_dir, **kwargs):
+  """Rewrites the history of a single blink branch (see RewriteBlinkHistories).
 
+  Returns:
+    The SHA1 (40 chars hex string) of the rewritten head.
+  """
+  return RewriteBlinkHistories([branch], blink_git_dir, new_obj_dir,
+                               **kwargs)[branch]
 
-def RewriteBlinkHistory(branch, blink_git_dir, new_obj_dir):
-  """Rewrites the history of the given blink branch
+
+def RewriteBlinkHistories(branches, blink_git_dir, new_obj_dir,
+                          reader='native', writer='pack', state_dir=None,
+                          scheduling='global', verify='deferred', rules=None,
+                          tree_cache_slots=None, commit_cache_slots=None):
+  """Rewrites the history of the given blink branches, in one pass.
 
   The rewrite consists of the following:
-    For each commit reachable by |branch|:
-      - Remove all .png files (see _BIN_EXTS) from the /LayoutTests directory.
+    For each commit reachable by any of the |branches|:
+      - Remove the files selected by the |rules| (by default the LayoutTests
+        .png files, see config.REWRITE_RULES).
       - Make the root tree a subtree of /third_party/WebKit/ (i.e. pretend that
         all commits always happened in third_party/WebKit).
+  The history shared by the branches is rewritten only once. The files of the
+  keep_if_at_tip rules which exist in the head of any of the branches are
+  preserved.
 
   Args:
-    branch: full ref to the branch to rewrite (e.g. refs/heads/master).
+    branches: list of full refs to the branches to rewrite (e.g.
+        refs/heads/master). Duplicates are fine.
     blink_git_dir: path to the source Blink git dir (will not be modified).
     new_obj_dir: where the newly created git objects will be stored.
+    reader: backend used to read the original objects (a key of
+        gitutils.READONLY_OBJDB_CLASSES).
+    writer: backend used to write the new objects (a key of
+        gitutils.WRITABLE_OBJDB_CLASSES).
+    state_dir: if not None, where the tree and commit translations are
+        checkpointed periodically. A subsequent run with the same |state_dir|
+        (and |new_obj_dir|) resumes from the last checkpoint. Once the
+        branches have been rewritten, their heads are recorded as well: the
+        next run rewrites only the commits added since then (i.e.
+        old_head..branch).
+    scheduling: how Phase 1 distributes the work to the pool.
+        'per-root': one job per root tree, each one recursing into the
+        directories that the rules can affect.
+        'global': first enumerates the distinct subtrees of those directories
+        in the whole history and rewrites them bottom-up, one level at a time,
+        so that each of them is read and written exactly once.
+        'diff': no pool. Walks the commits parents first and patches the
+        rewritten tree of the first parent with the paths that the commit
+        changed (see _RewriteTreesByDiff).
+    verify: how the integrity of the objects read is checked (one of
+        gitutils.ObjectVerifier.MODES). With 'deferred' the objects are
+        re-read and hashed by a pool of background processes, and the rewrite
+        fails at the end if any of them is corrupted.
+    rules: a rewrite_rules.RuleSet. Defaults to config.REWRITE_RULES.
+        Changing the rules discards the state of the previous runs.
+    tree_cache_slots, commit_cache_slots: the capacity (a power of 2) of the
+        translation tables, which can't grow. They must fit all the trees and
+        commits rewritten, by this run and the previous ones (see --plan).
+        Default to DEFAULT_TREE_CACHE_SLOTS and DEFAULT_COMMIT_CACHE_SLOTS.
+        Ignored if the tables exist already (i.e. by the next calls).
 
   Returns:
-    The SHA1 (40 chars hex string) of the rewritten head.
+    A dict {branch: SHA1 (40 chars hex string) of its rewritten head}.
   """
   _DIRS.ROOT_DIR = blink_git_dir
   _DIRS.NEWOBJS = new_obj_dir
+  _OPTS.READER = reader
+  _OPTS.WRITER = writer
+  _OPTS.SCHEDULING = scheduling
+  metrics.SetInfo('scheduling', scheduling)
+  _OPTS.VERIFY = verify
+  _OPTS.RULES = rules or rewrite_rules.RuleSet.FromConfig(config.REWRITE_RULES)
+
+  global _tree_cache, _commit_cache
+  if _tree_cache is None:
+    _tree_cache = shared_sha_table.SharedShaTable(
+        tree_cache_slots or DEFAULT_TREE_CACHE_SLOTS)
+    _commit_cache = shared_sha_table.SharedShaTable(
+        commit_cache_slots or DEFAULT_COMMIT_CACHE_SLOTS)
 
+  if _OPTS.VERIFY == 'deferred':
+    _StartDeferredVerification()
   _InitGitDBForCurrentProcess()  # Init db for the main process.
 
-  print '\nRewriting blink history for %s' % branch
+  branches = gitutils.Unique(branches)
+  print '\nRewriting blink history for %s' % ' '.join(branches)
   print '--------------------------------------------------------'
   assert os.path.isdir(_DIRS.NEWOBJS)
 
-  commits, trees = _LoadRevlist(branch)
-  print 'First commit to rewrite: ', subprocess.check_output(
-      ['git', 'log', '-1', r'--format=%h %cd %s', commits[0]],
-      cwd=_DIRS.ROOT_DIR).strip()
-  print 'Last commit to rewrite:  ', subprocess.check_output(
-      ['git', 'log', '-1', r'--format=%h %cd %s', commits[-1]],
-      cwd=_DIRS.ROOT_DIR).strip()
-  print 'Num commits to rewrite:  ', len(commits)
-
-  print 'Computing whitelist of binary files to keep'
-  last_treeish = trees[-1]
-  _BuildPngWhitelist(last_treeish, _obj_whitelist)
-  print 'Will preserve %d %s blobs (reference treeish: %s)' % (
-      len(_obj_whitelist), ' '.join(_BIN_EXTS), last_treeish[0:12])
-
-  print 'Phase 1/2: rewriting trees in parallel'
-  _RewriteTrees(trees)
-
-  print 'Phase 2/2: rewriting commits serially'
-  rewriten_head_sha1 = _RewriteCommits(commits)
+  if state_dir and not _STATE.TREES:
+    with metrics.Stage('load_state'):
+      _LoadState(state_dir)
+    _WarnIfCachesAlmostFull()
+
+  global _obj_whitelist
+  heads = dict(zip(branches, _RevParse(branches)))
+  if all(heads[b] in _commit_cache for b in branches):
+    print 'No new commits to rewrite'
+  else:
+    print 'Computing whitelist of the files to keep'
+    with metrics.Stage('whitelist'):
+      head_trees = gitutils.Unique(_RevParse(
+          ['%s^{tree}' % heads[b].encode('hex') for b in branches]))
+      whitelist = set(_obj_whitelist)
+      if any(r.keep_if_at_tip for r in _OPTS.RULES.rules):
+        for head_tree in head_trees:
+          _BuildTipWhitelist(head_tree, _OPTS.RULES.root, whitelist)
+      _obj_whitelist = sha_arrays.SortedShaSet(whitelist)
+      del whitelist
+      metrics.Add('whitelist.blobs', len(_obj_whitelist))
+    print 'Will preserve %d blobs (reference treeish: %s)' % (
+        len(_obj_whitelist),
+        ' '.join(t.encode('hex')[0:12] for t in head_trees))
+    if _STATE.WHITELIST_PATH:
+      gitutils.WriteFileAtomic(_STATE.WHITELIST_PATH, _obj_whitelist.ToBytes())
+      if not os.path.exists(_STATE.FIRST_WHITELIST_PATH):
+        gitutils.WriteFileAtomic(_STATE.FIRST_WHITELIST_PATH,
+                                 _obj_whitelist.ToBytes())
+
+    # The commits reachable from the heads rewritten by a previous run have all
+    # been rewritten already. Exclude them from the walk.
+    sinces = gitutils.Unique(filter(None, (_GetLastRewrittenHead(b)
+                                           for b in branches)))
+    for since in sinces:
+      print 'Previously rewritten head:', since[0:12]
+    rev_args = [h.encode('hex')
+                for h in gitutils.Unique(heads[b] for b in branches)]
+    rev_args += ['^' + s for s in sinces]
+    commits = sha_arrays.ShaArray()
+    if _OPTS.SCHEDULING == 'global':
+      print 'Enumerating the trees to rewrite'
+      with metrics.Stage('revlist'):
+        commits, tree_levels = _PlanTrees(rev_args)
+    elif _OPTS.SCHEDULING == 'diff':
+      tree_levels = None
+    else:
+      # The root trees are rewritten while git is still walking the history.
+      tree_levels = [(0, '', _StreamRootTrees(rev_args, commits))]
+
+    with metrics.Stage('trees'):
+      if tree_levels is None:
+        print 'Phase 1/2: rewriting trees, diffing each commit with its parent'
+        _RewriteTreesByDiff(rev_args, commits)
+      else:
+        print 'Phase 1/2: rewriting trees in parallel'
+        _RewriteTrees(tree_levels)
+    print 'Num commits to rewrite:  ', len(commits)
+    metrics.Add('revlist.commits', len(commits))
+
+    print 'Phase 2/2: rewriting commits'
+    with metrics.Stage('commits'):
+      _RewriteCommits(commits)
+      _GITDB.NEW.Flush()  # Make the new objects visible to other processes.
+    _WarnIfCachesAlmostFull()
+
+  rewritten_heads = {}
+  for branch in branches:
+    rewritten_heads[branch] = _commit_cache.Get(heads[branch]).encode('hex')
+    print 'New head of %s is %s (which corresponds to %s)' % (
+        branch, rewritten_heads[branch][0:12],
+        heads[branch].encode('hex')[0:12])
+  if _STATE.HEADS_PATH:
+    _SaveRewrittenHeads(dict((b, (heads[b].encode('hex'), rewritten_heads[b]))
+                             for b in branches))
+  _FinishRewrite()
   print '--------------------------------------------------------'
 
-  return rewriten_head_sha1
+  return rewritten_heads
+
+
+def _WarnIfCachesAlmostFull():
+  for name, table in (('tree', _tree_cache), ('commit', _commit_cache)):
+    if table.load_factor > MAX_CACHE_LOAD_FACTOR:
+      print ('Warning: the %s translation table is %d%% full (%d slots), it '
+             'slows down and fails once full. Make it bigger (see '
+             '--%s-cache-slots and --plan)' % (
+                 name, table.load_factor * 100, table.num_slots, name))
+
+
+def CountRewrite(branches, blink_git_dir, reader='native', state_dir=None,
+                 rules=None):
+  """Counts the work that RewriteBlinkHistories would do, writing nothing.
+
+  The arguments are the same of RewriteBlinkHistories. The |state_dir| is only
+  read, to exclude the commits rewritten by the previous run.
+
+  Returns:
+    A dict with:
+      'branches': {branch: {'commits', 'root_trees', 'subtrees'}}, the counts
+          of the whole history of each branch. The subtrees are the distinct
+          ones that the rules can affect (e.g. LayoutTests/**).
+      'commits', 'root_trees', 'subtrees': the same, for the history to
+          rewrite (of all the branches, since their previous rewrite if any).
+      'blobs_dropped': the distinct blobs stripped by the rules.
+      'entries_dropped': the tree entries removed.
+      'new_trees', 'new_tree_bytes': the trees written by the rewrite
+          (including the third_party/WebKit nesting) and their total size.
+      'commit_bytes': the total size of the commits to rewrite.
+  """
+  global _obj_whitelist
+  _DIRS.ROOT_DIR = blink_git_dir
+  _OPTS.RULES = rules or rewrite_rules.RuleSet.FromConfig(config.REWRITE_RULES)
+  _GITDB.ORIG = gitutils.READONLY_OBJDB_CLASSES[reader](blink_git_dir)
+  branches = gitutils.Unique(branches)
+  heads = dict(zip(branches, _RevParse(branches)))
+
+  counts = {'branches': {}, 'blobs_dropped': 0, 'entries_dropped': 0,
+            'new_trees': 0, 'new_tree_bytes': 0}
+  for branch in branches:
+    print 'Counting the history of', branch
+    commits, tree_levels = _PlanTrees([heads[branch].encode('hex')])
+    counts['branches'][branch] = _CountLevels(commits, tree_levels)
+
+  sinces = []
+  if state_dir and _ReadRulesFingerprint(state_dir) == _OPTS.RULES.fingerprint:
+    _STATE.HEADS_PATH = os.path.join(state_dir, 'heads')
+    rewritten_heads = LoadRewrittenHeads(_STATE.HEADS_PATH)
+    for branch, (orig_head, _) in rewritten_heads.iteritems():
+      if branch in heads and _IsAncestor(orig_head, branch):
+        sinces.append(orig_head)
+  print 'Counting the history to rewrite'
+  rev_args = [h.encode('hex')
+              for h in gitutils.Unique(heads[b] for b in branches)]
+  rev_args += ['^' + s for s in gitutils.Unique(sinces)]
+  commits, tree_levels = _PlanTrees(rev_args)
+  counts.update(_CountLevels(commits, tree_levels))
+  counts['commit_bytes'] = sum(_ObjectSizes(commits))
+
+  whitelist = set()
+  if any(r.keep_if_at_tip for r in _OPTS.RULES.rules):
+    for head_tree in gitutils.Unique(_RevParse(
+        ['%s^{tree}' % heads[b].encode('hex') for b in branches])):
+      _BuildTipWhitelist(head_tree, _OPTS.RULES.root, whitelist)
+  _obj_whitelist = sha_arrays.SortedShaSet(whitelist)
+  del whitelist
+
+  print 'Counting the blobs to strip'
+  changed = {}  # Cache key -> whether the tree changes (see _CountTree).
+  dropped_blobs = set()
+  _, _, root_trees = tree_levels[-1]
+  for tree_sha1 in root_trees:
+    _CountTree(tree_sha1, _OPTS.RULES.root, changed, counts, dropped_blobs)
+  # Each root gets nested in two new trees (see _RewriteOneTree).
+  counts['new_trees'] += 2 * len(root_trees)
+  counts['new_tree_bytes'] += len(root_trees) * (
+      len('40000 WebKit\0') + len('40000 third_party\0') + 40)
+  counts['blobs_dropped'] = len(dropped_blobs)
+  _GITDB.ORIG.Close()
+  _GITDB.ORIG = None
+  return counts
+
+
+def _CountLevels(commits, tree_levels):
+  """Counts the commits and trees returned by _PlanTrees."""
+  root_trees = sum(len(t) for depth, _, t in tree_levels if depth == 0)
+  return {'commits': len(commits), 'root_trees': root_trees,
+          'subtrees': sum(len(t) for _, _, t in tree_levels) - root_trees}
+
+
+def _CountTree(tree_sha1, state, changed, counts, dropped_blobs):
+  """Like _RewriteOneTree, but it only counts what the rewrite would do (in
+  |counts| and |dropped_blobs|). Returns whether the tree would change."""
+  key = state.CacheKey(tree_sha1)
+  if key in changed:
+    return changed[key]
+  tree = _GITDB.ORIG.ReadTree(tree_sha1)
+  new_size = len(tree.payload)
+  is_changed = False
+  for mode, fname, sha1 in _EntriesToVisit(tree, state):
+    if mode[0] == '1':  # It's a file
+      rules = state.MatchFile(fname)
+      if rules and _ShouldStrip(rules, sha1):
+        counts['entries_dropped'] += 1
+        dropped_blobs.add(sha1)
+        new_size -= len(mode) + len(fname) + 22  # '<mode> <name>\0<sha1>'.
+        is_changed = True
+    else:
+      assert mode == '40000'
+      child_state = state.Child(fname)
+      if child_state and _CountTree(sha1, child_state, changed, counts,
+                                    dropped_blobs):
+        is_changed = True
+  if is_changed:
+    counts['new_trees'] += 1
+    counts['new_tree_bytes'] += new_size
+  changed[key] = is_changed
+  return is_changed
+
+
+def _ObjectSizes(sha1s):
+  """Yields the size of each of the given objects (without reading them)."""
+  proc = subprocess.Popen(
+      ['git', 'cat-file', '--batch-check=%(objectsize)'], cwd=_DIRS.ROOT_DIR,
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+  out, _ = proc.communicate(''.join(s.encode('hex') + '\n' for s in sha1s))
+  assert proc.returncode == 0, 'git cat-file failed'
+  for line in out.splitlines():
+    yield int(line)
+
+
+def _FinishRewrite():
+  _CloseGitDBForCurrentProcess()  # Makes the new objects visible to others.
+  if _OPTS.VERIFY == 'deferred':
+    with metrics.Stage('verify'):
+      _FinishDeferredVerification()
+
+
+def _StartDeferredVerification():
+  _VERIFY.QUEUE = multiprocessing.Queue()
+  _VERIFY.NUM_VERIFIED = multiprocessing.Value('l', 0)
+  _VERIFY.NUM_FAILED = multiprocessing.Value('l', 0)
+  num_procs = max(1, multiprocessing.cpu_count() // 4)
+  _VERIFY.PROCS = [multiprocessing.Process(target=_DeferredVerifierMain)
+                   for _ in xrange(num_procs)]
+  for proc in _VERIFY.PROCS:
+    proc.start()
+
+
+def _FinishDeferredVerification():
+  """Waits for the verifier processes and fails if any object was corrupted."""
+  for _ in _VERIFY.PROCS:
+    _VERIFY.QUEUE.put(None)
+  for proc in _VERIFY.PROCS:
+    proc.join()
+  assert all(p.exitcode == 0 for p in _VERIFY.PROCS), 'Verifier crashed'
+  _VERIFY.PROCS = []
+  print 'Verified %d objects read' % _VERIFY.NUM_VERIFIED.value
+  metrics.Add('verify.objs_verified', _VERIFY.NUM_VERIFIED.value)
+  metrics.Add('verify.objs_failed', _VERIFY.NUM_FAILED.value)
+  assert _VERIFY.NUM_FAILED.value == 0, (
+      '%d objects failed the verification' % _VERIFY.NUM_FAILED.value)
+
+
+def _DeferredVerifierMain():
+  """Entry point of the deferred verification processes."""
+  # The objects are re-read by a reader that verifies them inline.
+  db = gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.ROOT_DIR)
+  already_verified = set()
+  while True:
+    sha1s = _VERIFY.QUEUE.get()
+    if sha1s is None:
+      break
+    sha1s = [s for s in gitutils.Unique(sha1s) if s not in already_verified]
+    num_failed = 0
+    for sha1 in sha1s:
+      try:
+        db.ReadObj(sha1)
+        already_verified.add(sha1)
+      except AssertionError:
+        sys.stderr.write('\nVerification failed for %s\n%s' % (
+            sha1.encode('hex'), traceback.format_exc()))
+        num_failed += 1
+        db.Close()  # The reader might be in an inconsistent state.
+        db = gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.ROOT_DIR)
+    with _VERIFY.NUM_VERIFIED.get_lock():
+      _VERIFY.NUM_VERIFIED.value += len(sha1s)
+    with _VERIFY.NUM_FAILED.get_lock():
+      _VERIFY.NUM_FAILED.value += num_failed
+  db.Close()
 
 
 def _InitGitDBForCurrentProcess():
   """Called by both the main and the pool's subprocesses to get a unique
   instance per process."""
+  _CloseGitDBForCurrentProcess()
+  if _OPTS.VERIFY == 'deferred':
+    verifier = gitutils.ObjectVerifier('deferred',
+                                       deferred_sink=_VERIFY.QUEUE.put)
+  else:
+    verifier = gitutils.ObjectVerifier(_OPTS.VERIFY)
+  _GITDB.ORIG = gitutils.MeteredObjDB(
+      gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.ROOT_DIR,
+                                                    verifier=verifier),
+      metrics.Counters(), 'blink')
+  _GITDB.NEW = gitutils.MeteredObjDB(
+      gitutils.WRITABLE_OBJDB_CLASSES[_OPTS.WRITER](_DIRS.NEWOBJS),
+      metrics.Counters(), 'new')
+
+
+def _CloseGitDBForCurrentProcess():
   if _GITDB.ORIG:
     _GITDB.ORIG.Close()
-  _GITDB.ORIG = gitutils.GitReadonlyObjDB(_DIRS.ROOT_DIR)
-  _GITDB.NEW = gitutils.GitLooseObjDB(_DIRS.NEWOBJS)
+  if _GITDB.NEW:
+    _GITDB.NEW.Close()
+  _GITDB.ORIG = _GITDB.NEW = None
+
+
+def _InitPoolWorker():
+  """Initializer of the pool's subprocesses."""
+  # Drop, without closing them, the instances inherited from the parent.
+  _GITDB.ORIG = _GITDB.NEW = None
+  metrics.ResetForWorker()
+  _InitGitDBForCurrentProcess()
+  # Pool workers exit without returning to the caller. Make sure that the
+  # pending objects (e.g., the current pack) are flushed before exiting.
+  multiprocessing.util.Finalize(None, _CloseGitDBForCurrentProcess,
+                                exitpriority=10)
+
+
+def _LoadState(state_dir):
+  """Loads the translations checkpointed by a previous run (if any)."""
+  gitutils.Makedirs(state_dir)
+  _STATE.TREES = translation_store.TranslationStore(
+      os.path.join(state_dir, 'trees.xlat'))
+  _STATE.COMMITS = translation_store.TranslationStore(
+      os.path.join(state_dir, 'commits.xlat'))
+  _STATE.HEADS_PATH = os.path.join(state_dir, 'heads')
+  _STATE.WHITELIST_PATH = os.path.join(state_dir, 'whitelist')
+  _STATE.FIRST_WHITELIST_PATH = os.path.join(state_dir, 'whitelist.first')
+  _STATE.RULES_PATH = os.path.join(state_dir, 'rules')
 
+  # The translations (and the whitelist) are valid only for the rules they
+  # were made with.
+  fingerprint = _ReadRulesFingerprint(state_dir)
+  if fingerprint != _OPTS.RULES.fingerprint:
+    paths = [_STATE.TREES.path, _STATE.COMMITS.path, _STATE.HEADS_PATH,
+             _STATE.WHITELIST_PATH, _STATE.FIRST_WHITELIST_PATH]
+    paths = [p for p in paths if os.path.exists(p)]
+    if paths:
+      print 'The rewrite rules changed, discarding the previous state'
+    for path in paths:
+      os.remove(path)
+    gitutils.WriteFileAtomic(_STATE.RULES_PATH, _OPTS.RULES.fingerprint + '\n')
 
-def _BuildPngWhitelist(tree_sha1, whitelist, depth=0, in_layouttests_dir=False):
-  """Builds up a set of SHA1s of .png files for a tree. This is to build
-     the decisional set of the .png to NOT drop in the rewrite process."""
-  assert len(tree_sha1) == 40
-  tree_entries = _GITDB.ORIG.ReadTree(tree_sha1)
-  for mode, fname, sha1 in tree_entries:
+  # The whitelist can only grow across runs (as it does across branches within
+  # the same run), so that the translations of the trees stay valid. Hence a
+  # blob stripped by a previous run stays stripped in the trees it rewrote,
+  # even if it is back at a tip (unlike in a run from scratch).
+  global _obj_whitelist
+  if os.path.exists(_STATE.WHITELIST_PATH):
+    with open(_STATE.WHITELIST_PATH, 'rb') as f:
+      _obj_whitelist = sha_arrays.SortedShaSet.FromBytes(f.read())
+
+  # Discard the translations pointing to objects that don't exist (anymore).
+  dbs = [gitutils.GitNativeObjDB(objdir=_DIRS.NEWOBJS),
+         gitutils.GitNativeObjDB(_DIRS.ROOT_DIR)]
+  translations = _STATE.TREES.Load()
+  _DropDanglingTranslations(translations, dbs)
+  _tree_cache.Update(translations)
+  print 'Loaded %d translations from %s' % (len(translations),
+                                            _STATE.TREES.path)
+  translations = _STATE.COMMITS.Load()
+  _DropDanglingTranslations(translations, dbs)
+  _commit_cache.Update(translations)
+  print 'Loaded %d translations from %s' % (len(translations),
+                                            _STATE.COMMITS.path)
+  for db in dbs:
+    db.Close()
+
+
+def _DropDanglingTranslations(translations, dbs):
+  """Removes from |translations| the ones to objects that none of |dbs| has.
+
+  The trees left untouched by the rewrite are translated to themselves, but
+  below the root their key is not their SHA1 (see _tree_cache), hence they are
+  looked up as well. The lookups don't rescan the packs (a listdir() per miss,
+  see GitNativeObjDB.HasObj): the misses are looked up again, once, after a
+  single rescan.
+  """
+  def Exists(sha1):
+    return any(db.HasObj(sha1, rescan=False) for db in dbs)
+  missing = [orig for orig, new in translations.iteritems()
+             if orig != new and not Exists(new)]
+  if not missing:
+    return
+  for db in dbs:
+    db.RescanPacks()
+  for orig in missing:
+    if not Exists(translations[orig]):
+      del translations[orig]
+
+
+def _ReadRulesFingerprint(state_dir):
+  """Returns the fingerprint of the rules of the state in |state_dir|."""
+  path = os.path.join(state_dir, 'rules')
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return f.read().strip()
+
+
+def LoadRewrittenHeads(heads_path):
+  """Returns a dict {branch: (orig head, rewritten head)}, as hex SHA1s, of the
+  heads recorded in |heads_path| (e.g. rewrite_state/heads)."""
+  heads = {}
+  if heads_path and os.path.exists(heads_path):
+    with open(heads_path) as f:
+      for line in f:
+        branch, orig_head, new_head = line.split()
+        heads[branch] = (orig_head, new_head)
+  return heads
+
+
+def _SaveRewrittenHeads(new_heads):
+  """Records the given {branch: (orig head, rewritten head)}."""
+  heads = LoadRewrittenHeads(_STATE.HEADS_PATH)
+  heads.update(new_heads)
+  gitutils.WriteFileAtomic(_STATE.HEADS_PATH, ''.join(
+      '%s %s %s\n' % (b, h[0], h[1]) for b, h in sorted(heads.iteritems())))
+
+
+def _GetLastRewrittenHead(branch):
+  """Returns the original head of |branch| rewritten by a previous run, if it is
+  still an ancestor of |branch| (i.e. the branch has only moved forward)."""
+  orig_head, new_head = LoadRewrittenHeads(_STATE.HEADS_PATH).get(
+      branch, (None, None))
+  if (not orig_head or
+      _commit_cache.Get(orig_head.decode('hex')) != new_head.decode('hex')):
+    return None
+  return orig_head if _IsAncestor(orig_head, branch) else None
+
+
+def _IsAncestor(rev, branch):
+  return subprocess.call(['git', 'merge-base', '--is-ancestor', rev, branch],
+                         cwd=_DIRS.ROOT_DIR) == 0
+
+
+def _BuildTipWhitelist(tree_sha1, state, whitelist):
+  """Builds up the set of SHA1s of the blobs of |tree_sha1| (in the directory
+     of |state|) that a keep_if_at_tip rule must NOT drop in the rewrite."""
+  assert len(tree_sha1) == 20
+  for mode, fname, sha1 in _EntriesToVisit(_GITDB.ORIG.ReadTree(tree_sha1),
+                                           state):
     if mode[0] == '1':  # It's a file
-      _, ext = os.path.splitext(fname)
-      if in_layouttests_dir and ext.lower() in _BIN_EXTS:
+      if any(r.keep_if_at_tip for r in state.MatchFile(fname)):
         whitelist.add(sha1)
-        continue
     else:
       assert mode == '40000'
-      if (in_layouttests_dir or fname == 'LayoutTests'):
-        _BuildPngWhitelist(sha1, whitelist, depth + 1, True)
+      child_state = state.Child(fname)
+      if child_state:
+        _BuildTipWhitelist(sha1, child_state, whitelist)
+
+
+def _EntriesToVisit(tree, state):
+  """Returns the entries of |tree| (a TreeView) that the rules of its |state|
+  can affect (possibly more)."""
+  if state.has_file_rules or state.literal_children is None:
+    return list(tree)
+  # Only a few subdirectories are named by the rules (e.g. LayoutTests/).
+  indexes = (tree.Find(name) for name in state.literal_children)
+  return [tree[i] for i in indexes if i is not None]
+
 
+def _PlanTrees(rev_args):
+  """Enumerates the distinct trees to rewrite, walking the history once.
 
-def _RewriteTrees(trees):
-  pool = multiprocessing.Pool(initializer=_InitGitDBForCurrentProcess)
-  eta = eta_estimator.ETA(len(trees), unit='trees')
-  for _ in pool.imap_unordered(_RewriteOneTreeWrapper, trees):
+  Returns:
+    A tuple (commits, tree_levels). |commits| is a ShaArray of all the commits
+    walked, in the order of git rev-list (children first). |tree_levels| is a
+    list of (depth, state path, ShaArray of trees) (see _RewriteTrees): the
+    subtrees that the rules can affect, deepest level first, and the root
+    trees last. A subtree is assigned to the level of the path where git met
+    it first. Should the same tree show up also at a shallower depth, it just
+    gets rewritten (recursively) by the job of its parent, if that runs first.
+  """
+  cmd = ['git', 'rev-list', '--objects', '--filter=blob:none'] + rev_args
+  proc = subprocess.Popen(
+      cmd, stdout=subprocess.PIPE, cwd=_DIRS.ROOT_DIR, bufsize=1048576)
+  commits = sha_arrays.ShaArray()
+  root_trees = sha_arrays.ShaArray()
+  levels = {(0, ''): root_trees}  # (depth, state path) -> ShaArray of trees.
+  for line in proc.stdout:
+    line = line.rstrip('\r\n')
+    if len(line) == 40:
+      commits.Append(line.decode('hex'))
+    elif len(line) == 41:  # A root tree (its path is empty).
+      root_trees.Append(line[0:40].decode('hex'))
+    else:
+      path = line[41:]
+      state = _OPTS.RULES.StateAt(path)
+      if state:
+        key = (path.count('/') + 1, state.path)
+        if key not in levels:
+          levels[key] = sha_arrays.ShaArray()
+        levels[key].Append(line[0:40].decode('hex'))
+  assert proc.wait() == 0, 'Failed: %s' % ' '.join(cmd)
+  print 'Found %d root trees and %d subtrees to rewrite, %d levels deep' % (
+      len(root_trees), sum(len(l) for l in levels.itervalues()) -
+      len(root_trees), max(depth for depth, _ in levels))
+  return commits, [(depth, path, levels[(depth, path)])
+                   for depth, path in sorted(levels, reverse=True)]
+
+
+def _StreamRootTrees(rev_args, commits):
+  """Yields the distinct root trees, as git rev-list emits them.
+
+  The commits walked are appended to |commits| (a ShaArray), in the order of
+  git rev-list (children first). It is complete once the generator is
+  exhausted.
+  """
+  cmd = ['git', 'rev-list', '--format=%T'] + rev_args
+  proc = subprocess.Popen(
+      cmd, stdout=subprocess.PIPE, cwd=_DIRS.ROOT_DIR, bufsize=1048576)
+  seen = set()
+  commit_sha = None
+  for line in proc.stdout:
+    line = line.rstrip('\r\n')
+    if line.startswith('commit'):
+      commit_sha = line[7:]
+      continue
+    assert len(commit_sha) == 40
+    assert len(line) == 40
+    commits.Append(commit_sha.decode('hex'))
+    tree_sha1 = line.decode('hex')
+    if tree_sha1 not in seen:
+      seen.add(tree_sha1)
+      yield tree_sha1
+  assert proc.wait() == 0, 'Failed: %s' % ' '.join(cmd)
+
+
+def _RewriteTrees(tree_levels):
+  """Rewrites the trees in |tree_levels| using a pool of workers.
+
+  Args:
+    tree_levels: a list of (depth, state path, trees), where trees is either a
+        ShaArray or an iterable of SHA1s (which is consumed while its trees are
+        being rewritten), all of them in the rule state of the directory
+        |state path| (see rewrite_rules.RuleSet.StateAt). All the trees of a
+        level are rewritten before starting the ones of the next level.
+  """
+  num_jobs = None
+  if all(isinstance(t, sha_arrays.ShaArray) for _, _, t in tree_levels):
+    num_jobs = 0
+    for _, path, trees in tree_levels:
+      state = _OPTS.RULES.StateAt(path)
+      num_jobs += sum(1 for t in trees if state.CacheKey(t) not in _tree_cache)
+    if len(_tree_cache):
+      print 'Skipping the trees already translated, %d left' % num_jobs
+  eta = eta_estimator.ETA(num_jobs, unit='trees')
+  # With checkpoints, each level is split in batches of |batch_size| trees,
+  # checkpointed once done (the size is then tuned to the rate measured).
+  # Without them, a level is a single batch, and |batch_size| is only the
+  # guess of its size for the streamed levels (to pick the chunksize).
+  batch_size = 1000
+  pool = None
+  num_procs = multiprocessing.cpu_count()
+  for _, path, trees in tree_levels:
+    level_size = len(trees) if isinstance(trees, sha_arrays.ShaArray) else None
+    state = _OPTS.RULES.StateAt(path)
+    level = ((t, path) for t in trees if state.CacheKey(t) not in _tree_cache)
+    level_done = level_size == 0
+    while not level_done:
+      if _STATE.TREES:
+        batch = itertools.islice(level, batch_size)
+        expected_size = min(batch_size, level_size or batch_size)
+      else:
+        batch = level
+        expected_size = level_size or batch_size
+      tstart = time.time()
+      pool = pool or multiprocessing.Pool(initializer=_InitPoolWorker)
+      chunksize = max(1, min(64, expected_size // (16 * num_procs)))
+      batch_len = 0
+      for new_translations, metrics_delta in metrics.TimedIter(
+          pool.imap_unordered(_RewriteOneTreeWrapper, batch, chunksize),
+          'ipc.wait_seconds'):
+        metrics.Merge(metrics_delta)
+        if _STATE.TREES:
+          _STATE.TREES.AddMany(new_translations)
+        batch_len += 1
+        eta.job_completed()
+      if level_size is not None:
+        level_size -= batch_len
+      level_done = (not _STATE.TREES or batch_len < batch_size or
+                    level_size == 0)
+      if not _STATE.TREES:
+        continue
+      pool.close()
+      pool.join()
+      pool = None
+      # All the workers have exited (hence flushed their objects) here. Only
+      # now the translations of the batch can be safely checkpointed, as they
+      # can refer to objects written by any of the workers.
+      _STATE.TREES.Checkpoint()
+      _GITDB.NEW.ConsolidatePacks()  # Each worker finalized its own pack.
+      # Size the next batch to take about _CHECKPOINT_INTERVAL_SECONDS.
+      rate = batch_len / max(time.time() - tstart, 0.001)
+      batch_size = max(100, int(rate * _CHECKPOINT_INTERVAL_SECONDS))
+  if pool:
+    pool.close()
+    pool.join()
+    _GITDB.NEW.ConsolidatePacks()
+  if num_jobs is None:
+    eta.set_total(eta.done)
+
+
+def _StreamCommitDiffs(rev_args):
+  """Yields the commits to rewrite, parents first, with what they changed.
+
+  Yields:
+    A tuple (commit, tree, first parent or None, changes) for each commit.
+    |changes| is the list of (old mode, new mode, new SHA1, status, path) of
+    the entries (trees included, each one before its contents) that differ
+    from the first parent, as reported by git diff-tree --raw. The modes are
+    the ones of the tree entries (e.g. '40000'), '' if there is no entry.
+  """
+  cmd = ['git', 'log', '--reverse', '--topo-order', '--format=%H %T %P',
+         '--diff-merges=first-parent', '--raw', '-r', '-t', '--no-renames',
+         '--no-abbrev', '-z'] + rev_args
+  proc = subprocess.Popen(
+      cmd, stdout=subprocess.PIPE, cwd=_DIRS.ROOT_DIR, bufsize=1048576)
+  commit = None
+  meta = None  # The raw diff line, until the path that follows it.
+  leftover = ''
+  while True:
+    chunk = proc.stdout.read(1048576)
+    tokens = (leftover + chunk).split('\0')
+    leftover = tokens.pop() if chunk else ''
+    for token in tokens:
+      if meta is not None:
+        old_mode, new_mode, _, new_sha1, status = meta.split()
+        commit[3].append((old_mode.lstrip('0'), new_mode.lstrip('0'),
+                          new_sha1.decode('hex'), status, token))
+        meta = None
+        continue
+      token = token.lstrip('\n')
+      if token.startswith(':'):
+        meta = token[1:]
+      elif token:
+        if commit:
+          yield commit
+        shas = [s.decode('hex') for s in token.split()]
+        commit = (shas[0], shas[1], shas[2] if len(shas) > 2 else None, [])
+    if not chunk:
+      break
+  if commit:
+    yield commit
+  assert proc.wait() == 0, 'Failed: %s' % ' '.join(cmd)
+
+
+def _RewriteTreesByDiff(rev_args, commits):
+  """Rewrites the root trees of the commits in |rev_args|, in the main process.
+
+  The rewritten tree of a commit is the one of its first parent, patched only
+  along the paths changed by the commit (see _PatchTree). So the work per
+  commit is proportional to the size of its change, not of its tree. Commits
+  without a rewritten parent (e.g. the first one) are rewritten from scratch.
+  The commits walked are appended to |commits| (a ShaArray), in the order of
+  git rev-list (children first).
+  """
+  reader = gitutils.LayeredObjDB(_GITDB.NEW, _GITDB.ORIG)
+  root_trees = {}  # commit -> its (original) tree, for the commits walked.
+  walked = sha_arrays.ShaArray()
+  eta = eta_estimator.ETA(None, unit='trees')
+  last_checkpoint = time.time()
+  for commit, tree_sha1, parent, changes in _StreamCommitDiffs(rev_args):
+    walked.Append(commit)
+    root_trees[commit] = tree_sha1
+    if tree_sha1 in _tree_cache:
+      metrics.Add('trees.cache_hits')
+      continue
+    new_parent_root = None
+    if parent:
+      parent_tree = root_trees.get(parent)
+      if parent_tree is None:  # Rewritten by a previous run.
+        parent_tree = _GITDB.ORIG.ReadCommit(parent).tree
+      new_parent_root = _tree_cache.Get(parent_tree)
+    if new_parent_root:
+      res = _PatchTree(new_parent_root, tree_sha1, changes, reader)
+      _tree_cache.SetDefault(tree_sha1, res)
+      if _STATE.TREES:
+        _new_tree_translations.append((tree_sha1, res))
+      metrics.Add('trees.diff_patched')
+    else:
+      _RewriteOneTree(tree_sha1, _OPTS.RULES.root)
+      metrics.Add('trees.diff_full')
     eta.job_completed()
-  pool.close()
-  pool.join()
+    if not _STATE.TREES:
+      continue
+    _STATE.TREES.AddMany(_new_tree_translations)
+    del _new_tree_translations[:]
+    if time.time() - last_checkpoint > _CHECKPOINT_INTERVAL_SECONDS:
+      _GITDB.NEW.Flush()  # The translations can refer to any object written.
+      _STATE.TREES.Checkpoint()
+      _GITDB.NEW.ConsolidatePacks()  # A pack per checkpoint.
+      last_checkpoint = time.time()
+  eta.set_total(eta.done)
+  if _STATE.TREES:
+    _GITDB.NEW.Flush()
+    _STATE.TREES.Checkpoint()
+  commits.Extend(reversed(walked))
+
+
+def _PatchTree(new_parent_root, tree_sha1, changes, reader):
+  """Applies the |changes| of a commit (see _StreamCommitDiffs), whose root
+  tree is |tree_sha1|, to the rewritten root tree of its parent. Returns the
+  SHA1 of the rewritten root tree of the commit."""
+  edits = {}  # path -> (mode, SHA1), or None to remove the entry.
+  skip_prefix = None  # Of the tree whose contents are handled already.
+  orig_trees = set([tree_sha1])  # The original trees on the paths patched.
+  for old_mode, new_mode, sha1, status, path in changes:
+    if new_mode == '40000':
+      orig_trees.add(sha1)
+    if skip_prefix and path.startswith(skip_prefix):
+      continue
+    skip_prefix = None
+    dirname, _, fname = path.rpartition('/')
+    if status == 'D':
+      edits.setdefault(path, None)  # An entry can be deleted and re-added.
+      if old_mode == '40000':
+        skip_prefix = path + '/'
+    elif new_mode == '40000':
+      state = _OPTS.RULES.StateAt(dirname)
+      child_state = state.Child(fname) if state else None
+      if child_state and status != 'A' and old_mode == '40000':
+        continue  # A tree to rewrite that changed: patch its changes below.
+      if child_state:
+        sha1 = _RewriteOneTree(sha1, child_state)
+      edits[path] = (new_mode, sha1)
+      skip_prefix = path + '/'
+    else:
+      state = _OPTS.RULES.StateAt(dirname)
+      rules = state.MatchFile(fname) if state else ()
+      if rules and _ShouldStrip(rules, sha1):
+        edits[path] = None
+        metrics.Add('trees.blobs_removed')
+      else:
+        edits[path] = (new_mode, sha1)
 
+  editor = gitutils.TreeEditor(new_parent_root, reader,
+                               _NewTreeWriter(orig_trees))
+  edited = False
+  for path, edit in edits.iteritems():
+    dst = 'third_party/WebKit/' + path
+    if edit:
+      editor.Set(dst, edit[1], mode=edit[0])
+    elif editor.Lookup(dst):  # Stripped files are not in the parent.
+      editor.Remove(dst)
+    else:
+      continue
+    edited = True
+  return editor.Write() if edited else new_parent_root
+
+
+class _NewTreeWriter(object):
+  """Writes trees to _GITDB.NEW, except the ones in |orig_trees|.
+
+  A patched tree can come out identical to the original one (e.g. nothing was
+  stripped from it), which is in the blink repo already. _RewriteOneTree never
+  writes those copies, neither should _PatchTree.
+  """
+  def __init__(self, orig_trees):
+    self._orig_trees = orig_trees
+
+  def WriteTree(self, view):
+    payload = view.payload
+    sha1 = hashlib.sha1('tree %d\x00%s' % (len(payload), payload)).digest()
+    if sha1 in self._orig_trees:
+      return sha1
+    return _GITDB.NEW.WriteTree(view)
 
-def _RewriteOneTreeWrapper(treeish):
-  """Entry point of each subprocess job."""
+
+def _RewriteOneTreeWrapper(job):
+  """Entry point of each subprocess job.
+
+  Returns a tuple (new translations, metrics delta).
+  """
   # Need this try block to deal properly with exceptions in multiprocessing.
   try:
-    # Do not bother checking if we already translated the tree. It is extremely
-    # unlikely (i.e. empty commits) and is not worth the overhead of doing that.
-    _RewriteOneTree(treeish)
+    with metrics.WorkerJob():
+      tree_sha1, path = job
+      _RewriteOneTree(tree_sha1, _OPTS.RULES.StateAt(path))
+    new_translations = _new_tree_translations[:]
+    del _new_tree_translations[:]
+    return new_translations, metrics.TakeDelta()
   except Exception as e:
     sys.stderr.write('\n' + traceback.format_exc())
     raise
 
 
-def _RewriteOneTree(tree_sha1, depth=0, in_layouttests_dir=False):
-  assert len(tree_sha1) == 40
-  cached_translation = _tree_cache.get(tree_sha1)
+def _RewriteOneTree(tree_sha1, state, cache_key=None):
+  """Rewrites |tree_sha1|, in the directory of |state| (a
+  rewrite_rules.DirState). Returns the SHA1 of the rewritten tree."""
+  assert len(tree_sha1) == 20
+  cache_key = cache_key or state.CacheKey(tree_sha1)
+  cached_translation = _tree_cache.Get(cache_key)
   if cached_translation:
+    metrics.Add('trees.cache_hits')
     return cached_translation
+  metrics.Add('trees.cache_misses')
 
-  changed = False
-  entries = []
-
-  tree_entries = _GITDB.ORIG.ReadTree(tree_sha1)
-  for mode, fname, sha1 in tree_entries:
+  tree = _GITDB.ORIG.ReadTree(tree_sha1)
+  upserts = []
+  removals = []
+  subtrees = []  # (fname, sha1, state, cache key) of the subtrees to rewrite.
+  for mode, fname, sha1 in _EntriesToVisit(tree, state):
     if mode[0] == '1':  # It's a file
-      _, ext = os.path.splitext(fname)
-      if (in_layouttests_dir and ext.lower() in _BIN_EXTS and
-          sha1 not in _obj_whitelist):
-        changed = True
-        continue  # omit non whitelisted .png file.
+      rules = state.MatchFile(fname)
+      if rules and _ShouldStrip(rules, sha1):
+        removals.append(fname)
+        metrics.Add('trees.blobs_removed')
     else:
       assert mode == '40000'
-      if in_layouttests_dir or fname == 'LayoutTests':
-        old_sha1 = sha1
-        sha1 = _RewriteOneTree(sha1, depth + 1, True)
-        changed = True if old_sha1 != sha1 else changed
-    entries.append((mode, fname, sha1))
-
-  if changed:
-    res = _GITDB.NEW.WriteTree(entries)
+      child_state = state.Child(fname)
+      if child_state:
+        subtrees.append((fname, sha1, child_state, child_state.CacheKey(sha1)))
+  # Let the reader fetch the subtrees to rewrite while this one is processed.
+  _GITDB.ORIG.Prefetch(sha1 for _, sha1, _, key in subtrees
+                       if key not in _tree_cache)
+  for fname, sha1, child_state, key in subtrees:
+    new_sha1 = _RewriteOneTree(sha1, child_state, key)
+    if new_sha1 != sha1:
+      upserts.append(('40000', fname, new_sha1))
+
+  if upserts or removals:
+    res = _GITDB.NEW.WriteTree(tree.Edit(upserts, removals))
   else:
     res =  tree_sha1
 
   # Create the third_party/WebKit nesting if this is the root tree.
-  if depth == 0:
+  if state is _OPTS.RULES.root:
     third_party_tree = _GITDB.NEW.WriteTree([('40000', 'WebKit', res)])
     res = _GITDB.NEW.WriteTree([('40000', 'third_party', third_party_tree)])
 
   # If there is a collision (another process translated the same tree) check
   # pedantically that the translated tree has the same SHA1.
-  collision = _tree_cache.setdefault(tree_sha1, res)
+  collision = _tree_cache.SetDefault(cache_key, res)
+  if collision is not res:  # Not inserted by us, it's a copy from the table.
+    metrics.Add('trees.cache_collisions')
   assert collision == res
+  if _STATE.TREES:
+    _new_tree_translations.append((cache_key, res))
   return res
 
 
-def _LoadRevlist(branch='master'):
-  """Returns a tuple of two lists: commitish(es), treeish(es)."""
-  commits = []
-  trees = []
-  cmd = ['git', 'rev-list', '--format=%T', '--reverse', branch]
-  print 'Running [%s], might take some minutes' % ' '.join(cmd),
-  sys.stdout.flush()
-  proc = subprocess.Popen(
-      cmd, stdout=subprocess.PIPE, cwd=_DIRS.ROOT_DIR, bufsize=1048576)
-  commit_sha = None
-  tree_sha = None
-  while True:
-    line = proc.stdout.readline()
-    if not line:
-      break
-    line = line.rstrip('\r\n')
-    if line.startswith('commit'):
-      commit_sha = line[7:]
-    else:
-      tree_sha = line
-      assert len(commit_sha) == 40
-      assert len(tree_sha) == 40
-      commits.append(commit_sha)
-      trees.append(tree_sha)
-      commit_sha = tree_sha = None
-  print '\r%120s\r' % '',
-  return commits, trees
+def _ShouldStrip(rules, sha1):
+  """Whether any of the |rules| selecting a file (by its path) strips |sha1|."""
+  return rewrite_rules.ShouldStrip(rules, sha1, _obj_whitelist, _GITDB.ORIG)
+
+
+def _RevParse(revs):
+  """Returns the SHA1s of the given revisions."""
+  return [sha1.decode('hex') for sha1 in subprocess.check_output(
+      ['git', 'rev-parse'] + revs, cwd=_DIRS.ROOT_DIR).split()]
 
 
 def _RewriteCommits(revs):
-  translated_trees = _tree_cache.copy()  # Un-proxied local copy for faster lookups.
-  translated_commits = {}  # orig commitish -> rewritten commitish
+  """Rewrites the commits in |revs|, which can be in any order.
+
+  The commits are read in parallel by a pool of workers (reading has no
+  ordering constraints). Only the translation of tree and parents, the hashing
+  and the writing happen in the main process. A commit is written as soon as
+  all its parents have been rewritten. Until then, it is kept aside.
+  """
+  translated_commits = _commit_cache  # orig commitish -> rewritten commitish
   eta = eta_estimator.ETA(len(revs), unit='commits')
   _InitGitDBForCurrentProcess()
-  for rev in revs:
-    commit = _GITDB.ORIG.ReadCommit(rev)
-    new_tree = translated_trees[commit.tree]
-    assert len(new_tree) == 40
-    commit.tree = new_tree
-    if commit.parent:
-      if commit.parent not in translated_commits:
-        assert False, ('%s depends on %s, which has not been rewritten.' % (
-            rev[0:12],commit.parent[0:12]))
-        commit.parent = None
-      else:
-        commit.parent = translated_commits[commit.parent]
-    try:
-      translated_commit = _GITDB.NEW.WriteCommit(commit.payload)
-    except:
-      print 'FAILED on ', rev
-      print 'Payload: ', commit.payload
-      raise
-    translated_commits[rev] = translated_commit
-    eta.job_completed()
-  old_head = revs[-1]
-  new_head = translated_commits[old_head]
-  print 'New blink head is %s (which corresponds to %s)' % (
-      new_head[0:12], old_head[0:12])
-  return new_head
-
-################################################################################
-# Testing stuff
-################################################################################
-
-def LoadTreeCacheForTests(cache_db_path):
-  import json
-  if os.path.exists(cache_db_path) and os.path.getsize(cache_db_path):
-    print 'Loading translations from %s' % cache_db_path
-    with open(cache_db_path, 'r') as f:
-      for k,v in json.load(f).iteritems():
-        _tree_cache[str(k)] = str(v)
-      print 'Loaded %d translations from cache' % len(_tree_cache)
-
-def StoreTreeCacheForTests(cache_db_path):
-  import json
-  with open(cache_db_path, 'w') as f:
-    json.dump(_tree_cache.copy(), f)
\ No newline at end of file
+  last_checkpoint = time.time()
+  # git rev-list emits children first. Reading parents first minimizes the
+  # commits which have to wait for their parents.
+  pending_revs = sha_arrays.ShaArray(
+      rev for rev in reversed(revs) if rev not in translated_commits)
+  eta.job_completed(len(revs) - len(pending_revs))  # Rewritten by a prev. run.
+  metrics.Add('commits.cache_hits', len(revs) - len(pending_revs))
+  pending_revs_set = sha_arrays.SortedShaSet(pending_revs)
+  waiting = {}  # parent rev -> [(rev, Commit) waiting for it to be rewritten]
+  pool = multiprocessing.Pool(initializer=_InitPoolWorker)
+  for rev, payload in _ReadCommitsInParallel(pool, pending_revs):
+    ready = [(rev, gitutils.Commit(payload))]
+    while ready:
+      rev, commit = ready.pop()
+      missing = [p for p in commit.parents if p not in translated_commits]
+      if missing:
+        assert missing[0] in pending_revs_set, (
+            '%s depends on %s, which has not been rewritten.' % (
+                rev.encode('hex')[0:12], missing[0].encode('hex')[0:12]))
+        waiting.setdefault(missing[0], []).append((rev, commit))
+        metrics.Add('commits.waited_for_parents')
+        continue
+      new_tree = _tree_cache.Get(commit.tree)
+      assert new_tree, 'The tree of %s has not been rewritten' % (
+          rev.encode('hex')[0:12])
+      commit.tree = new_tree
+      commit.parents = [translated_commits.Get(p) for p in commit.parents]
+      try:
+        translated_commit = _GITDB.NEW.WriteCommit(commit.payload)
+      except:
+        print 'FAILED on ', rev.encode('hex')
+        print 'Payload: ', commit.payload
+        raise
+      translated_commits.SetDefault(rev, translated_commit)
+      metrics.Add('commits.rewritten')
+      if _STATE.COMMITS:
+        _STATE.COMMITS.Add(rev, translated_commit)
+        if time.time() - last_checkpoint > _CHECKPOINT_INTERVAL_SECONDS:
+          _CheckpointCommits()
+          last_checkpoint = time.time()
+      eta.job_completed()
+      ready.extend(waiting.pop(rev, []))
+  pool.close()
+  pool.join()
+  assert not waiting, 'Commits depending on missing parents: %s' % ' '.join(
+      r.encode('hex')[0:12] for r in waiting)
+  if _STATE.COMMITS:
+    _CheckpointCommits()
+  # The checkpoints finalized a pack each. Merge them now that the workers,
+  # which read the new objects too, have exited.
+  _GITDB.NEW.ConsolidatePacks()
+
+
+def _ReadCommitsInParallel(pool, revs, window=8192, job_size=256):
+  """Yields (rev, payload) for each rev in |revs|, in order.
+
+  Reads are submitted |window| commits at a time, to bound the memory used by
+  payloads read ahead of the consumer. Each job streams |job_size| commits
+  through the reader (see GitReadonlyObjDB.ReadObjs).
+  """
+  for start in xrange(0, len(revs), window):
+    chunk = revs[start:start + window]
+    jobs = [chunk[i:i + job_size] for i in xrange(0, len(chunk), job_size)]
+    for rev_payloads, metrics_delta in metrics.TimedIter(
+        pool.imap(_ReadCommitsWrapper, jobs), 'ipc.wait_seconds'):
+      metrics.Merge(metrics_delta)
+      for rev_payload in rev_payloads:
+        yield rev_payload
+
+
+def _ReadCommitsWrapper(revs):
+  """Entry point of the commit reading jobs.
+
+  Returns a tuple ([(rev, payload)], metrics delta).
+  """
+  try:
+    res = []
+    with metrics.WorkerJob():
+      for rev, objtype, payload in _GITDB.ORIG.ReadObjs(revs):
+        assert objtype == 'commit', '%s is not a commit (%s)' % (
+            rev.encode('hex'), objtype)
+        res.append((rev, payload))
+    return res, metrics.TakeDelta()
+  except Exception as e:
+    sys.stderr.write('\n' + traceback.format_exc())
+    raise
+
+
+def _CheckpointCommits():
+  _GITDB.NEW.Flush()  # The objects must be durable before their translations.
+  _STATE.COMMITS.Checkpoint()
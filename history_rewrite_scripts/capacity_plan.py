@@ -0,0 +1,240 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Predicts the duration, peak memory and disk use of a merge (see --plan).
+
+The work to do is counted upfront (see blink_rewriter.CountRewrite) and turned
+into resources using the rates measured by a previous run, i.e. the metrics
+report it wrote (see metrics.py). E.g., the cost of rewriting a tree is the
+duration of the trees stage, times the workers, divided by the trees
+rewritten (i.e. it includes the time the workers were not busy). With
+--scheduling=diff the trees stage runs in the main process and its cost is
+per root tree instead, so it is calibrated only by runs with the same mode.
+The rates measured by a small (e.g. incremental) run are less accurate than
+the ones of a full run. Without a previous run, only the counts and the disk
+use (as an upper bound) can be predicted.
+"""
+
+import os
+
+import blink_rewriter
+
+
+# Bytes taken in memory by each tree or commit to rewrite: its slot in the
+# shared translation table and its entry in the ShaArrays of the plan.
+_BYTES_PER_TRANSLATION = 41 + 20
+
+# Bytes taken by each translation in rewrite_state (see translation_store).
+_STATE_BYTES_PER_TRANSLATION = 40
+
+# Objects written by each merge: the .gitignore and DEPS blobs, the root and
+# third_party trees and the merge commit (see _MergeBlinkIntoChrome).
+_OBJECTS_PER_MERGE = 5
+
+
+def Calibrate(report):
+  """Returns the rates measured by a run, given its metrics report."""
+  counters = report['counters']
+  def StageSeconds(name):
+    return sum(s['seconds'] for s in report['stages']
+               if s['name'].split('/')[-1] == name)
+  def Ratio(num, den):
+    return float(num) / den if num is not None and den else None
+
+  # The diff mode patches most root trees in the main process (see
+  # blink_rewriter._RewriteTreesByDiff), only the others are rewritten from
+  # scratch and counted as cache misses (with their subtrees).
+  is_diff = report.get('info', {}).get('scheduling') == 'diff'
+  diff_root_trees = (counters.get('trees.diff_patched', 0) +
+                     counters.get('trees.diff_full', 0))
+  trees_rewritten = (counters.get('trees.cache_misses', 0) +
+                     counters.get('trees.diff_patched', 0))
+  commits_rewritten = counters.get('commits.rewritten', 0)
+  num_cpus = report.get('num_cpus', 1)
+  merges = [s for s in report['stages'] if s['name'].startswith('merge ')]
+  rss = report.get('max_rss_bytes', {})
+  return {
+      'revlist_seconds_per_commit': Ratio(StageSeconds('revlist'),
+                                          counters.get('revlist.commits')),
+      'whitelist_seconds': StageSeconds('whitelist'),
+      # Seconds of a worker, i.e. to be divided by the number of workers.
+      'seconds_per_tree': None if is_diff else Ratio(
+          StageSeconds('trees') * num_cpus, trees_rewritten),
+      # Seconds of the main process, with --scheduling=diff.
+      'seconds_per_root_tree': Ratio(StageSeconds('trees'),
+                                     diff_root_trees) if is_diff else None,
+      'seconds_per_commit': Ratio(StageSeconds('commits'), commits_rewritten),
+      'verify_seconds_per_object': Ratio(StageSeconds('verify'),
+                                         counters.get('verify.objs_verified')),
+      'seconds_per_merge': Ratio(sum(s['seconds'] for s in merges),
+                                 len(merges)),
+      'main_rss_bytes': rss.get('main'),
+      'main_translations': trees_rewritten + commits_rewritten,
+      'worker_rss_bytes': rss.get('children'),
+      # The new objects are compressed on disk (pack or loose).
+      'disk_bytes_per_byte_written': Ratio(
+          counters.get('disk.new_objects_growth_bytes'),
+          counters.get('new.bytes_written')),
+  }
+
+
+def Estimate(counts, rates, num_cpus, num_merges, disk_bytes_now,
+             translations_now, scheduling='global'):
+  """Predicts the resources needed by a run.
+
+  Args:
+    counts: the result of blink_rewriter.CountRewrite.
+    rates: the result of Calibrate, or None if there is no previous run.
+    num_cpus: the size of the pools.
+    num_merges: the number of branches to merge.
+    disk_bytes_now: {'mirrors', 'new_objects', 'rewrite_state'}, the size of
+        what is on disk already (and is kept by the run).
+    translations_now: {'trees', 'commits'}, the number of translations kept
+        from the previous runs (which are loaded in the translation tables).
+    scheduling: the --scheduling of the run. The trees stage can't be
+        predicted by |rates| measured with the diff mode for the others, and
+        vice versa.
+
+  Returns:
+    A dict {'seconds', 'seconds_by_stage', 'peak_rss_bytes', 'disk_bytes',
+    'disk_bytes_by_dir', 'new_objects', 'new_objects_bytes', 'cache_slots'}.
+    'cache_slots' is {'tree', 'commit'}, the capacity the translation tables
+    need (see blink_rewriter.MAX_CACHE_LOAD_FACTOR). The values that can't be
+    predicted without |rates| are None.
+  """
+  rates = rates or {}
+  trees = counts['subtrees'] + counts['root_trees']
+  commits = counts['commits']
+  new_objects = counts['new_trees'] + commits + num_merges * _OBJECTS_PER_MERGE
+  new_objects_bytes = counts['new_tree_bytes'] + counts['commit_bytes']
+
+  def Times(rate, count):
+    return rate * count if rate is not None else None
+  if scheduling == 'diff':  # In the main process.
+    tree_seconds = Times(rates.get('seconds_per_root_tree'),
+                         counts['root_trees'])
+  else:
+    tree_seconds = Times(rates.get('seconds_per_tree'), trees)
+    if tree_seconds is not None:
+      tree_seconds /= num_cpus
+  seconds_by_stage = {
+      'revlist': Times(rates.get('revlist_seconds_per_commit'), commits),
+      'whitelist': rates.get('whitelist_seconds'),
+      'trees': tree_seconds,
+      'commits': Times(rates.get('seconds_per_commit'), commits),
+      # The objects read are the trees and the commits to rewrite.
+      'verify': Times(rates.get('verify_seconds_per_object'), trees + commits),
+      'merge': Times(rates.get('seconds_per_merge'), num_merges),
+  }
+  seconds = None
+  if all(s is not None for s in seconds_by_stage.itervalues()):
+    seconds = sum(seconds_by_stage.itervalues())
+
+  peak_rss_bytes = None
+  if rates.get('main_rss_bytes') and rates.get('worker_rss_bytes'):
+    main_rss = rates['main_rss_bytes'] + _BYTES_PER_TRANSLATION * max(
+        0, trees + commits - rates['main_translations'])
+    peak_rss_bytes = main_rss + num_cpus * rates['worker_rss_bytes']
+
+  # Without a calibration, assume that the objects are stored uncompressed.
+  ratio = rates.get('disk_bytes_per_byte_written') or 1.0
+  disk_bytes_by_dir = {
+      'mirrors': disk_bytes_now['mirrors'],
+      'new_objects': disk_bytes_now['new_objects'] + int(
+          new_objects_bytes * ratio),
+      'rewrite_state': disk_bytes_now['rewrite_state'] + (
+          _STATE_BYTES_PER_TRANSLATION * (trees + commits)),
+  }
+  return {
+      'seconds': seconds,
+      'seconds_by_stage': seconds_by_stage,
+      'peak_rss_bytes': peak_rss_bytes,
+      'disk_bytes': sum(disk_bytes_by_dir.itervalues()),
+      'disk_bytes_by_dir': disk_bytes_by_dir,
+      'new_objects': new_objects,
+      'new_objects_bytes': new_objects_bytes,
+      'cache_slots': {
+          'tree': _CacheSlots(trees + translations_now['trees']),
+          'commit': _CacheSlots(commits + translations_now['commits']),
+      },
+  }
+
+
+def _CacheSlots(num_translations):
+  """The smallest power of 2 that keeps the load factor of a translation
+  table with |num_translations| within blink_rewriter.MAX_CACHE_LOAD_FACTOR."""
+  slots = 1
+  while slots * blink_rewriter.MAX_CACHE_LOAD_FACTOR < num_translations:
+    slots *= 2
+  return slots
+
+
+def PrintPlan(counts, estimate, num_cpus, calibration_path, cache_slots):
+  """Prints the plan. |cache_slots| is {'tree', 'commit'}, the capacity of
+  the translation tables the run would have."""
+  print '\n\n'
+  print '----------------------------------------------'
+  print '             CAPACITY PLAN'
+  print '----------------------------------------------'
+  print '%-40s %10s %10s %10s' % ('Blink branch', 'commits', 'root trees',
+                                  'subtrees')
+  for branch, c in sorted(counts['branches'].iteritems()):
+    print '%-40s %10d %10d %10d' % (branch, c['commits'], c['root_trees'],
+                                    c['subtrees'])
+  print '%-40s %10d %10d %10d' % ('To rewrite (all branches)',
+                                  counts['commits'], counts['root_trees'],
+                                  counts['subtrees'])
+  print ''
+  print 'Blobs dropped by the rules: %d (%d tree entries)' % (
+      counts['blobs_dropped'], counts['entries_dropped'])
+  print 'New objects:                %d (%s)' % (
+      estimate['new_objects'], _Bytes(estimate['new_objects_bytes']))
+  if estimate['seconds'] is not None:
+    print 'Expected duration:          %s (%s)' % (
+        _Seconds(estimate['seconds']), ', '.join(
+            '%s %s' % (stage, _Seconds(s)) for stage, s in sorted(
+                estimate['seconds_by_stage'].iteritems())))
+  else:
+    print 'Expected duration:          unknown (no calibration of: %s)' % (
+        ', '.join(sorted(stage for stage, s in
+                         estimate['seconds_by_stage'].iteritems()
+                         if s is None)))
+  if estimate['peak_rss_bytes'] is not None:
+    print 'Expected peak memory:       %s (with %d workers)' % (
+        _Bytes(estimate['peak_rss_bytes']), num_cpus)
+  else:
+    print 'Expected peak memory:       unknown (no calibration)'
+  print 'Expected disk use:          %s (%s)' % (
+      _Bytes(estimate['disk_bytes']), ', '.join(
+          '%s %s' % (d, _Bytes(b)) for d, b in sorted(
+              estimate['disk_bytes_by_dir'].iteritems())))
+  for name, slots in sorted(estimate['cache_slots'].iteritems()):
+    if slots > cache_slots[name]:
+      print 'The %s translation table is too small: pass --%s-cache-slots=%d' \
+          % (name, name, slots)
+  if calibration_path:
+    print 'Calibrated with the run of: %s' % calibration_path
+  else:
+    print 'No previous run to calibrate with: the disk use of new_objects is'
+    print 'an upper bound (uncompressed).'
+
+
+def DirSize(path):
+  """The total size of the files in |path| (recursively)."""
+  total = 0
+  for root, _, files in os.walk(path):
+    for fname in files:
+      try:
+        total += os.lstat(os.path.join(root, fname)).st_size
+      except OSError:
+        pass  # e.g., a .tmp file renamed in the meanwhile.
+  return total
+
+
+def _Bytes(num_bytes):
+  return '%.1f MB' % (num_bytes / 1048576.0)
+
+
+def _Seconds(seconds):
+  return '%d:%04.1f' % (seconds // 60, seconds % 60)
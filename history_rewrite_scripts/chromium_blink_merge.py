@@ -3,18 +3,23 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import json
+import multiprocessing
 import optparse
 import os
 import re
+import struct
 import subprocess
 import sys
 import time
 import traceback
 
+import blink_rewriter
+import capacity_plan
 import config
 import deps_cleanup
 import gitutils
-import blink_rewriter
+import metrics
 
 
 class _DIRS:
@@ -23,18 +28,83 @@ class _DIRS:
   BLINK = None
   BLINKOBJS = None
   MERGEREPO = None
+  STATE = None  # Where the rewriter checkpoints its translations.
 
 class _GITDB:
-  ORIG = None  # An instance of GitReadonlyObjDB
-  NEW = None  # An instance of GitLooseObjDB
+  ORIG = None  # An instance of GitNativeObjDB or GitReadonlyObjDB
+  NEW = None  # An instance of GitPackObjDB or GitLooseObjDB
 
 
 def main():
   parser = optparse.OptionParser()
   parser.add_option('--no-clobber', '-n', action='store_true', help='Keep the '
-      ' original trees and the translation cache from the previous run (only '
-      ' to speed up testing)')
+      ' original repos, the new objects and the translations checkpointed by '
+      ' the previous run, resuming from where it stopped')
+  parser.add_option('--incremental', '-i', action='store_true', help='Keep the'
+      ' new objects and the translations of the previous run and rewrite only'
+      ' the blink commits landed since then. The blobs it stripped stay'
+      ' stripped in the history rewritten then, even if back at a tip (unlike'
+      ' in a run from scratch, see the README)')
+  parser.add_option('--refresh', '-r', action='store_true', help='Keep the'
+      ' mirrors and update them with git fetch (instead of cloning them from'
+      ' scratch), keep the new objects and the translations of the previous'
+      ' run (as long as they are consistent with the fetched refs) and rebuild'
+      ' only the merge repo. As for --incremental, the result can differ from'
+      ' the one of a run from scratch')
+  parser.add_option('--reader', default='native',
+      choices=sorted(gitutils.READONLY_OBJDB_CLASSES.keys()),
+      help='How to read the original objects: "native" parses the pack files '
+      ' in-process, "git" pipes them through git cat-file (default: %default)')
+  parser.add_option('--writer', default='pack',
+      choices=sorted(gitutils.WRITABLE_OBJDB_CLASSES.keys()),
+      help='How to write the new objects: "pack" appends them to pack files, '
+      ' "loose" writes one file per object (default: %default)')
+  parser.add_option('--scheduling', default='global',
+      choices=['global', 'per-root', 'diff'],
+      help='How to split the tree rewrite across processes: "global" rewrites'
+      ' each distinct subtree affected by the rewrite rules once, bottom-up;'
+      ' "per-root" has one job per commit; "diff" patches the rewritten tree'
+      ' of the parent commit with the changed paths, in a single process'
+      ' (default: %default)')
+  parser.add_option('--verify', default='deferred',
+      choices=gitutils.ObjectVerifier.MODES,
+      help='How to verify the integrity of the blink objects read: "inline" '
+      ' hashes each of them, "sampled" only some, "deferred" hashes them in '
+      ' background processes and fails at the end (default: %default)')
+  parser.add_option('--tree-cache-slots', type='int',
+      default=blink_rewriter.DEFAULT_TREE_CACHE_SLOTS,
+      help='Capacity (a power of 2) of the table of the tree translations, of'
+      ' this run and the previous ones. --plan tells how big it needs to be'
+      ' (default: %default)')
+  parser.add_option('--commit-cache-slots', type='int',
+      default=blink_rewriter.DEFAULT_COMMIT_CACHE_SLOTS,
+      help='Same as --tree-cache-slots, for the commit translations'
+      ' (default: %default)')
+  parser.add_option('--blink-url', default=config.BLINK_REPO_URL,
+      help='Where to clone blink from (default: %default)')
+  parser.add_option('--chromium-url', default=config.CHROMIUM_REPO_URL,
+      help='Where to clone chromium from (default: %default)')
+  parser.add_option('--plan', action='store_true', help='Only print the'
+      ' expected duration, peak memory and disk use of the merge, based on the'
+      ' existing mirrors and on the metrics of the previous run (see'
+      ' --metrics-json), without writing anything')
+  parser.add_option('--export-pack',
+      help='If set, write to this file a thin pack of the objects that the'
+      ' merged branches need and chromium.git does not have, i.e. what a push'
+      ' would upload')
+  parser.add_option('--metrics-json', default='metrics.json',
+      help='Where to write the report of the counters and timers of each'
+      ' stage of the merge (default: %default)')
+  parser.add_option('--metrics-stream',
+      help='If set, a snapshot of the counters is appended to this file'
+      ' periodically, as a JSON object per line')
+  parser.add_option('--metrics-interval', type='int', default=10,
+      help='Seconds between the snapshots of --metrics-stream'
+      ' (default: %default)')
   options, _ = parser.parse_args()
+  for slots in (options.tree_cache_slots, options.commit_cache_slots):
+    if slots <= 0 or slots & (slots - 1):
+      parser.error('The cache slots must be a power of 2, not %d' % slots)
 
   base_dir = os.path.abspath(os.getcwd())
   _DIRS.BLINK = os.path.join(base_dir, 'blink.git')
@@ -42,6 +112,10 @@ def main():
   _DIRS.CHROMIUM = os.path.join(base_dir, 'chromium.git')
   _DIRS.MERGEREPO = os.path.join(base_dir, 'chrome-blink-merge.git')
   _DIRS.NEWOBJS = os.path.join(base_dir, 'new_objects')
+  _DIRS.STATE = os.path.join(base_dir, 'rewrite_state')
+  if options.metrics_stream and not options.plan:
+    metrics.StartStream(os.path.abspath(options.metrics_stream),
+                        options.metrics_interval)
 
   print '--------------------------------------------------------'
   print '             Chromium + Blink automerger'
@@ -54,29 +128,37 @@ def main():
   print 'Merged repo dir:       ', _DIRS.MERGEREPO
   print ''
 
-  if not options.no_clobber:
-    _Rmtree(_DIRS.BLINK)
-  if not os.path.exists(_DIRS.BLINK):
-    cmd = ['git', 'clone', '--mirror', config.BLINK_REPO_URL, _DIRS.BLINK]
-    print 'Cloning blink: ', ' '.join(cmd)
-    subprocess.check_call(cmd)
+  if options.plan:
+    return _Plan(options)
 
-  if not options.no_clobber:
-    _Rmtree(_DIRS.CHROMIUM)
-  if not os.path.exists(_DIRS.CHROMIUM):
-    cmd = ['git', 'clone', '--mirror', config.CHROMIUM_REPO_URL, _DIRS.CHROMIUM]
-    print 'Cloning chromium: ', ' '.join(cmd)
-    subprocess.check_call(cmd)
+  _SyncMirror('blink', _DIRS.BLINK, options.blink_url,
+              clobber=not options.no_clobber and not options.refresh,
+              fetch=options.refresh)
+  _SyncMirror('chromium', _DIRS.CHROMIUM, options.chromium_url,
+              clobber=not options.no_clobber and not options.refresh,
+              fetch=options.refresh)
 
   _Rmtree(_DIRS.MERGEREPO)
 
-  if not options.no_clobber:
+  if not (options.no_clobber or options.incremental or options.refresh):
     _Rmtree(_DIRS.NEWOBJS)
+    _Rmtree(_DIRS.STATE)
   if not os.path.exists(_DIRS.NEWOBJS):
+    # The translations are meaningless without the objects they refer to.
+    _Rmtree(_DIRS.STATE)
     os.makedirs(_DIRS.NEWOBJS)
-
-  _GITDB.ORIG = gitutils.GitReadonlyObjDB(_DIRS.CHROMIUM)
-  _GITDB.NEW = gitutils.GitLooseObjDB(_DIRS.NEWOBJS)
+  gitutils.RemoveStalePacks(_DIRS.NEWOBJS)
+  new_objects_bytes_start = capacity_plan.DirSize(_DIRS.NEWOBJS)
+
+  # The few chromium objects read here are verified inline, unless disabled.
+  _GITDB.ORIG = gitutils.MeteredObjDB(
+      gitutils.READONLY_OBJDB_CLASSES[options.reader](
+          _DIRS.CHROMIUM, verifier=gitutils.ObjectVerifier(
+              'off' if options.verify == 'off' else 'inline')),
+      metrics.Counters(), 'chromium')
+  _GITDB.NEW = gitutils.MeteredObjDB(
+      gitutils.WRITABLE_OBJDB_CLASSES[options.writer](_DIRS.NEWOBJS),
+      metrics.Counters(), 'new')
 
   print 'Initializing the merge repo'
   subprocess.check_call(['git', 'clone', '--bare', '--shared', _DIRS.CHROMIUM,
@@ -86,24 +168,46 @@ def main():
     alt_fd.write('\n%s' % os.path.join(_DIRS.BLINK, 'objects'))
     alt_fd.write('\n%s' % _DIRS.NEWOBJS)
 
-  if options.no_clobber:
-    blink_rewriter.LoadTreeCacheForTests(os.path.join(_DIRS.NEWOBJS, 'cache'))
+  # The blink branches share most of their history: rewrite them in one pass.
+  with metrics.Stage('rewrite'):
+    blink_rewritten_heads = blink_rewriter.RewriteBlinkHistories(
+        [b[1] for b in config.BRANCHES_TO_MERGE], _DIRS.BLINK, _DIRS.NEWOBJS,
+        reader=options.reader, writer=options.writer, state_dir=_DIRS.STATE,
+        scheduling=options.scheduling, verify=options.verify,
+        tree_cache_slots=options.tree_cache_slots,
+        commit_cache_slots=options.commit_cache_slots)
 
   merge_heads = []  # ('chromium ref', 'blink ref', 'merge sha1 in chromium')
+  chromium_heads = []  # The first parents of the merges.
   for chromium_ref, blink_ref, add_commit_position in config.BRANCHES_TO_MERGE:
-    chromium_sha1 = subprocess.check_output(['git', 'rev-parse', chromium_ref],
-                                            cwd=_DIRS.CHROMIUM).strip()
-    blink_rewritten_sha1 = blink_rewriter.RewriteBlinkHistory(
-        blink_ref, _DIRS.BLINK, _DIRS.NEWOBJS)
-    merge_sha1 = _MergeBlinkIntoChrome(chromium_sha1, blink_rewritten_sha1,
-                                       add_commit_position)
-    merge_heads.append((chromium_ref, blink_ref, merge_sha1))
+    with metrics.Stage('merge ' + chromium_ref):
+      chromium_sha1 = subprocess.check_output(
+          ['git', 'rev-parse', chromium_ref], cwd=_DIRS.CHROMIUM).strip()
+      merge_sha1 = _MergeBlinkIntoChrome(
+          chromium_sha1, blink_rewritten_heads[blink_ref], add_commit_position)
+      merge_heads.append((chromium_ref, blink_ref, merge_sha1))
+      chromium_heads.append(chromium_sha1)
+
+  # A single flush (i.e. a single pack) for all the merge commits, which must be
+  # visible to update-ref.
+  _GITDB.NEW.Flush()
+  for chromium_ref, _, merge_sha1 in merge_heads:
     print 'Merged @ %s in %s' % (merge_sha1[0:12], _DIRS.MERGEREPO)
     cmd = ['git', 'update-ref', chromium_ref, merge_sha1]
     subprocess.check_call(cmd, cwd=_DIRS.MERGEREPO)
 
-  if options.no_clobber:
-    blink_rewriter.StoreTreeCacheForTests(os.path.join(_DIRS.NEWOBJS, 'cache'))
+  _GITDB.NEW.Close()
+  metrics.Add('disk.new_objects_growth_bytes',
+              capacity_plan.DirSize(_DIRS.NEWOBJS) - new_objects_bytes_start)
+
+  if options.export_pack:
+    print 'Exporting the new objects to', os.path.abspath(options.export_pack)
+    with metrics.Stage('export'):
+      _ExportThinPack([m[2] for m in merge_heads], chromium_heads,
+                      os.path.abspath(options.export_pack))
+
+  metrics.StopStream()
+  metrics.WriteReport(os.path.abspath(options.metrics_json))
 
   print '\n\n'
   print '----------------------------------------------'
@@ -113,14 +217,67 @@ def main():
     print '%-26s + %-32s -> %s' % (chromium_ref, blink_ref, merge_sha1)
   print ' '
   print 'You should now:'
+  print '  %s  # Or, much slower, git fsck in %s' % (
+      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   'verify_merge.py'), _DIRS.MERGEREPO)
   print '  cd %s' %  _DIRS.MERGEREPO
-  print '  git fsck'
-  print '  git push %s %s' % (config.CHROMIUM_REPO_URL,
+  print '  git push %s %s' % (options.chromium_url,
                               ' '.join(b[0] for b in config.BRANCHES_TO_MERGE))
+  if options.export_pack:
+    print '(%s has all the objects the push will upload)' % (
+        os.path.abspath(options.export_pack))
+  print 'If the push is too big for the server, warm it up first with:'
+  print '  %s %s HEAD^2' % (
+      os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                   'gradual_push.py'), options.chromium_url)
   print ''
   print 'Note: the repo has "alternates" references to the original blink and'
   print 'chromium repos. If you need a standalone pack run:'
   print '  git repack -a -d --window=50 --depth=100'
+  print ''
+  print 'Metrics of the run: %s' % os.path.abspath(options.metrics_json)
+
+
+def _Plan(options):
+  """Prints the capacity plan of the merge (see capacity_plan)."""
+  for git_dir in (_DIRS.BLINK, _DIRS.CHROMIUM):
+    if not os.path.isdir(git_dir):
+      print 'Cannot plan without the mirrors: %s is missing' % git_dir
+      return 1
+  keep_state = options.no_clobber or options.incremental or options.refresh
+  counts = blink_rewriter.CountRewrite(
+      [b[1] for b in config.BRANCHES_TO_MERGE], _DIRS.BLINK,
+      reader=options.reader, state_dir=_DIRS.STATE if keep_state else None)
+
+  calibration_path = os.path.abspath(options.metrics_json)
+  rates = None
+  if os.path.exists(calibration_path):
+    with open(calibration_path) as f:
+      rates = capacity_plan.Calibrate(json.load(f))
+  else:
+    calibration_path = None
+  disk_bytes_now = {
+      'mirrors': (capacity_plan.DirSize(_DIRS.BLINK) +
+                  capacity_plan.DirSize(_DIRS.CHROMIUM)),
+      'new_objects': keep_state and capacity_plan.DirSize(_DIRS.NEWOBJS) or 0,
+      'rewrite_state': keep_state and capacity_plan.DirSize(_DIRS.STATE) or 0,
+  }
+  # The translation tables hold the translations of the previous runs too.
+  translations_now = {'trees': 0, 'commits': 0}
+  if keep_state:
+    for kind in translations_now:
+      path = os.path.join(_DIRS.STATE, kind + '.xlat')
+      if os.path.exists(path):
+        translations_now[kind] = os.path.getsize(path) // 40
+  num_cpus = multiprocessing.cpu_count()
+  estimate = capacity_plan.Estimate(counts, rates, num_cpus,
+                                    len(config.BRANCHES_TO_MERGE),
+                                    disk_bytes_now, translations_now,
+                                    options.scheduling)
+  capacity_plan.PrintPlan(counts, estimate, num_cpus, calibration_path,
+                          {'tree': options.tree_cache_slots,
+                           'commit': options.commit_cache_slots})
+  return 0
 
 
 def _MergeBlinkIntoChrome(chromium_sha1, blink_sha1, add_commit_position):
@@ -128,19 +285,21 @@ def _MergeBlinkIntoChrome(chromium_sha1, blink_sha1, add_commit_position):
   # third_party/WebKit/ already.
   # We want to merge the subtree in BLINK_REWRITTEN/third_party/WebKit into
   # CHROMIUM/third_party/.
-
-  # Retrieve third_party_tree, which is the tree inside the Chromium containing
-  # third_party/WebKit/.
-  cr_commit = _GITDB.ORIG.ReadCommit(chromium_sha1)
-  cr_root_tree = _GITDB.ORIG.ReadTree(cr_commit.tree)
-  cr_3party_tree_sha1 = gitutils.TreeLookup(cr_root_tree, 'third_party')
-  assert cr_3party_tree_sha1, 'No /third_party in %s' % chromium_sha1
-  cr_3party_tree = _GITDB.ORIG.ReadTree(cr_3party_tree_sha1)
-  assert gitutils.TreeLookup(cr_3party_tree, 'WebKit') is None, (
+  # The args and the returned SHA1 are hex, gitutils deals with binary SHA1s.
+  chromium_bin_sha1 = chromium_sha1.decode('hex')
+  blink_bin_sha1 = blink_sha1.decode('hex')
+
+  # All the edits to the chromium tree are applied in one batch, which rewrites
+  # only the trees on their paths (i.e. the root and third_party).
+  cr_commit = _GITDB.ORIG.ReadCommit(chromium_bin_sha1)
+  cr_tree_editor = gitutils.TreeEditor(cr_commit.tree, _GITDB.ORIG, _GITDB.NEW)
+  assert cr_tree_editor.Lookup('third_party'), (
+      'No /third_party in %s' % chromium_sha1)
+  assert cr_tree_editor.Lookup('third_party/WebKit') is None, (
       'WebKit seems already merged in %s' % chromium_sha1)
 
   # remove WebKit references from .gitignore
-  cr_gitignore_sha1 = gitutils.TreeLookup(cr_root_tree, '.gitignore')
+  cr_gitignore_sha1 = cr_tree_editor.Lookup('.gitignore')
   assert cr_gitignore_sha1, 'No .gitignore in %s' % chromium_sha1
   cr_gitignore_lines = _GITDB.ORIG.ReadBlob(cr_gitignore_sha1).splitlines()
   GITIGNORE_LINE = '/third_party/WebKit'
@@ -148,21 +307,18 @@ def _MergeBlinkIntoChrome(chromium_sha1, blink_sha1, add_commit_position):
       'No %s in .gitignore in %s' % (GITIGNORE_LINE, chromium_sha1))
   cr_gitignore_lines = [l for l in cr_gitignore_lines if l != GITIGNORE_LINE]
   cr_gitignore = '\n'.join(cr_gitignore_lines)
-  cr_gitignore_sha1 = _GITDB.NEW.WriteBlob(cr_gitignore)
+  cr_tree_editor.Replace('.gitignore', _GITDB.NEW.WriteBlob(cr_gitignore))
 
   # remove WebKit references from DEPS
-  deps_sha1 = gitutils.TreeLookup(cr_root_tree, 'DEPS')
+  deps_sha1 = cr_tree_editor.Lookup('DEPS')
   assert deps_sha1, 'No DEPS in %s' % chromium_sha1
   deps = _GITDB.ORIG.ReadBlob(deps_sha1)
   deps = deps_cleanup.CleanupDeps(deps)
-  deps_sha1 = _GITDB.NEW.WriteBlob(deps)
-
-  # cr_3party_tree at this point contains stuff like cld, libjpeg,
-  # but NOT WebKit (yet).
+  cr_tree_editor.Replace('DEPS', _GITDB.NEW.WriteBlob(deps))
 
   # Now retrieve the WebKit tree inside third_party from the rewritten blink
   # history.
-  bl_commit = _GITDB.NEW.ReadCommit(blink_sha1)
+  bl_commit = _GITDB.NEW.ReadCommit(blink_bin_sha1)
   bl_last_commit_time = int(bl_commit.headers['committer'].rsplit(' ',2)[-2])
   bl_root_tree = _GITDB.NEW.ReadTree(bl_commit.tree)
   assert len(bl_root_tree) == 1 and bl_root_tree[0][1] == 'third_party'
@@ -171,16 +327,8 @@ def _MergeBlinkIntoChrome(chromium_sha1, blink_sha1, add_commit_position):
   assert len(bl_3party_tree) == 1 and bl_3party_tree[0][1] == 'WebKit'
   bl_webkit_tree_sha1 = bl_3party_tree[0][2]
 
-  cr_merge_3party_tree = (cr_3party_tree +
-                          [('40000', 'WebKit', bl_webkit_tree_sha1)])
-  cr_merge_3party_tree_sha1 = _GITDB.NEW.WriteTree(cr_merge_3party_tree)
-  cr_merge_root_tree = gitutils.ReplaceInTree(
-      cr_root_tree, 'third_party', cr_merge_3party_tree_sha1)
-  cr_merge_root_tree = gitutils.ReplaceInTree(
-      cr_merge_root_tree, '.gitignore', cr_gitignore_sha1)
-  cr_merge_root_tree = gitutils.ReplaceInTree(
-      cr_merge_root_tree, 'DEPS', deps_sha1)
-  cr_merge_root_tree_sha1 = _GITDB.NEW.WriteTree(cr_merge_root_tree)
+  cr_tree_editor.Set('third_party/WebKit', bl_webkit_tree_sha1, mode='40000')
+  cr_merge_root_tree_sha1 = cr_tree_editor.Write()
 
   bl_ref = re.findall(r'^git-svn-id: svn://svn.chromium.org(.+)@(\d+) ',
                       bl_commit.message, re.MULTILINE)
@@ -213,11 +361,75 @@ def _MergeBlinkIntoChrome(chromium_sha1, blink_sha1, add_commit_position):
       config.AUTOMERGER_NAME, config.AUTOMERGER_EMAIL, cr_merge_commit_time)
   cr_merge_commit.headers['committer'] = cr_merge_commit.headers['author']
   cr_merge_commit.tree = cr_merge_root_tree_sha1
-  cr_merge_commit.parent = chromium_sha1
-  cr_merge_commit.merged_parent = blink_sha1
+  cr_merge_commit.parents = [chromium_bin_sha1]
+  cr_merge_commit.merged_parent = blink_bin_sha1
+  cr_merge_commit.extra_headers = []  # Don't inherit e.g. the gpgsig.
   cr_merge_commit.message = cr_merge_msg
   cr_merge_commit_sha1 = _GITDB.NEW.WriteCommit(cr_merge_commit.payload)
-  return cr_merge_commit_sha1
+  return cr_merge_commit_sha1.encode('hex')
+
+
+def _SyncMirror(name, git_dir, url, clobber, fetch):
+  """Makes |git_dir| a mirror of |url|.
+
+  An existing mirror is deleted if |clobber|, updated with git fetch if |fetch|
+  and left as it is otherwise. A mirror of another url is never updated.
+  The objects fetched don't invalidate the translations of the rewriter: they
+  are keyed by (immutable) SHA1s and the rewriter checks that the heads it
+  rewrote last time are still ancestors of the fetched ones (see
+  blink_rewriter._GetLastRewrittenHead).
+  """
+  if os.path.exists(git_dir) and fetch:
+    origin_url = subprocess.Popen(
+        ['git', 'config', 'remote.origin.url'], stdout=subprocess.PIPE,
+        cwd=git_dir).communicate()[0].strip()
+    if origin_url != url:
+      print 'The %s mirror is a mirror of %s, cloning it again' % (name,
+                                                                   origin_url)
+      clobber = True
+  if clobber:
+    _Rmtree(git_dir)
+  if not os.path.exists(git_dir):
+    cmd = ['git', 'clone', '--mirror', url, git_dir]
+    print 'Cloning %s: ' % name, ' '.join(cmd)
+    with metrics.Stage('clone_' + name):
+      subprocess.check_call(cmd)
+  elif fetch:
+    # Mirrors fetch +refs/*:refs/*, i.e. they track all the refs of |url|.
+    cmd = ['git', 'fetch', '--prune', 'origin']
+    print 'Updating %s: ' % name, ' '.join(cmd)
+    with metrics.Stage('fetch_' + name):
+      subprocess.check_call(cmd, cwd=git_dir)
+
+
+def _ExportThinPack(merge_sha1s, chromium_sha1s, pack_path):
+  """Writes the objects reachable from |merge_sha1s| and not from
+  |chromium_sha1s| (hex SHA1s) to |pack_path|, as a thin pack.
+
+  Those are the rewritten blink commits and trees, the blink blobs they use and
+  the trees and commits of the merges: exactly what a push to a server which
+  has |chromium_sha1s| needs. Being thin, the pack can contain deltas against
+  the objects reachable from |chromium_sha1s| (hence it can't be indexed as it
+  is, see git index-pack --fix-thin).
+  """
+  revs = merge_sha1s + ['^' + sha1 for sha1 in gitutils.Unique(chromium_sha1s)]
+  cmd = ['git', 'pack-objects', '--revs', '--thin', '--delta-base-offset',
+         '--stdout', '-q']
+  tmp_path = pack_path + '.tmp'
+  with open(tmp_path, 'wb') as pack_file:
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=pack_file,
+                            cwd=_DIRS.MERGEREPO)
+    proc.communicate(''.join(rev + '\n' for rev in revs))
+  assert proc.returncode == 0, 'Failed: %s' % ' '.join(cmd)
+  os.rename(tmp_path, pack_path)
+
+  with open(pack_path, 'rb') as pack_file:
+    signature, _, num_objects = struct.unpack('>4sII', pack_file.read(12))
+  assert signature == 'PACK', '%s is not a pack' % pack_path
+  pack_size = os.path.getsize(pack_path)
+  metrics.Add('export.objects', num_objects)
+  metrics.Add('export.pack_bytes', pack_size)
+  print 'Exported %d objects, %.1f MB' % (num_objects, pack_size / 1048576.0)
 
 
 def _Rmtree(dirpath):
@@ -226,4 +438,4 @@ def _Rmtree(dirpath):
     assert not os.path.exists(dirpath)
 
 if __name__ == '__main__':
-  main()
+  sys.exit(main())
@@ -21,6 +21,14 @@ BRANCHES_TO_MERGE = [
     ('refs/pending/branch-heads/2490', 'refs/branch-heads/chromium/2490', False),
 ]
 
+# What the blink history rewrite strips (see rewrite_rules.py for the syntax).
+# Changing the rules invalidates the results of previous (incremental) runs.
+REWRITE_RULES = [
+    # The LayoutTests pngs, except the ones still there at the tip of a branch.
+    {'paths': ['LayoutTests/**'], 'extensions': ['.png'],
+     'keep_if_at_tip': True},
+]
+
 MERGE_MSG = """Merge Chromium + Blink git repositories
 
 Blink SHA1: %(blink_sha)s
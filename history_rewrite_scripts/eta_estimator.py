@@ -9,7 +9,12 @@ import time
 
 
 class ETA(object):
-  def __init__(self, num_jobs_expected, unit=''):
+  """Progress of a set of jobs.
+
+  |num_jobs_expected| can be None if the jobs are still being discovered while
+  the first ones complete. In this case no ETA is printed until set_total().
+  """
+  def __init__(self, num_jobs_expected, unit='', verb='Rewrote'):
     self.tstart = time.time()
     self.tprint = 0
     self.checkpoint_time = self.tstart
@@ -18,6 +23,7 @@ class ETA(object):
     self.checkpoint_done = 0
     self.done_since_checkpoint = 0
     self.unit = unit
+    self.verb = verb  # Of the final message, e.g. 'Rewrote 10 trees in ...'.
 
   @staticmethod
   def TimeToStr(seconds):
@@ -27,18 +33,24 @@ class ETA(object):
   def job_completed(self, num_jobs_completed=1):
     self.done += num_jobs_completed
     now = time.time()
+    finished = self.total is not None and self.done >= self.total
     if sys.stdout.isatty():
-      if self.done >= self.total or (now - self.tprint) > 0.5:
+      done_since_checkpoint = self.done - self.checkpoint_done
+      if done_since_checkpoint and (finished or (now - self.tprint) > 0.5):
         self.tprint = now
-        done_since_checkpoint = self.done - self.checkpoint_done
         compl_rate = (now - self.checkpoint_time) / done_since_checkpoint
-        eta = ETA.TimeToStr((self.total - self.done) * compl_rate)
-        print '\r%d / %d %s (%.1f %s/sec), ETA: %s      ' % (
-            self.done,
-            self.total,
-            self.unit, 1 / compl_rate if compl_rate else 0,
-            self.unit,
-            eta),
+        if self.total is None:
+          print '\r%d / ? %s (%.1f %s/sec)      ' % (
+              self.done, self.unit, 1 / compl_rate if compl_rate else 0,
+              self.unit),
+        else:
+          eta = ETA.TimeToStr((self.total - self.done) * compl_rate)
+          print '\r%d / %d %s (%.1f %s/sec), ETA: %s      ' % (
+              self.done,
+              self.total,
+              self.unit, 1 / compl_rate if compl_rate else 0,
+              self.unit,
+              eta),
         sys.stdout.flush()
       # Keep a window of the last 5 s. for ETA calculation.
       if now - self.checkpoint_time > 5:
@@ -46,9 +58,14 @@ class ETA(object):
         self.checkpoint_time = now
 
     # Final completion message
-    if self.done >= self.total:
+    if finished:
       elapsed = time.time() - self.tstart
       if sys.stdout.isatty():
         print '\r%120s\r' % '',  # Clear the current line.
-      print 'Rewrote %d %s in %s (%.1f %s/sec)' % (self.done, self.unit,
+      print '%s %d %s in %s (%.1f %s/sec)' % (self.verb, self.done, self.unit,
           ETA.TimeToStr(elapsed), self.done / elapsed, self.unit)
+
+  def set_total(self, num_jobs_expected):
+    """Sets the number of jobs, once known (see __init__)."""
+    self.total = num_jobs_expected
+    self.job_completed(0)
@@ -0,0 +1,445 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Low level readers/writers for git pack (.pack) and index (.idx) files.
+
+See Documentation/technical/pack-format.txt in git.git for the format specs.
+"""
+
+import collections
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {OBJ_COMMIT: 'commit', OBJ_TREE: 'tree', OBJ_BLOB: 'blob',
+              OBJ_TAG: 'tag'}
+TYPE_CODES = dict((v, k) for k, v in TYPE_NAMES.iteritems())
+
+_IDX_V2_MAGIC = '\377tOc'
+
+
+class PackIndex(object):
+  """A memory-mapped .idx file (supports both v1 and v2 formats)."""
+  def __init__(self, idx_path):
+    self.path = idx_path
+    with open(idx_path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self._map[0:4] == _IDX_V2_MAGIC:
+      version, = struct.unpack_from('>I', self._map, 4)
+      assert version == 2, 'Unsupported idx version %d in %s' % (
+          version, idx_path)
+      self._fanout_off = 8
+    else:
+      version = 1
+      self._fanout_off = 0
+    self.version = version
+    self._fanout = struct.unpack_from('>256I', self._map, self._fanout_off)
+    self.num_objects = self._fanout[255]
+    if version == 2:
+      self._sha_off = self._fanout_off + 1024
+      self._sha_stride = 20
+      self._ofs_off = self._sha_off + 24 * self.num_objects  # Skip the CRCs.
+      self._ofs64_off = self._ofs_off + 4 * self.num_objects
+    else:
+      self._sha_off = self._fanout_off + 1024 + 4  # Entries are (ofs, sha1).
+      self._sha_stride = 24
+
+  def GetSha1(self, pos):
+    """Returns the (binary) SHA1 of the |pos|-th object in the index."""
+    off = self._sha_off + pos * self._sha_stride
+    return self._map[off:off + 20]
+
+  def Find(self, bin_sha1):
+    """Returns the offset of the object in the .pack file, or None."""
+    first_byte = ord(bin_sha1[0])
+    lo = self._fanout[first_byte - 1] if first_byte else 0
+    hi = self._fanout[first_byte]
+    mm = self._map
+    base = self._sha_off
+    stride = self._sha_stride
+    while lo < hi:
+      mid = (lo + hi) // 2
+      off = base + mid * stride
+      cur = mm[off:off + 20]
+      if cur < bin_sha1:
+        lo = mid + 1
+      elif cur > bin_sha1:
+        hi = mid
+      else:
+        return self._GetOffset(mid)
+    return None
+
+  def Entries(self):
+    """Returns the list of (binary SHA1, offset) of its objects."""
+    return [(self.GetSha1(pos), self._GetOffset(pos))
+            for pos in xrange(self.num_objects)]
+
+  def _GetOffset(self, pos):
+    if self.version == 1:
+      return struct.unpack_from('>I', self._map, self._fanout_off + 1024 +
+                                pos * 24)[0]
+    ofs, = struct.unpack_from('>I', self._map, self._ofs_off + pos * 4)
+    if ofs & 0x80000000:  # MSB set -> index into the 64-bit offsets table.
+      ofs, = struct.unpack_from('>Q', self._map, self._ofs64_off +
+                                (ofs & 0x7fffffff) * 8)
+    return ofs
+
+  def Close(self):
+    self._map.close()
+
+
+class PackFile(object):
+  """A memory-mapped .pack file. Deltas are resolved by the caller (see
+  ReadRawEntry), as REF_DELTA bases can live outside of the pack."""
+  def __init__(self, pack_path):
+    self.path = pack_path
+    with open(pack_path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    assert self._map[0:4] == 'PACK', 'Bad pack signature in ' + pack_path
+    version, = struct.unpack_from('>I', self._map, 4)
+    assert version in (2, 3), 'Unsupported pack version in ' + pack_path
+    self.size = len(self._map)
+
+  def ReadRaw(self, offset, length):
+    """Reads |length| bytes at |offset|, e.g. an entry as it is."""
+    return self._map[offset:offset + length]
+
+  def ReadRawEntry(self, offset):
+    """Reads the entry at |offset|.
+
+    Returns:
+      A tuple (objtype, data, delta_base) where:
+        objtype is one of the OBJ_* constants.
+        data is the inflated payload (or the delta instructions for deltas).
+        delta_base is the offset of the base (for OBJ_OFS_DELTA), the binary
+        SHA1 of the base (for OBJ_REF_DELTA) or None.
+    """
+    mm = self._map
+    pos = offset
+    c = ord(mm[pos])
+    pos += 1
+    objtype = (c >> 4) & 7
+    size = c & 15
+    shift = 4
+    while c & 0x80:
+      c = ord(mm[pos])
+      pos += 1
+      size |= (c & 0x7f) << shift
+      shift += 7
+
+    delta_base = None
+    if objtype == OBJ_OFS_DELTA:
+      c = ord(mm[pos])
+      pos += 1
+      base_ofs = c & 0x7f
+      while c & 0x80:
+        c = ord(mm[pos])
+        pos += 1
+        base_ofs = ((base_ofs + 1) << 7) | (c & 0x7f)
+      delta_base = offset - base_ofs
+    elif objtype == OBJ_REF_DELTA:
+      delta_base = mm[pos:pos + 20]
+      pos += 20
+
+    return objtype, self._Inflate(pos, size), delta_base
+
+  def _Inflate(self, pos, size):
+    mm = self._map
+    decomp = zlib.decompressobj()
+    # The compressed stream is almost always smaller than the inflated one, so
+    # in most cases a single chunk of |size| bytes (+ zlib overhead) suffices.
+    chunk_len = max(size + 64, 4096)
+    chunks = []
+    inflated = 0
+    while True:
+      chunk = mm[pos:pos + chunk_len]
+      assert chunk, 'Truncated pack entry in %s' % self.path
+      pos += len(chunk)
+      data = decomp.decompress(chunk)
+      chunks.append(data)
+      inflated += len(data)
+      if decomp.unused_data or inflated >= size:
+        break
+    chunks.append(decomp.flush())
+    payload = ''.join(chunks)
+    assert len(payload) == size, 'Corrupted pack entry in %s' % self.path
+    return payload
+
+  def Close(self):
+    self._map.close()
+
+
+class PackWriter(object):
+  """Appends (non-deltified) objects to a new pack file in |pack_dir|.
+
+  The pack is written under a tmp_pack_* name, which git ignores. Finalize()
+  fixes up the header, appends the trailer, writes the v2 .idx and renames both
+  to pack-<checksum>.{pack,idx}. The .idx is renamed last, so that readers
+  (which look for .idx files) never see an incomplete pack.
+  """
+  def __init__(self, pack_dir, zlib_level=1):
+    fd, self.path = tempfile.mkstemp(prefix='tmp_pack_', dir=pack_dir)
+    self._file = os.fdopen(fd, 'w+b')
+    self._file.write(struct.pack('>4sII', 'PACK', 2, 0))
+    self._zlib_level = zlib_level
+    self._entries = []  # List of (bin_sha1, crc32, offset).
+    self.size = 12
+
+  @property
+  def num_objects(self):
+    return len(self._entries)
+
+  def Append(self, bin_sha1, objtype, payload):
+    """Appends an object. Returns a tuple (offset, entry_len, header_len)."""
+    size = len(payload)
+    c = (TYPE_CODES[objtype] << 4) | (size & 15)
+    size >>= 4
+    header = []
+    while size:
+      header.append(chr(c | 0x80))
+      c = size & 0x7f
+      size >>= 7
+    header.append(chr(c))
+    entry = ''.join(header) + zlib.compress(payload, self._zlib_level)
+    offset = self.size
+    self._file.write(entry)
+    self._entries.append((bin_sha1, zlib.crc32(entry) & 0xffffffff, offset))
+    self.size += len(entry)
+    return offset, len(entry), len(header)
+
+  def AppendRaw(self, bin_sha1, raw_entry):
+    """Appends an entry copied as it is from another pack (see MergePacks).
+    It can't be a delta, whose base would be elsewhere."""
+    assert (ord(raw_entry[0]) >> 4) & 7 in TYPE_NAMES, (
+        'Cannot copy the delta %s' % bin_sha1.encode('hex'))
+    offset = self.size
+    self._file.write(raw_entry)
+    self._entries.append((bin_sha1, zlib.crc32(raw_entry) & 0xffffffff,
+                          offset))
+    self.size += len(raw_entry)
+
+  def ReadRaw(self, offset, length):
+    """Reads back a raw (i.e. not yet inflated) entry of the pending pack."""
+    self._file.flush()
+    self._file.seek(offset)
+    data = self._file.read(length)
+    self._file.seek(0, os.SEEK_END)
+    return data
+
+  def Finalize(self):
+    """Completes the pack and writes its .idx. Returns the .idx path."""
+    self._file.seek(8)
+    self._file.write(struct.pack('>I', len(self._entries)))
+    self._file.flush()
+    self._file.seek(0)
+    hasher = hashlib.sha1()
+    while True:
+      chunk = self._file.read(1048576)
+      if not chunk:
+        break
+      hasher.update(chunk)
+    pack_sha1 = hasher.digest()
+    self._file.seek(0, os.SEEK_END)
+    self._file.write(pack_sha1)
+    self._file.close()
+
+    pack_dir = os.path.dirname(self.path)
+    base_name = os.path.join(pack_dir, 'pack-' + pack_sha1.encode('hex'))
+    tmp_idx_path = self.path + '.idx'
+    with open(tmp_idx_path, 'wb') as idx_file:
+      idx_file.write(_BuildIndexV2(self._entries, pack_sha1))
+    os.rename(self.path, base_name + '.pack')
+    os.rename(tmp_idx_path, base_name + '.idx')
+    return base_name + '.idx'
+
+  def Abort(self):
+    self._file.close()
+    os.unlink(self.path)
+
+
+def _BuildIndexV2(entries, pack_sha1):
+  """Returns the contents of the v2 .idx for the given (sha1, crc, offset)."""
+  entries = sorted(entries)
+  fanout = [0] * 256
+  for bin_sha1, _, _ in entries:
+    fanout[ord(bin_sha1[0])] += 1
+  for i in xrange(1, 256):
+    fanout[i] += fanout[i - 1]
+  offsets = []
+  large_offsets = []
+  for _, _, offset in entries:
+    if offset < 0x80000000:
+      offsets.append(offset)
+    else:
+      offsets.append(0x80000000 | len(large_offsets))
+      large_offsets.append(offset)
+  num = len(entries)
+  data = ''.join([
+      _IDX_V2_MAGIC,
+      struct.pack('>I', 2),
+      struct.pack('>256I', *fanout),
+      ''.join(e[0] for e in entries),
+      struct.pack('>%dI' % num, *[e[1] for e in entries]),
+      struct.pack('>%dI' % num, *offsets),
+      struct.pack('>%dQ' % len(large_offsets), *large_offsets),
+      pack_sha1])
+  return data + hashlib.sha1(data).digest()
+
+
+def MergePacks(idx_paths, pack_dir):
+  """Writes the objects of the packs of |idx_paths| to a new pack in |pack_dir|.
+
+  The entries are copied as they are (no inflating), in the order of the packs
+  and of their offsets, the duplicates once. Hence the packs must have no
+  deltas, as the ones of PackWriter. Returns the .idx path of the new pack.
+  """
+  writer = PackWriter(pack_dir)
+  indexes = []  # Of the packs copied so far, to skip the duplicates.
+  try:
+    for idx_path in idx_paths:
+      index = PackIndex(idx_path)
+      pack = PackFile(idx_path[:-4] + '.pack')
+      entries = sorted(index.Entries(), key=lambda e: e[1])
+      ends = [offset for _, offset in entries[1:]] + [pack.size - 20]
+      for (sha1, offset), end in zip(entries, ends):
+        if all(i.Find(sha1) is None for i in indexes):
+          writer.AppendRaw(sha1, pack.ReadRaw(offset, end - offset))
+      pack.Close()
+      indexes.append(index)
+  except:
+    writer.Abort()
+    raise
+  finally:
+    for index in indexes:
+      index.Close()
+  return writer.Finalize()
+
+
+def InflateRawEntry(raw_entry, header_len):
+  """Inflates a non-delta entry previously written by PackWriter.Append()."""
+  return zlib.decompress(raw_entry[header_len:])
+
+
+def ListStalePacks(objdir):
+  """Returns the tmp_pack_* files left behind by crashed PackWriter(s)."""
+  pack_dir = os.path.join(objdir, 'pack')
+  if not os.path.isdir(pack_dir):
+    return []
+  return [os.path.join(pack_dir, f) for f in sorted(os.listdir(pack_dir))
+          if f.startswith('tmp_pack_')]
+
+
+class DeltaBaseCache(object):
+  """A bounded (in bytes) LRU cache of resolved delta bases."""
+  def __init__(self, max_bytes=64 * 1024 * 1024):
+    self._entries = collections.OrderedDict()
+    self._max_bytes = max_bytes
+    self._cur_bytes = 0
+
+  def Get(self, key):
+    value = self._entries.pop(key, None)
+    if value is not None:
+      self._entries[key] = value  # Move to the MRU end.
+    return value
+
+  def Put(self, key, value):
+    if key in self._entries or len(value[1]) > self._max_bytes // 4:
+      return
+    self._entries[key] = value
+    self._cur_bytes += len(value[1])
+    while self._cur_bytes > self._max_bytes:
+      _, (_, evicted) = self._entries.popitem(last=False)
+      self._cur_bytes -= len(evicted)
+
+
+def _ReadDeltaSize(delta, pos):
+  size = 0
+  shift = 0
+  while True:
+    c = ord(delta[pos])
+    pos += 1
+    size |= (c & 0x7f) << shift
+    shift += 7
+    if not c & 0x80:
+      return size, pos
+
+
+def ApplyDelta(base, delta):
+  """Applies a git delta (copy/insert instructions) to |base|."""
+  src_size, pos = _ReadDeltaSize(delta, 0)
+  assert src_size == len(base), 'Delta base size mismatch'
+  dst_size, pos = _ReadDeltaSize(delta, pos)
+  out = []
+  delta_len = len(delta)
+  while pos < delta_len:
+    op = ord(delta[pos])
+    pos += 1
+    if op & 0x80:  # Copy from base.
+      cp_off = cp_size = 0
+      for i in xrange(4):
+        if op & (1 << i):
+          cp_off |= ord(delta[pos]) << (8 * i)
+          pos += 1
+      for i in xrange(3):
+        if op & (0x10 << i):
+          cp_size |= ord(delta[pos]) << (8 * i)
+          pos += 1
+      if cp_size == 0:
+        cp_size = 0x10000
+      out.append(base[cp_off:cp_off + cp_size])
+    elif op:  # Insert the next |op| bytes literally.
+      out.append(delta[pos:pos + op])
+      pos += op
+    else:
+      raise ValueError('Invalid delta opcode 0')
+  result = ''.join(out)
+  assert len(result) == dst_size, 'Delta result size mismatch'
+  return result
+
+
+def ListPacks(objdir):
+  """Returns the list of (idx_path, pack_path) in |objdir|/pack."""
+  pack_dir = os.path.join(objdir, 'pack')
+  if not os.path.isdir(pack_dir):
+    return []
+  res = []
+  for fname in sorted(os.listdir(pack_dir)):
+    if not fname.endswith('.idx'):
+      continue
+    pack_path = os.path.join(pack_dir, fname[:-4] + '.pack')
+    if os.path.exists(pack_path):
+      res.append((os.path.join(pack_dir, fname), pack_path))
+  return res
+
+
+def ReadAlternates(objdir):
+  """Returns the list of the alternate object dirs of |objdir| (recursively)."""
+  res = []
+  pending = [objdir]
+  while pending:
+    cur = pending.pop(0)
+    alt_path = os.path.join(cur, 'info', 'alternates')
+    if not os.path.exists(alt_path):
+      continue
+    with open(alt_path) as f:
+      for line in f:
+        line = line.strip()
+        if not line or line.startswith('#'):
+          continue
+        alt_dir = os.path.normpath(os.path.join(cur, line))
+        if alt_dir not in res and alt_dir != objdir:
+          res.append(alt_dir)
+          pending.append(alt_dir)
+  return res
@@ -2,44 +2,76 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
-"""A collection of classes to read/parse/write efficiently git objects."""
+"""A collection of classes to read/parse/write efficiently git objects.
 
+Object ids (SHA1s) are binary 20 bytes strings everywhere. The hex form is used
+only within the textual git formats (e.g. commit headers) and for the user.
+"""
+
+import array
+import collections
 import hashlib
 import os
+import Queue
 import subprocess
+import sys
+import threading
+import time
 import zlib
 
+import gitpack
+
 
 class _AbstractGitObjDB(object):
-  """Base class for GitReadonlyObjDB and GitLooseObjDB."""
+  """Base class for the Git*ObjDB classes below."""
   def ReadObj(self, sha1):
     raise NotImplementedError()
 
   def WriteObj(self, objtype, payload):
     raise NotImplementedError()
 
+  def HasObj(self, sha1, rescan=True):
+    """Whether |sha1| exists. Unless |rescan|, the objects added by other
+    processes after the initialization might not be seen."""
+    raise NotImplementedError()
+
+  def ReadObjs(self, sha1s):
+    """Yields a tuple (sha1, objtype, payload) for each of the given SHA1s."""
+    for sha1 in sha1s:
+      objtype, payload = self.ReadObj(sha1)
+      yield sha1, objtype, payload
+
+  def Prefetch(self, sha1s):
+    """Hints that the given objects are likely to be read soon."""
+    pass
+
   def ReadCommit(self, sha1):
     objtype, payload = self.ReadObj(sha1)
-    assert objtype == 'commit', '%s is not a commit (%s)' % (sha1, objtype)
+    assert objtype == 'commit', '%s is not a commit (%s)' % (
+        sha1.encode('hex'), objtype)
     return Commit(payload)
 
   def ReadTree(self, sha1):
     objtype, payload = self.ReadObj(sha1)
-    assert objtype == 'tree', '%s is not a tree (%s)' % (sha1, objtype)
-    return ParseTree(payload)
+    assert objtype == 'tree', '%s is not a tree (%s)' % (
+        sha1.encode('hex'), objtype)
+    return TreeView(payload)
 
   def ReadBlob(self, sha1):
     objtype, payload = self.ReadObj(sha1)
-    assert objtype == 'blob', '%s is not a blob (%s)' % (sha1, objtype)
+    assert objtype == 'blob', '%s is not a blob (%s)' % (
+        sha1.encode('hex'), objtype)
     return payload
 
   def WriteCommit(self, payload):
     return self.WriteObj('commit', payload)
 
   def WriteTree(self, entries):
-    payload = ''
-    for entry in sorted(entries, key=_GitTreeEntryGetSortKey):
-      payload += entry[0] + ' ' + entry[1] + '\x00' + entry[2].decode('hex')
+    """Writes a tree given either a TreeView or a list of entries."""
+    if isinstance(entries, TreeView):
+      return self.WriteObj('tree', entries.payload)
+    payload = ''.join(mode + ' ' + fname + '\x00' + sha1 for mode, fname, sha1
+                      in sorted(entries, key=_GitTreeEntryGetSortKey))
     return self.WriteObj('tree', payload)
 
   def WriteBlob(self, data):
@@ -48,6 +80,14 @@ class _AbstractGitObjDB(object):
   def CopyBlobIntoFile(self, sha1, file_path):
     WriteFileAtomic(file_path, self.ReadBlob(sha1))
 
+  def Flush(self):
+    pass
+
+  def ConsolidatePacks(self):
+    """Merges the small packs written so far, if any (see GitPackObjDB).
+    Returns the number of packs merged."""
+    return 0
+
   def Close(self):
     pass
 
@@ -57,98 +97,636 @@ class GitReadonlyObjDB(_AbstractGitObjDB):
 
   Pro: can read from both pack files and loose objects.
   Cons: does not support writing; it is slow (pipes everything trough git).
+  The latency of the pipe can be hidden keeping up to |window| requests in
+  flight, either via ReadObjs() or via Prefetch() hints.
   """
-  def __init__(self, git_dir=None):
+  def __init__(self, git_dir=None, window=256, verifier=None):
+    # The requests in flight must fit in the stdin pipe buffer (64 KB), or
+    # writing them could block while git is blocked writing its replies.
+    assert window <= 1024
     self._proc = subprocess.Popen(['git', 'cat-file', '--batch'],
                                   stdout=subprocess.PIPE,
                                   stdin=subprocess.PIPE,
+                                  bufsize=-1,
                                   cwd=git_dir)
+    self._window = window
+    self._verifier = verifier or ObjectVerifier()
+    self._inflight = collections.deque()  # SHA1s requested but not read yet.
+    # SHA1 -> number of its requests in |_inflight|, for O(1) lookups.
+    self._inflight_counts = collections.Counter()
+    # SHA1 -> (objtype, payload) read ahead. Capped to |window| entries, as
+    # the prefetch hints might never be followed by an actual read.
+    self._prefetched = collections.OrderedDict()
 
   def ReadObj(self, sha1):
-    assert len(sha1) == 40
-    self._proc.stdin.write(sha1 + '\n')
+    assert len(sha1) == 20
+    res = self._prefetched.pop(sha1, None)
+    if res:
+      return res
+    if sha1 not in self._inflight_counts:
+      self._Request([sha1])
+    while True:
+      ret_sha1, objtype, payload = self._ReadReply()
+      if ret_sha1 == sha1:
+        return objtype, payload
+      self._prefetched[ret_sha1] = (objtype, payload)
+      if len(self._prefetched) > self._window:
+        self._prefetched.popitem(last=False)
+
+  def ReadObjs(self, sha1s):
+    queue = collections.deque()
+    for sha1 in sha1s:
+      queue.append(sha1)
+      self.Prefetch([sha1])
+      if len(queue) >= self._window:
+        sha1 = queue.popleft()
+        objtype, payload = self.ReadObj(sha1)
+        yield sha1, objtype, payload
+    while queue:
+      sha1 = queue.popleft()
+      objtype, payload = self.ReadObj(sha1)
+      yield sha1, objtype, payload
+
+  def Prefetch(self, sha1s):
+    budget = self._window - len(self._inflight)
+    to_request = []
+    for sha1 in sha1s:
+      if len(to_request) >= budget:
+        break  # Prefetching is just a hint, drop the excess.
+      if sha1 not in self._prefetched and sha1 not in self._inflight_counts:
+        to_request.append(sha1)
+    if to_request:
+      self._Request(to_request)
+
+  def _Request(self, sha1s):
+    self._proc.stdin.write(''.join(s.encode('hex') + '\n' for s in sha1s))
+    self._proc.stdin.flush()
+    self._inflight.extend(sha1s)
+    self._inflight_counts.update(sha1s)
+
+  def _ReadReply(self):
+    """Reads the reply to the oldest request in flight."""
+    sha1 = self._inflight.popleft()
+    self._inflight_counts[sha1] -= 1
+    if not self._inflight_counts[sha1]:
+      del self._inflight_counts[sha1]
     line = self._proc.stdout.readline().strip('\r\n')
     ret_sha1, objtype, size = line.split()
-    assert sha1 == ret_sha1
+    assert sha1 == ret_sha1.decode('hex'), line
     payload = self._proc.stdout.read(int(size))
-    assert VerifyObject(objtype, payload, sha1)
+    self._verifier.Verify(objtype, payload, sha1)
     assert self._proc.stdout.read(1) == '\n'
-    return objtype, payload
+    return sha1, objtype, payload
 
   def WriteObj(self, objtype, payload):
     raise NotImplementedError('Write not supported in GitReadonlyObjDB')
 
   def Close(self):
+    self._verifier.Flush()
     try:
       self._proc.terminate()
     except:
       pass
 
 
+class GitNativeObjDB(_AbstractGitObjDB):
+  """Reads arbitrary objects (packed or loose) from a repo, natively.
+
+  Pack files and their indexes are memory-mapped and parsed in-process. Loose
+  objects and objects/info/alternates are supported as well.
+  Pros: no round trips through a git subprocess; a drop-in replacement for
+        GitReadonlyObjDB.
+  Cons: does not support writing.
+  """
+  def __init__(self, git_dir=None, delta_cache_bytes=64 * 1024 * 1024,
+               objdir=None, verifier=None):
+    if not objdir:
+      git_dir = os.path.abspath(git_dir or os.getcwd())
+      objdir = os.path.join(git_dir, 'objects')
+      if not os.path.isdir(objdir):  # Non-bare repo.
+        objdir = os.path.join(git_dir, '.git', 'objects')
+    assert os.path.isdir(objdir), 'Cannot find the objects dir ' + objdir
+    self._objdirs = [objdir] + gitpack.ReadAlternates(objdir)
+    self._packs = []  # List of (PackIndex, PackFile) tuples.
+    self._known_packs = set()
+    self._delta_cache = gitpack.DeltaBaseCache(delta_cache_bytes)
+    self._verifier = verifier or ObjectVerifier()
+    self.RescanPacks()
+
+  def RescanPacks(self):
+    """Picks up packs created after the initialization. Returns True if any.
+
+    Costs a listdir() of each pack dir. The reads and HasObj() rescan on a
+    miss, so this is needed only to pick up the packs upfront.
+    """
+    found_new_packs = False
+    for objdir in self._objdirs:
+      for idx_path, pack_path in gitpack.ListPacks(objdir):
+        if idx_path not in self._known_packs:
+          self.AddPack(idx_path)
+          found_new_packs = True
+    return found_new_packs
+
+  def AddPack(self, idx_path):
+    """Makes the pack of |idx_path| readable, without a rescan (e.g. a pack
+    just finalized by a GitPackObjDB, see gitpack.PackWriter.Finalize)."""
+    self._known_packs.add(idx_path)
+    self._packs.append((gitpack.PackIndex(idx_path),
+                        gitpack.PackFile(idx_path[:-4] + '.pack')))
+    # The lookups try the packs in order: the biggest ones are the likeliest
+    # to have the objects.
+    self._packs.sort(key=lambda p: -p[0].num_objects)
+
+  def ReadObj(self, sha1):
+    assert len(sha1) == 20
+    res = self.ReadObjOrNone(sha1)
+    assert res, 'Object %s not found' % sha1.encode('hex')
+    objtype, payload = res
+    self._verifier.Verify(objtype, payload, sha1)
+    return objtype, payload
+
+  def HasObj(self, sha1, rescan=True):
+    """Whether |sha1| exists, packed or loose. On a miss, the packs are
+    rescanned (see RescanPacks) unless |rescan| is False."""
+    assert len(sha1) == 20
+    if self.HasPackedObj(sha1):
+      return True
+    hex_sha1 = sha1.encode('hex')
+    if any(os.path.exists(os.path.join(d, hex_sha1[0:2], hex_sha1[2:]))
+           for d in self._objdirs):
+      return True
+    return rescan and self.RescanPacks() and self.HasPackedObj(sha1)
+
+  def HasPackedObj(self, sha1):
+    """Whether |sha1| is in the packs known (no stat()s, no rescan)."""
+    for pack_index, _ in self._packs:
+      if pack_index.Find(sha1) is not None:
+        return True
+    return False
+
+  def ReadObjOrNone(self, sha1):
+    """Returns (objtype, payload) or None if the object doesn't exist.
+
+    Unlike ReadObj(), the object is not verified (e.g. for the objects that
+    the caller wrote itself).
+    """
+    for _ in xrange(2):
+      for pack_index, pack in self._packs:
+        offset = pack_index.Find(sha1)
+        if offset is not None:
+          return self._ReadPacked(pack, offset)
+      hex_sha1 = sha1.encode('hex')
+      for objdir in self._objdirs:
+        objpath = os.path.join(objdir, hex_sha1[0:2], hex_sha1[2:])
+        if os.path.exists(objpath):
+          return _ReadLooseObject(objpath)
+      if not self.RescanPacks():
+        break
+    return None
+
+  def _ReadPacked(self, pack, offset):
+    """Reads the object at |offset|, resolving the chain of deltas."""
+    deltas = []  # Stack of (pack, offset, delta instructions).
+    while True:
+      base = self._delta_cache.Get((pack.path, offset))
+      if base:
+        break
+      objtype, data, delta_base = pack.ReadRawEntry(offset)
+      if objtype == gitpack.OBJ_OFS_DELTA:
+        deltas.append((pack, offset, data))
+        offset = delta_base
+      elif objtype == gitpack.OBJ_REF_DELTA:
+        deltas.append((pack, offset, data))
+        base = self.ReadObjOrNone(delta_base)
+        assert base, 'Missing delta base %s' % delta_base.encode('hex')
+        break
+      else:
+        base = (gitpack.TYPE_NAMES[objtype], data)
+        if deltas:
+          self._delta_cache.Put((pack.path, offset), base)
+        break
+    objtype, data = base
+    while deltas:
+      delta_pack, delta_offset, delta = deltas.pop()
+      data = gitpack.ApplyDelta(data, delta)
+      # Intermediate objects are likely to be the base of other deltas.
+      if deltas:
+        self._delta_cache.Put((delta_pack.path, delta_offset), (objtype, data))
+    return objtype, data
+
+  def WriteObj(self, objtype, payload):
+    raise NotImplementedError('Write not supported in GitNativeObjDB')
+
+  def Close(self):
+    self._verifier.Flush()
+    for pack_index, pack in self._packs:
+      pack_index.Close()
+      pack.Close()
+    self._packs = []
+    self._known_packs.clear()
+
+
 class GitLooseObjDB(_AbstractGitObjDB):
   """Reads/Writes loose git objects.
 
   Pros: can both read and write objects; it's blazing fast.
   Con: it can ready only loose objects (no objects from packs).
+  Writes are asynchronous: WriteObj() hashes the object and returns its SHA1
+  right away, while the compression and the file writes are done by a pool of
+  |num_threads| threads (which release the GIL while doing so). Up to
+  |max_queued| objects can wait for them, after which WriteObj() blocks.
+  Flush() waits for all the pending writes.
+  The fanout dirs are created upfront and there are no stat()s per object:
+  the objects written by this instance are tracked in memory. An object
+  already on disk, but unknown to this instance, is just written again (the
+  rename is atomic and the content is identical, by definition).
   """
-  def __init__(self, objdir=None):
+  def __init__(self, objdir=None, num_threads=2, max_queued=1024):
     self._objdir = objdir
+    for i in xrange(256):
+      Makedirs(os.path.join(objdir, '%02x' % i))
+    self._num_threads = num_threads
+    self._written = set()  # SHA1s written (or being written) by this instance.
+    self._pending = {}  # SHA1 -> data not written yet (see ReadObj()).
+    self._lock = threading.Lock()  # Guards |_pending|.
+    self._queue = Queue.Queue(max_queued)  # (sha1, data) to be written.
+    self._threads = []  # Started on the first write.
+    self._error = None  # The exc_info of the first failed write, if any.
 
   def ReadObj(self, sha1):
-    assert len(sha1) == 40
-    objpath = os.path.join(self._objdir, sha1[0:2], sha1[2:])
-    with open(objpath, 'rb') as fin:
-      data = zlib.decompress(fin.read())
-    headlen = data.index('\x00')
-    objtype, objlen = data[:headlen].split()
-    objlen = int(objlen)
-    payload = data[headlen + 1:]
-    assert len(data) == (objlen + headlen + 1)
-    return objtype, payload
+    assert len(sha1) == 20
+    with self._lock:
+      data = self._pending.get(sha1)
+    if data is not None:
+      headlen = data.index('\x00')
+      return data[:headlen].split()[0], data[headlen + 1:]
+    return _ReadLooseObject(self._ObjPath(sha1))
+
+  def HasObj(self, sha1, rescan=True):
+    assert len(sha1) == 20
+    return sha1 in self._written or os.path.exists(self._ObjPath(sha1))
 
   def WriteObj(self, objtype, payload):
+    self._RaiseIfWriteFailed()
     data = ('%s %d\x00' % (objtype, len(payload))) + payload
-    hasher = hashlib.sha1()
-    hasher.update(data)
-    sha1 = hasher.hexdigest()
-    basedir = os.path.join(self._objdir, sha1[0:2])
-    objpath = os.path.join(basedir, sha1[2:])
-    if not os.path.exists(objpath):
-      Makedirs(basedir)
-      WriteFileAtomic(objpath, zlib.compress(data, 1))
+    sha1 = hashlib.sha1(data).digest()
+    if sha1 in self._written:
+      return sha1
+    self._written.add(sha1)
+    if not self._threads:
+      self._StartThreads()
+    with self._lock:
+      self._pending[sha1] = data
+    self._queue.put((sha1, data))
+    return sha1
+
+  def Flush(self):
+    """Waits for the pending writes to complete."""
+    if self._threads:
+      self._queue.join()
+    self._RaiseIfWriteFailed()
+
+  def Close(self):
+    self.Flush()
+    for _ in self._threads:
+      self._queue.put(None)
+    for thread in self._threads:
+      thread.join()
+    self._threads = []
+
+  def _StartThreads(self):
+    for _ in xrange(self._num_threads):
+      thread = threading.Thread(target=self._WriterThreadMain)
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _WriterThreadMain(self):
+    while True:
+      item = self._queue.get()
+      if item is None:
+        self._queue.task_done()
+        break
+      sha1, data = item
+      try:
+        if not self._error:
+          WriteFileAtomic(self._ObjPath(sha1), zlib.compress(data, 1))
+      except Exception:
+        self._error = self._error or sys.exc_info()
+      finally:
+        with self._lock:
+          del self._pending[sha1]
+        self._queue.task_done()
+
+  def _RaiseIfWriteFailed(self):
+    if self._error:
+      raise self._error[0], self._error[1], self._error[2]
+
+  def _ObjPath(self, sha1):
+    hex_sha1 = sha1.encode('hex')
+    return os.path.join(self._objdir, hex_sha1[0:2], hex_sha1[2:])
+
+
+class ObjectVerifier(object):
+  """Checks that the objects read match their SHA1, according to |mode|.
+
+  'off': no check at all.
+  'inline': every object is hashed before being returned (the default).
+  'sampled': only the objects whose SHA1 starts with a byte multiple of
+      |sample_rate| (i.e. 1 every |sample_rate|, on average) are hashed inline.
+  'deferred': the SHA1s of the objects read are passed, in batches, to
+      |deferred_sink|, which is expected to verify them off the critical path
+      (e.g. re-reading them from a different process).
+  """
+  MODES = ('off', 'inline', 'sampled', 'deferred')
+
+  def __init__(self, mode='inline', sample_rate=16, deferred_sink=None,
+               deferred_batch_size=1024):
+    assert mode in ObjectVerifier.MODES, 'Invalid verify mode ' + mode
+    assert mode != 'deferred' or deferred_sink
+    self._mode = mode
+    self._sample_rate = sample_rate
+    self._deferred_sink = deferred_sink
+    self._deferred_batch_size = deferred_batch_size
+    self._deferred = []
+
+  def Verify(self, objtype, payload, sha1):
+    if self._mode == 'off':
+      return
+    if self._mode == 'deferred':
+      self._deferred.append(sha1)
+      if len(self._deferred) >= self._deferred_batch_size:
+        self.Flush()
+      return
+    if self._mode == 'sampled' and ord(sha1[0]) % self._sample_rate:
+      return
+    assert VerifyObject(objtype, payload, sha1), (
+        'Corrupted object ' + sha1.encode('hex'))
+
+  def Flush(self):
+    """Passes the pending SHA1s (if any) to the |deferred_sink|."""
+    if self._deferred:
+      self._deferred_sink(self._deferred)
+      self._deferred = []
+
+
+# Classes that can be used to read the original (i.e. mirrored) repos.
+READONLY_OBJDB_CLASSES = {
+    'native': GitNativeObjDB,
+    'git': GitReadonlyObjDB,
+}
+
+
+class GitPackObjDB(_AbstractGitObjDB):
+  """Reads/Writes git objects, writing new objects into pack files.
+
+  New objects are appended to a pack in |objdir|/pack, which is finalized (i.e.
+  gets its .idx and becomes visible to git and other processes) when it grows
+  beyond |max_pack_bytes|, on Flush() or on Close(). Objects of the pending
+  (not finalized) pack can still be read back by this instance.
+  Pros: no per-object files, stat()s or renames.
+  Cons: objects become visible to other processes only once finalized. Each
+        instance (e.g. each pool worker) finalizes its own packs, which add
+        up: see ConsolidatePacks().
+  """
+  def __init__(self, objdir, max_pack_bytes=1024 * 1024 * 1024):
+    self._objdir = objdir
+    self._pack_dir = os.path.join(objdir, 'pack')
+    Makedirs(self._pack_dir)
+    self._max_pack_bytes = max_pack_bytes
+    self._reader = GitNativeObjDB(objdir=objdir)
+    self._writer = None
+    self._pending = {}  # sha1 -> (objtype, offset, entry_len, header_len)
+
+  def ReadObj(self, sha1):
+    assert len(sha1) == 20
+    pending = self._pending.get(sha1)
+    if pending:
+      objtype, offset, entry_len, header_len = pending
+      raw_entry = self._writer.ReadRaw(offset, entry_len)
+      return objtype, gitpack.InflateRawEntry(raw_entry, header_len)
+    res = self._reader.ReadObjOrNone(sha1)
+    assert res, 'Object %s not found' % sha1.encode('hex')
+    return res
+
+  def HasObj(self, sha1, rescan=True):
+    """Unless |rescan|, only the packs known are looked up (no stat()s nor
+    listdir()s), which is enough for the objects that this instance wrote or
+    that were there at its initialization (the writers write only packs)."""
+    if sha1 in self._pending or self._reader.HasPackedObj(sha1):
+      return True
+    return rescan and self._reader.HasObj(sha1)
+
+  def WriteObj(self, objtype, payload):
+    hasher = hashlib.sha1('%s %d\x00' % (objtype, len(payload)))
+    hasher.update(payload)
+    sha1 = hasher.digest()
+    # Duplicates of objects in other packs are harmless, but skipping the ones
+    # already known saves space. Loose objects are not checked to avoid stat()s.
+    if self.HasObj(sha1, rescan=False):
+      return sha1
+    if not self._writer:
+      self._writer = gitpack.PackWriter(self._pack_dir)
+    self._pending[sha1] = (objtype,) + self._writer.Append(
+        sha1, objtype, payload)
+    if self._writer.size >= self._max_pack_bytes:
+      self.Flush()
     return sha1
 
+  def Flush(self):
+    """Finalizes the pending pack (if any), making its objects visible."""
+    if not self._writer:
+      return
+    if self._writer.num_objects:
+      self._reader.AddPack(self._writer.Finalize())
+    else:
+      self._writer.Abort()
+    self._writer = None
+    self._pending = {}
+
+  def ConsolidatePacks(self, min_packs=8, small_pack_bytes=64 * 1024 * 1024):
+    """Merges the packs in |objdir| smaller than |small_pack_bytes| into one,
+    once there are |min_packs| of them. Returns the number of packs merged.
+
+    Every lookup of a missing object (e.g. each WriteObj) probes all the packs,
+    so their number must stay bounded. The merged packs are deleted: no other
+    process must be reading or writing |objdir| meanwhile.
+    """
+    self.Flush()
+    small_packs = [(idx_path, pack_path) for idx_path, pack_path
+                   in gitpack.ListPacks(self._objdir)
+                   if os.path.getsize(pack_path) < small_pack_bytes]
+    if len(small_packs) < min_packs:
+      return 0
+    merged_idx_path = gitpack.MergePacks([i for i, _ in small_packs],
+                                         self._pack_dir)
+    self._reader.Close()
+    for idx_path, pack_path in small_packs:
+      if idx_path != merged_idx_path:  # Unless they had the same objects.
+        os.unlink(idx_path)  # First, as the readers look for the .idx files.
+        os.unlink(pack_path)
+    self._reader = GitNativeObjDB(objdir=self._objdir)
+    return len(small_packs)
+
+  def Close(self):
+    self.Flush()
+    self._reader.Close()
+
+
+def RemoveStalePacks(objdir):
+  """Removes the incomplete packs left behind by a crashed GitPackObjDB."""
+  for path in gitpack.ListStalePacks(objdir):
+    os.unlink(path)
+
+
+# Classes that can be used to write the new (i.e. rewritten) objects.
+WRITABLE_OBJDB_CLASSES = {
+    'pack': GitPackObjDB,
+    'loose': GitLooseObjDB,
+}
+
+
+class LayeredObjDB(_AbstractGitObjDB):
+  """Reads the objects that |top| has from it, and the others from |bottom|.
+
+  E.g., to read the rewritten trees, which mix new objects with original ones.
+  |top| must implement HasObj() (as the writable classes do). It is probed
+  without rescans, as most of the reads are of |bottom|'s objects: the objects
+  to read from |top| must be ones that it wrote or had at its initialization.
+  """
+  def __init__(self, top, bottom):
+    self._top = top
+    self._bottom = bottom
+
+  def ReadObj(self, sha1):
+    if self._top.HasObj(sha1, rescan=False):
+      return self._top.ReadObj(sha1)
+    return self._bottom.ReadObj(sha1)
+
+  def HasObj(self, sha1, rescan=True):
+    return (self._top.HasObj(sha1, rescan=rescan) or
+            self._bottom.HasObj(sha1, rescan=rescan))
+
+
+class MeteredObjDB(_AbstractGitObjDB):
+  """Wraps any of the classes above, counting the objects it reads and writes.
+
+  The counts (and the seconds spent) are added to |counters| (a dict, e.g. a
+  collections.Counter) as |prefix|.objs_read, |prefix|.bytes_read,
+  |prefix|.read_seconds, the same for writes, |prefix|.flush_seconds and
+  |prefix|.packs_merged (see ConsolidatePacks).
+  """
+  def __init__(self, db, counters, prefix):
+    self._db = db
+    self._counters = counters
+    self._prefix = prefix
+    self._read_names = tuple(prefix + n for n in (
+        '.objs_read', '.bytes_read', '.read_seconds'))
+    self._write_names = tuple(prefix + n for n in (
+        '.objs_written', '.bytes_written', '.write_seconds'))
+
+  def _Count(self, names, payload, tstart):
+    counters = self._counters
+    counters[names[0]] += 1
+    counters[names[1]] += len(payload)
+    counters[names[2]] += time.time() - tstart
+
+  def ReadObj(self, sha1):
+    tstart = time.time()
+    objtype, payload = self._db.ReadObj(sha1)
+    self._Count(self._read_names, payload, tstart)
+    return objtype, payload
+
+  def ReadObjs(self, sha1s):
+    objs = self._db.ReadObjs(sha1s)
+    while True:
+      tstart = time.time()
+      try:
+        sha1, objtype, payload = next(objs)
+      except StopIteration:
+        break
+      self._Count(self._read_names, payload, tstart)
+      yield sha1, objtype, payload
+
+  def WriteObj(self, objtype, payload):
+    tstart = time.time()
+    sha1 = self._db.WriteObj(objtype, payload)
+    self._Count(self._write_names, payload, tstart)
+    return sha1
+
+  def HasObj(self, sha1, rescan=True):
+    return self._db.HasObj(sha1, rescan=rescan)
+
+  def Prefetch(self, sha1s):
+    self._db.Prefetch(sha1s)
+
+  def Flush(self):
+    tstart = time.time()
+    self._db.Flush()
+    self._counters[self._prefix + '.flush_seconds'] += time.time() - tstart
+
+  def ConsolidatePacks(self):
+    tstart = time.time()
+    num_packs = self._db.ConsolidatePacks()
+    self._counters[self._prefix + '.packs_merged'] += num_packs
+    self._counters[self._prefix + '.flush_seconds'] += time.time() - tstart
+    return num_packs
+
+  def Close(self):
+    tstart = time.time()
+    self._db.Close()
+    self._counters[self._prefix + '.flush_seconds'] += time.time() - tstart
+
 
 class Commit(object):
-  """Semi-structured representation of a commit object."""
+  """Semi-structured representation of a commit object.
+
+  Supports any number of parents. |tree|, |parents| and |merged_parent| are
+  binary SHA1s. Headers other than tree, parent, author and committer (e.g.
+  encoding, gpgsig, mergetag) are preserved, in order, in |extra_headers|.
+  Multi-line values are stored without the leading spaces of their
+  continuation lines.
+  """
   def __init__(self, payload):
     headers, self.message = payload.split('\n\n', 1)
-    self.headers = {}
+    self.headers = {}  # author and committer.
+    self.tree = None
+    self.parents = []
+    self.extra_headers = []  # List of [header, value].
     self.merged_parent = None
-    for header, value in (h.split(' ', 1) for h in headers.split('\n')):
-      assert header not in self.headers, 'Duplicate ' + header
-      self.headers[header] = value
-    assert 'tree' in self.headers
+    last_value = None
+    for line in headers.split('\n'):
+      if line.startswith(' '):  # Continuation of a multi-line header.
+        assert last_value is not None, 'Unexpected continuation line'
+        last_value[1] += '\n' + line[1:]
+        continue
+      header, value = line.split(' ', 1)
+      if header == 'parent':
+        self.parents.append(value.decode('hex'))
+        last_value = None
+      elif header == 'tree':
+        assert self.tree is None, 'Duplicate tree'
+        self.tree = value.decode('hex')
+        last_value = None
+      elif header in ('author', 'committer'):
+        assert header not in self.headers, 'Duplicate ' + header
+        self.headers[header] = value
+        last_value = None
+      else:
+        last_value = [header, value]
+        self.extra_headers.append(last_value)
+    assert self.tree
     assert 'author' in self.headers
     assert 'committer' in self.headers
 
   @property
   def parent(self):
-    """Returns the SHA1 of the parent commit or None."""
-    return self.headers.get('parent')
+    """Returns the SHA1 of the (first) parent commit or None."""
+    return self.parents[0] if self.parents else None
 
   @parent.setter
   def parent(self, value):
-    self.headers['parent'] = value
-
-  @property
-  def tree(self):
-    """Returns the SHA1 of the tree."""
-    return self.headers.get('tree')
-
-  @tree.setter
-  def tree(self, value):
-    self.headers['tree'] = value
+    self.parents[0:1] = [value] if value else []
 
   @property
   def author(self):
@@ -171,26 +749,246 @@ class Commit(object):
   @property
   def payload(self):
     """Returns the raw object payload."""
-    payload = 'tree ' + self.headers['tree']
-    if self.parent:
-      payload += '\nparent ' + self.headers['parent']
+    lines = ['tree ' + self.tree.encode('hex')]
+    lines.extend('parent ' + p.encode('hex') for p in self.parents)
     if self.merged_parent:
-      payload += '\nparent ' + self.merged_parent
-    payload += '\nauthor ' + self.headers['author']
-    payload += '\ncommitter ' + self.headers['committer']
-    payload += '\n\n'
-    payload += self.message
-    return payload
+      lines.append('parent ' + self.merged_parent.encode('hex'))
+    lines.append('author ' + self.headers['author'])
+    lines.append('committer ' + self.headers['committer'])
+    lines.extend(h + ' ' + v.replace('\n', '\n ')
+                 for h, v in self.extra_headers)
+    return '\n'.join(lines) + '\n\n' + self.message
+
+
+class TreeView(object):
+  """A read-only, lazily parsed view of the payload of a tree object.
+
+  Behaves like the list of (mode, fname, sha1) tuples returned by ParseTree().
+  The offsets of the entries are indexed only on the first access, and the
+  tuples are created only for the entries actually accessed. Entries are
+  looked up by binary search (they are in git sort order). Edit() builds the
+  payload of the modified tree copying the unmodified entries as raw slices.
+  """
+  def __init__(self, payload):
+    self.payload = payload
+    self._view = memoryview(payload)
+    self._offsets = None  # Start of each entry, plus len(payload).
+
+  def _Index(self):
+    if self._offsets is None:
+      offsets = array.array('l')
+      payload = self.payload
+      cursor = 0
+      while cursor < len(payload):
+        offsets.append(cursor)
+        cursor = payload.index('\0', cursor) + 21
+      assert cursor == len(payload), 'Truncated tree'
+      offsets.append(cursor)
+      self._offsets = offsets
+    return self._offsets
+
+  def _Entry(self, index):
+    start = self._Index()[index]
+    nul = self.payload.index('\0', start)
+    space = self.payload.index(' ', start, nul)
+    return (self.payload[start:space], self.payload[space + 1:nul],
+            self._view[nul + 1:nul + 21].tobytes())
+
+  def _SortKey(self, index):
+    mode, fname, _ = self._Entry(index)
+    return _GitTreeEntryGetSortKey((mode, fname))
+
+  def _Bisect(self, key):
+    """Returns the index of the first entry whose sort key is >= |key|."""
+    lo, hi = 0, len(self)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self._SortKey(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def Find(self, fname):
+    """Returns the index of the entry named |fname| or None."""
+    for key in (fname, fname + '/'):  # A blob or a subtree.
+      index = self._Bisect(key)
+      if index < len(self) and self._Entry(index)[1] == fname:
+        return index
+    return None
+
+  def Lookup(self, fname):
+    """Returns the SHA1 of the entry named |fname| or None."""
+    index = self.Find(fname)
+    return None if index is None else self._Entry(index)[2]
+
+  def Edit(self, upserts=(), removals=()):
+    """Returns a new TreeView with the given changes applied.
+
+    Args:
+      upserts: (mode, fname, sha1) entries to add, or to replace the existing
+          entries with the same name.
+      removals: names of the entries to remove. They must exist.
+    """
+    offsets = self._Index()
+    # (start index, end index, sort key, replacement). The sort key orders the
+    # entries inserted at the same index.
+    ops = []
+    edited_names = set()
+    for fname in removals:
+      index = self.Find(fname)
+      assert index is not None, 'Could not find %s in tree' % fname
+      ops.append((index, index + 1, '', ''))
+      edited_names.add(fname)
+    for mode, fname, sha1 in upserts:
+      assert fname not in edited_names, 'Conflicting edits for ' + fname
+      edited_names.add(fname)
+      index = self.Find(fname)
+      if index is not None:
+        ops.append((index, index + 1, '', ''))
+      key = _GitTreeEntryGetSortKey((mode, fname))
+      pos = self._Bisect(key)
+      ops.append((pos, pos, key, mode + ' ' + fname + '\0' + sha1))
+    ops.sort(key=lambda op: op[0:3])
+    chunks = []
+    cursor = 0
+    for start, end, _, replacement in ops:
+      chunks.append(self.payload[offsets[cursor]:offsets[start]])
+      chunks.append(replacement)
+      cursor = end
+    chunks.append(self.payload[offsets[cursor]:])
+    return TreeView(''.join(chunks))
+
+  def __len__(self):
+    return len(self._Index()) - 1
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('TreeView index out of range')
+    return self._Entry(index)
+
+  def __iter__(self):
+    for index in xrange(len(self)):
+      yield self._Entry(index)
+
+
+class TreeEditor(object):
+  """Applies a batch of path-level edits to a tree.
+
+  Each tree on the paths of the edits is read once (from |reader|) and only
+  those trees are written (to |writer|): the rest of the tree is shared with
+  the original one. The paths are relative to the root, '/'-separated.
+  Example:
+    editor = TreeEditor(root_sha1, reader, writer)
+    editor.Set('third_party/WebKit', webkit_tree_sha1, mode='40000')
+    editor.Replace('DEPS', deps_sha1)
+    editor.Remove('.gitignore')
+    new_root_sha1 = editor.Write()
+  """
+  def __init__(self, root_sha1, reader, writer):
+    self._root_sha1 = root_sha1
+    self._reader = reader
+    self._writer = writer
+    self._views = {}  # Path of a tree ('' for the root) -> TreeView.
+    # The edits, as a trie: name -> nested dict (for an edit below that path)
+    # or ('set', mode, sha1), ('replace', sha1), ('remove',).
+    self._edits = {}
+
+  def _ReadView(self, path, sha1):
+    view = self._views.get(path)
+    if view is None:
+      view = self._reader.ReadTree(sha1) if sha1 else TreeView('')
+      self._views[path] = view
+    return view
+
+  def _Resolve(self, path):
+    """Returns the entry (mode, fname, sha1) at |path| or None."""
+    entry = ('40000', '', self._root_sha1)
+    tree_path = ''
+    for name in path.split('/'):
+      if entry[0] != '40000':
+        return None  # A blob or a submodule can't have children.
+      view = self._ReadView(tree_path, entry[2])
+      index = view.Find(name)
+      if index is None:
+        return None
+      entry = view[index]
+      tree_path = tree_path + '/' + name if tree_path else name
+    return entry
+
+  def Lookup(self, path):
+    """Returns the SHA1 of the object at |path| in the original tree or None."""
+    entry = self._Resolve(path)
+    return entry[2] if entry else None
+
+  def _AddEdit(self, path, edit):
+    names = path.split('/')
+    node = self._edits
+    for name in names[:-1]:
+      node = node.setdefault(name, {})
+      assert isinstance(node, dict), 'Conflicting edits for ' + path
+    assert names[-1] not in node, 'Conflicting edits for ' + path
+    node[names[-1]] = edit
+
+  def Set(self, path, sha1, mode='100644'):
+    """Adds (or replaces) the entry at |path|. Missing trees are created."""
+    self._AddEdit(path, ('set', mode, sha1))
+
+  def Replace(self, path, sha1):
+    """Replaces the object at |path|, which must exist, keeping its mode."""
+    assert self._Resolve(path), 'Could not find %s in tree' % path
+    self._AddEdit(path, ('replace', sha1))
+
+  def Remove(self, path):
+    """Removes the entry at |path|, which must exist."""
+    assert self._Resolve(path), 'Could not find %s in tree' % path
+    self._AddEdit(path, ('remove',))
+
+  def Write(self):
+    """Writes the edited trees. Returns the SHA1 of the new root tree."""
+    return self._WriteTree('', self._root_sha1, self._edits)
+
+  def _WriteTree(self, path, sha1, edits):
+    view = self._ReadView(path, sha1)
+    upserts = []
+    removals = []
+    for name, edit in edits.iteritems():
+      child_path = path + '/' + name if path else name
+      if isinstance(edit, dict):
+        index = view.Find(name)
+        child_sha1 = None
+        if index is not None:
+          mode, _, child_sha1 = view[index]
+          assert mode == '40000', '%s is not a tree' % child_path
+        upserts.append(
+            ('40000', name, self._WriteTree(child_path, child_sha1, edit)))
+      elif edit[0] == 'set':
+        upserts.append((edit[1], name, edit[2]))
+      elif edit[0] == 'replace':
+        mode = view[view.Find(name)][0]
+        upserts.append((mode, name, edit[1]))
+      else:
+        removals.append(name)
+    return self._writer.WriteTree(view.Edit(upserts, removals))
 
 
 def TreeLookup(entries, entry_name):
   """Returns the sha1 for the given blob/subtree name if any, or None."""
+  if isinstance(entries, TreeView):
+    return entries.Lookup(entry_name)
   sha1s = [e[2] for e in entries if e[1] == entry_name]
   return sha1s[0] if sha1s else None
 
 
 def ReplaceInTree(entries, entry_name, replacement_sha1):
   """Replaces the blob/subtree named |entry_name| with the given sha1"""
+  if isinstance(entries, TreeView):
+    index = entries.Find(entry_name)
+    assert index is not None, 'Could not find %s in tree' % entry_name
+    mode, fname, _ = entries[index]
+    return entries.Edit(upserts=[(mode, fname, replacement_sha1)])
   new_entries = []
   did_replace = False
   for entry in entries:
@@ -205,27 +1003,15 @@ def ReplaceInTree(entries, entry_name, replacement_sha1):
 
 def VerifyObject(objtype, payload, expected_sha1):
   """Verifies the consistency of the given git object."""
-  assert len(expected_sha1) == 40
-  data = ('%s %d\x00' % (objtype, len(payload))) + payload
-  hasher = hashlib.sha1()
-  hasher.update(data)
-  return hasher.hexdigest() == expected_sha1
+  assert len(expected_sha1) == 20
+  hasher = hashlib.sha1('%s %d\x00' % (objtype, len(payload)))
+  hasher.update(payload)
+  return hasher.digest() == expected_sha1
 
 
 def ParseTree(payload):
   """Returns a sorted list of tupled (mode, fname, sha1)"""
-  cursor = 0
-  entries = []
-  while cursor < len(payload):
-    cs1 = payload.find(' ', cursor)
-    cs2 = payload.find('\0', cursor)
-    mode = payload[cursor:cs1]
-    fname = payload[(cs1 + 1):cs2]
-    sha1 = payload[(cs2 + 1):(cs2 + 21)].encode('hex')
-    assert len(sha1) == 40
-    cursor = cs2 + 21
-    entries.append((mode, fname, sha1))
-  return entries
+  return list(TreeView(payload))
 
 
 def _GitTreeEntryGetSortKey(entry):
@@ -235,6 +1021,18 @@ def _GitTreeEntryGetSortKey(entry):
   else:
     return entry[1]
 
+def _ReadLooseObject(objpath):
+  """Reads and inflates a loose object. Returns a tuple (objtype, payload)."""
+  with open(objpath, 'rb') as fin:
+    data = zlib.decompress(fin.read())
+  headlen = data.index('\x00')
+  objtype, objlen = data[:headlen].split()
+  objlen = int(objlen)
+  payload = data[headlen + 1:]
+  assert len(data) == (objlen + headlen + 1)
+  return objtype, payload
+
+
 def Makedirs(path):
   """like os.makedirs, ignore errors if already exists."""
   try:
@@ -249,3 +1047,9 @@ def WriteFileAtomic(file_path, data):
   with open(tmp_path, 'wb') as tmp_file:
     tmp_file.write(data)
   os.rename(tmp_path, file_path)
+
+
+def Unique(items):
+  """Returns the items of the given iterable without duplicates, in order."""
+  seen = set()
+  return [i for i in items if not (i in seen or seen.add(i))]
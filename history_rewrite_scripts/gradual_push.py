@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Pushes a long history to a server in batches of bounded size.
+
+Git servers refuse pushes bigger than a limit (e.g. receive.maxInputSize), and
+the rewritten blink history is way bigger than that. This walks the first-
+parent chain of |rev| (e.g. HEAD^2 of a merge, i.e. the rewritten blink head)
+and picks as checkpoints the farthest commits whose objects, not pushed yet,
+fit in the byte budget. The checkpoints are then pushed, oldest first, to a
+temporary ref. The plan and the progress are kept in a state file: if a push
+fails, running the same command again resumes from the last checkpoint pushed.
+
+The size of a batch is the on-disk size of its objects (git rev-list
+--disk-usage). That overestimates what git push sends (new_objects are not
+deltified), so the budget is a conservative bound. A single commit bigger than
+the budget (e.g. the first one) cannot be split, and is pushed as it is.
+"""
+
+import json
+import optparse
+import os
+import subprocess
+import sys
+
+import gitutils
+
+
+def PlanCheckpoints(git_dir, rev, exclude_revs, budget):
+  """Returns a list of (commit, size) to push in order to push |rev|.
+
+  Args:
+    git_dir: the repo containing |rev|.
+    rev: the commit to push eventually (any git revision).
+    exclude_revs: the commits that the server has already (which, and whose
+        ancestors, are not pushed). The ones unknown locally are ignored.
+    budget: the max size of each batch, in bytes (see the module docstring).
+  Returns:
+    A list of (hex SHA1, size of the batch it pushes in bytes), oldest first.
+    The last commit is |rev|. A size can exceed |budget| only if the batch is
+    a single commit.
+  """
+  excludes = ['^' + r for r in exclude_revs]
+  cmd = ['git', 'rev-list', '--first-parent', '--reverse', '--stdin',
+         '--ignore-missing']
+  chain = _GitWithStdin(git_dir, cmd, [rev] + excludes).split()
+  checkpoints = []
+  start = 0  # Index of the first commit of the chain not pushed yet.
+  while start < len(chain):
+    # The size of the batch grows with the commit picked as its end: gallop
+    # to bracket the farthest one within the budget, then bisect.
+    sizes = {}
+    def BatchSize(end):
+      if end not in sizes:
+        sizes[end] = _DiskUsage(git_dir, chain[end], excludes)
+      return sizes[end]
+    best = start  # Pushed even if it alone exceeds the budget.
+    step = 1
+    while start + step < len(chain) and BatchSize(start + step) <= budget:
+      best = start + step
+      step *= 2
+    lo, hi = best, min(start + step, len(chain))  # best <= end < hi.
+    while hi - lo > 1:
+      mid = (lo + hi) // 2
+      if BatchSize(mid) <= budget:
+        lo = mid
+      else:
+        hi = mid
+    best = lo
+    checkpoints.append((chain[best], BatchSize(best)))
+    excludes = excludes + ['^' + chain[best]]
+    start = best + 1
+  return checkpoints
+
+
+def PushCheckpoints(git_dir, remote, ref, state, state_path):
+  """Pushes the checkpoints of |state| not pushed yet to |ref| on |remote|.
+
+  Returns True if all of them have been pushed.
+  """
+  checkpoints = state['checkpoints']
+  for i in xrange(state['pushed'], len(checkpoints)):
+    sha1, size = checkpoints[i]
+    print 'Pushing %d/%d: %s (%d bytes)' % (i + 1, len(checkpoints),
+                                            sha1[0:12], size)
+    if subprocess.call(['git', 'push', remote, '+%s:%s' % (sha1, ref)],
+                       cwd=git_dir) != 0:
+      print 'Failed to push %s. Run again to resume from it.' % sha1[0:12]
+      return False
+    state['pushed'] = i + 1
+    _SaveState(state_path, state)
+  return True
+
+
+def _DiskUsage(git_dir, rev, excludes):
+  """The on-disk size of the objects reachable from |rev| but not |excludes|."""
+  cmd = ['git', 'rev-list', '--objects', '--disk-usage', '--stdin',
+         '--ignore-missing']
+  return int(_GitWithStdin(git_dir, cmd, [rev] + excludes))
+
+
+def _GitWithStdin(git_dir, cmd, lines):
+  proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          cwd=git_dir)
+  out, _ = proc.communicate(''.join(l + '\n' for l in lines))
+  assert proc.returncode == 0, 'Failed: %s' % ' '.join(cmd)
+  return out
+
+
+def _RemoteHeads(git_dir, remote):
+  """Returns the (hex) SHA1s of all the refs of |remote|."""
+  out = subprocess.check_output(['git', 'ls-remote', remote], cwd=git_dir)
+  return sorted(set(line.split()[0] for line in out.splitlines()))
+
+
+def _LoadState(state_path):
+  if not os.path.exists(state_path):
+    return None
+  with open(state_path) as f:
+    return json.load(f)
+
+
+def _SaveState(state_path, state):
+  gitutils.WriteFileAtomic(state_path,
+                           json.dumps(state, indent=2, sort_keys=True) + '\n')
+
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options] REMOTE REV')
+  parser.add_option('--git-dir', default='.',
+      help='The repo to push from (default: the current dir)')
+  parser.add_option('--ref', default='refs/ignore/blink_tmp',
+      help='The (temporary) ref of the server to push to (default: %default)')
+  parser.add_option('--budget', type='int', default=1 << 30,
+      help='Max size of each push, in bytes (default: %default)')
+  parser.add_option('--state', default='gradual_push.json',
+      help='Where to keep the plan and the progress, to resume from them '
+      'after a failure (default: %default)')
+  parser.add_option('--plan-only', action='store_true',
+      help='Only compute (and save) the plan, without pushing')
+  options, args = parser.parse_args()
+  if len(args) != 2:
+    parser.error('Expected REMOTE and REV')
+  remote, rev = args
+  git_dir = os.path.abspath(options.git_dir)
+  state_path = os.path.abspath(options.state)
+
+  tip = subprocess.check_output(['git', 'rev-parse', rev + '^{commit}'],
+                                cwd=git_dir).strip()
+  state = _LoadState(state_path)
+  if state and (state['remote'], state['tip'], state['ref'],
+                state['budget']) == (remote, tip, options.ref, options.budget):
+    print 'Resuming from %s: %d/%d checkpoints pushed' % (
+        state_path, state['pushed'], len(state['checkpoints']))
+  else:
+    print 'Planning the push of %s to %s' % (tip[0:12], remote)
+    checkpoints = PlanCheckpoints(git_dir, tip,
+                                  _RemoteHeads(git_dir, remote), options.budget)
+    state = {'remote': remote, 'tip': tip, 'ref': options.ref,
+             'budget': options.budget, 'checkpoints': checkpoints, 'pushed': 0}
+    _SaveState(state_path, state)
+    for i, (sha1, size) in enumerate(checkpoints):
+      print 'Checkpoint %d: %s, %d bytes%s' % (
+          i + 1, sha1[0:12], size,
+          ' (a single commit, more than the budget)'
+          if size > options.budget else '')
+    print 'Planned %d pushes, %d bytes in total (plan saved in %s)' % (
+        len(checkpoints), sum(s for _, s in checkpoints), state_path)
+
+  if options.plan_only:
+    return 0
+  if not PushCheckpoints(git_dir, remote, options.ref, state, state_path):
+    return 1
+  print 'Done. %s is now on %s as %s' % (tip[0:12], remote, options.ref)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
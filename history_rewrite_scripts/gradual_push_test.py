@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Checks gradual_push.py against a local bare repo with receive.maxInputSize.
+
+The history is made of commits adding a random (i.e. incompressible) file
+each, so that it is way bigger than the limit of the server, while every
+commit alone is well below it.
+"""
+
+import json
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import gradual_push
+
+
+_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       'gradual_push.py')
+_NUM_COMMITS = 40
+_FILE_SIZE = 4096
+_MAX_INPUT_SIZE = 32 << 10
+_BUDGET = 24 << 10
+
+# Fails the second push it receives, as a flaky server would.
+_FAILING_HOOK = '''#!/bin/sh
+count=$(cat "$GIT_DIR/pushes" 2>/dev/null || echo 0)
+echo $((count + 1)) > "$GIT_DIR/pushes"
+test "$count" != 1
+'''
+
+
+def _Git(cwd, *args):
+  return subprocess.check_output(('git',) + args, cwd=cwd).strip()
+
+
+class GradualPushTest(unittest.TestCase):
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp(prefix='gradual_push_test-')
+    self.src = os.path.join(self.tmp_dir, 'src')
+    self.remote = os.path.join(self.tmp_dir, 'remote.git')
+    self.state_path = os.path.join(self.tmp_dir, 'state.json')
+    _Git(self.tmp_dir, 'init', '-q', self.src)
+    rnd = random.Random(0)
+    for i in xrange(_NUM_COMMITS):
+      with open(os.path.join(self.src, 'file%d' % i), 'wb') as f:
+        f.write(''.join(chr(rnd.randrange(256)) for _ in xrange(_FILE_SIZE)))
+      _Git(self.src, 'add', '.')
+      _Git(self.src, '-c', 'user.name=test', '-c', 'user.email=test@test',
+           'commit', '-q', '-m', 'Commit %d' % i)
+    self.tip = _Git(self.src, 'rev-parse', 'HEAD')
+    _Git(self.tmp_dir, 'init', '-q', '--bare', self.remote)
+    _Git(self.remote, 'config', 'receive.maxInputSize', str(_MAX_INPUT_SIZE))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def _GradualPush(self):
+    with open(os.devnull, 'w') as devnull:
+      return subprocess.call(
+          [sys.executable, _SCRIPT, '--git-dir', self.src, '--budget',
+           str(_BUDGET), '--state', self.state_path, self.remote, 'HEAD'],
+          stdout=devnull, stderr=devnull)
+
+  def _RemoteTip(self):
+    return _Git(self.remote, 'rev-parse', '--verify', '-q',
+                'refs/ignore/blink_tmp^{commit}')
+
+  def testPlainPushExceedsTheLimit(self):
+    with open(os.devnull, 'w') as devnull:
+      self.assertNotEqual(0, subprocess.call(
+          ['git', 'push', self.remote, 'HEAD:refs/heads/master'],
+          cwd=self.src, stdout=devnull, stderr=devnull))
+
+  def testPlanFitsTheBudget(self):
+    checkpoints = gradual_push.PlanCheckpoints(self.src, self.tip, [], _BUDGET)
+    self.assertGreater(len(checkpoints), 1)
+    self.assertEqual(self.tip, checkpoints[-1][0])
+    for _, size in checkpoints:
+      self.assertLessEqual(size, _BUDGET)
+
+  def testPush(self):
+    self.assertEqual(0, self._GradualPush())
+    self.assertEqual(self.tip, self._RemoteTip())
+
+  def testResumeAfterFailure(self):
+    hook_path = os.path.join(self.remote, 'hooks', 'pre-receive')
+    with open(hook_path, 'w') as f:
+      f.write(_FAILING_HOOK)
+    os.chmod(hook_path, os.stat(hook_path).st_mode | stat.S_IXUSR)
+    self.assertEqual(1, self._GradualPush())
+    with open(self.state_path) as f:
+      state = json.load(f)
+    self.assertEqual(1, state['pushed'])
+    self.assertEqual(state['checkpoints'][0][0], self._RemoteTip())
+
+    self.assertEqual(0, self._GradualPush())
+    self.assertEqual(self.tip, self._RemoteTip())
+    with open(self.state_path) as f:
+      self.assertEqual(state['checkpoints'], json.load(f)['checkpoints'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,232 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Counters and timers of the merge, aggregated across processes.
+
+Each process accumulates its own counters (Add(), Timer()). Pool workers hand
+theirs to the main process along with the result of each job (TakeDelta() in
+the worker, Merge() in the main process). The main process splits the run in
+(possibly nested) stages via Stage(): the report (WriteReport()) contains, for
+each of them, its duration and the counters accumulated meanwhile, including
+the utilization of the workers. Optionally the main process also appends a
+snapshot of all the counters to a stream file every few seconds (StartStream()),
+one JSON object per line.
+
+Counters whose name ends in _seconds are timers.
+"""
+
+import collections
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+
+# Counters of the current process. Never rebound (see Counters()).
+_counters = collections.Counter()
+
+# Busy time and jobs of each pool worker, aggregated by Merge().
+_workers = collections.defaultdict(collections.Counter)  # pid -> Counter.
+
+# Properties of the run that the counters depend on (see SetInfo()).
+_info = {}
+
+_active_stages = []  # The stack of the stages in progress.
+_stages = []  # Report entries of the completed stages.
+_tstart = time.time()
+
+
+class _STREAM:
+  THREAD = None
+  STOP = None  # A threading.Event.
+
+
+def Counters():
+  """Returns the (live) counters of the current process, e.g. to pass them to
+  gitutils.MeteredObjDB."""
+  return _counters
+
+
+def Add(name, value=1):
+  _counters[name] += value
+
+
+def SetInfo(name, value):
+  """Records a property of the run in the report, e.g. an option which changes
+  what the counters mean (see capacity_plan.Calibrate)."""
+  _info[name] = value
+
+
+@contextlib.contextmanager
+def Timer(name):
+  """Adds the seconds spent in the with block to the |name| timer."""
+  tstart = time.time()
+  try:
+    yield
+  finally:
+    _counters[name] += time.time() - tstart
+
+
+def TimedIter(iterable, name):
+  """Yields the items of |iterable|, timing the waits for them as |name|.
+
+  Meant for the results of a multiprocessing.Pool: the time the main process
+  spends blocked on them is time in which it does nothing else.
+  """
+  iterator = iter(iterable)
+  while True:
+    tstart = time.time()
+    try:
+      item = next(iterator)
+    except StopIteration:
+      break
+    finally:
+      _counters[name] += time.time() - tstart
+    yield item
+
+
+def ResetForWorker():
+  """Drops the counters inherited from the parent. Call it in pool workers."""
+  _counters.clear()
+  _workers.clear()
+  del _active_stages[:]
+  del _stages[:]
+
+
+class WorkerJob(object):
+  """Accounts the with block as a job (and busy time) of this pool worker."""
+  def __enter__(self):
+    self._tstart = time.time()
+
+  def __exit__(self, *_):
+    _counters['worker.jobs'] += 1
+    _counters['worker.busy_seconds'] += time.time() - self._tstart
+
+
+def TakeDelta():
+  """Returns, and resets, the counters accumulated by this worker.
+
+  The result is meant to be returned to the main process and passed to Merge().
+  """
+  delta = (os.getpid(), dict(_counters))
+  _counters.clear()
+  return delta
+
+
+def Merge(delta):
+  """Aggregates the counters of a pool worker (see TakeDelta())."""
+  pid, counters = delta
+  for name, value in counters.iteritems():
+    if name.startswith('worker.'):
+      _workers[pid][name[len('worker.'):]] += value
+    else:
+      _counters[name] += value
+
+
+def _CpuSeconds():
+  """CPU time of this process and of its children reaped so far."""
+  return sum(os.times()[0:4])
+
+
+@contextlib.contextmanager
+def Stage(name):
+  """Accounts the counters incremented in the with block to stage |name|."""
+  _active_stages.append(name)
+  full_name = '/'.join(_active_stages)
+  counters_start = _counters.copy()
+  workers_start = dict((pid, c.copy()) for pid, c in _workers.iteritems())
+  tstart = time.time()
+  cpu_start = _CpuSeconds()
+  try:
+    yield
+  finally:
+    seconds = max(time.time() - tstart, 1e-6)
+    workers = {}
+    for pid, counters in _workers.iteritems():
+      counters = counters - workers_start.get(pid, collections.Counter())
+      if counters:
+        workers[pid] = dict(counters,
+                            utilization=counters['busy_seconds'] / seconds)
+    _stages.append({
+        'name': full_name,
+        'start': tstart - _tstart,
+        'seconds': seconds,
+        'cpu_seconds': _CpuSeconds() - cpu_start,
+        'counters': dict(_counters - counters_start),
+        'workers': workers,
+        # Pools have a worker per CPU, but they can be recycled within a stage.
+        'worker_utilization': sum(
+            w['busy_seconds'] for w in workers.itervalues()) / (
+                seconds * multiprocessing.cpu_count()),
+    })
+    _active_stages.pop()
+
+
+def Report():
+  """Returns the report of the whole run so far, as a JSON-able dict."""
+  return {
+      'seconds': time.time() - _tstart,
+      'cpu_seconds': _CpuSeconds(),
+      'counters': dict(_counters),
+      'workers': dict((pid, dict(c)) for pid, c in _workers.iteritems()),
+      'stages': sorted(_stages, key=lambda s: s['start']),
+      'num_cpus': multiprocessing.cpu_count(),
+      'info': dict(_info),
+      # Peak RSS of this process and of the largest of its children (e.g. a
+      # pool worker) reaped so far.
+      'max_rss_bytes': {
+          'main': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+          'children': resource.getrusage(
+              resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+      },
+  }
+
+
+def WriteReport(path):
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as f:
+    json.dump(Report(), f, indent=2, sort_keys=True)
+  os.rename(tmp_path, path)
+
+
+def StartStream(path, interval_seconds=10):
+  """Appends a snapshot of the counters to |path| every |interval_seconds|."""
+  assert not _STREAM.THREAD
+  _STREAM.STOP = threading.Event()
+  _STREAM.THREAD = threading.Thread(target=_StreamThreadMain,
+                                    args=(path, interval_seconds))
+  _STREAM.THREAD.daemon = True
+  _STREAM.THREAD.start()
+
+
+def StopStream():
+  """Writes the last snapshot and stops the stream (if any)."""
+  if _STREAM.THREAD:
+    _STREAM.STOP.set()
+    _STREAM.THREAD.join()
+    _STREAM.THREAD = None
+
+
+def _StreamThreadMain(path, interval_seconds):
+  with open(path, 'a') as f:
+    stopping = False
+    while not stopping:
+      stopping = _STREAM.STOP.wait(interval_seconds)
+      # Copying the dicts is atomic (under the GIL), iterating them is not.
+      counters = dict(_counters)
+      workers = dict(_workers)
+      snapshot = {
+          'time': time.time(),
+          'seconds': time.time() - _tstart,
+          'stage': '/'.join(_active_stages),
+          'counters': counters,
+          'num_workers': len(workers),
+          'workers_busy_seconds': sum(
+              c['busy_seconds'] for c in workers.itervalues()),
+      }
+      f.write(json.dumps(snapshot, sort_keys=True) + '\n')
+      f.flush()
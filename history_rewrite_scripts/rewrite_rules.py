@@ -0,0 +1,223 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""The rules deciding which files the blink history rewrite strips.
+
+A rule (see config.REWRITE_RULES) selects the files:
+  - directly inside the directories matching any of its |paths| globs. Globs
+    are /-separated. Each segment is either a fnmatch pattern matching exactly
+    one directory name, or '**', which matches zero or more of them. E.g.,
+    'LayoutTests/**' matches LayoutTests and all the directories below it.
+  - whose name ends with one of its |extensions| (case insensitive), if any.
+    A name which is just the extension (e.g. '.png') does not match, as it
+    has no extension for os.path.splitext either.
+  - whose size is >= |min_size| bytes, if set.
+A file is stripped if it is selected by any rule, unless the rule is
+|keep_if_at_tip| and the file (i.e. its blob) exists in the tip of any of the
+branches being rewritten.
+
+The globs are compiled into a trie of DirStates (a DFA over the path
+segments), built lazily: the state of a directory is the state of its parent
+advanced by the name of the directory, which is a dict lookup once memoized.
+The state tells, with one lookup per entry, which files can be stripped (a
+matcher keyed by suffix) and which subdirectories are worth descending into:
+a subdirectory that no rule can affect has no state, and is skipped.
+"""
+
+import fnmatch
+import hashlib
+
+import gitutils
+
+
+# Sizes of the blobs read by ShouldStrip(), for the min_size rules.
+_blob_sizes = {}
+
+
+class Rule(object):
+  """A class of files to strip from the history (see the module docstring)."""
+  def __init__(self, paths, extensions=None, min_size=None,
+               keep_if_at_tip=False):
+    assert paths, 'A rule needs at least one path glob'
+    self.paths = [p.strip('/') for p in paths]
+    self.extensions = [e.lower() for e in extensions or []]
+    assert all(self.extensions), 'Empty extension'
+    self.min_size = min_size
+    self.keep_if_at_tip = keep_if_at_tip
+
+  def __repr__(self):
+    return 'Rule(paths=%r, extensions=%r, min_size=%r, keep_if_at_tip=%r)' % (
+        self.paths, self.extensions, self.min_size, self.keep_if_at_tip)
+
+
+class RuleSet(object):
+  """The compiled form of a list of Rules."""
+  def __init__(self, rules):
+    self.rules = rules
+    # Identifies the rule set, e.g. to invalidate the results of a rewrite
+    # made with different rules.
+    self.fingerprint = hashlib.sha1(repr(rules)).hexdigest()
+    # The globs, as lists of segments. An NFA position is a tuple
+    # (glob index, index of the next segment to match).
+    self._globs = []  # [(rule, [segments])]
+    for rule in rules:
+      for path in rule.paths:
+        self._globs.append((rule, path.split('/') if path else []))
+    self._states = {}  # frozenset of positions -> DirState.
+    # The root is never shared with other directories (even if they end up
+    # with the same positions): its trees are the only ones which get nested
+    # in third_party/WebKit and translated with their SHA1 as key.
+    self.root = DirState(self, self._Closure(
+        (i, 0) for i in xrange(len(self._globs))), '')
+    self.root.salt = None
+
+  @staticmethod
+  def FromConfig(config_rules):
+    """Builds a RuleSet from a list of Rule kwargs dicts (see config.py)."""
+    return RuleSet([Rule(**r) for r in config_rules])
+
+  def StateAt(self, path):
+    """Returns the DirState of the directory |path| ('' is the root), or None
+    if no rule can affect it."""
+    state = self.root
+    for name in path.split('/') if path else []:
+      state = state.Child(name)
+      if state is None:
+        return None
+    return state
+
+  def _Closure(self, positions):
+    """Adds the positions reachable skipping '**' (i.e. matching nothing)."""
+    positions = list(positions)
+    closure = set(positions)
+    todo = positions[:]
+    while todo:
+      glob_idx, seg_idx = todo.pop()
+      segments = self._globs[glob_idx][1]
+      if seg_idx < len(segments) and segments[seg_idx] == '**':
+        next_pos = (glob_idx, seg_idx + 1)
+        if next_pos not in closure:
+          closure.add(next_pos)
+          todo.append(next_pos)
+    return frozenset(closure)
+
+  def _GetState(self, positions, path):
+    positions = self._Closure(positions)
+    if not positions:
+      return None
+    state = self._states.get(positions)
+    if state is None:
+      state = DirState(self, positions, path)
+      self._states[positions] = state
+    return state
+
+  def _Advance(self, state, name):
+    """Returns the state of the subdirectory |name| of |state|."""
+    positions = []
+    for glob_idx, seg_idx in state.positions:
+      segments = self._globs[glob_idx][1]
+      if seg_idx == len(segments):
+        continue  # Fully matched, nothing to match below.
+      segment = segments[seg_idx]
+      if segment == '**':
+        positions.append((glob_idx, seg_idx))
+      elif fnmatch.fnmatchcase(name, segment):
+        positions.append((glob_idx, seg_idx + 1))
+    child_path = state.path + '/' + name if state.path else name
+    return self._GetState(positions, child_path)
+
+
+class DirState(object):
+  """What the rules say about the entries of a directory (and below)."""
+  def __init__(self, rule_set, positions, path):
+    self.positions = positions
+    self.path = path  # The first path which led to this state.
+    self._rule_set = rule_set
+    self._children = {}  # name -> DirState or None (memoized _Advance()).
+    # The translation of a tree depends on the state it is rewritten in, so
+    # does its key in the translations cache (see CacheKey()).
+    self.salt = hashlib.sha1(rule_set.fingerprint + repr(sorted(positions))
+                             ).digest()
+
+    # The names of the only subdirectories which can have a state, or None if
+    # any can (the state has wildcard segments to match).
+    literals = set()
+    for glob_idx, seg_idx in positions:
+      segments = rule_set._globs[glob_idx][1]
+      if seg_idx < len(segments):
+        if _IsPattern(segments[seg_idx]):
+          literals = None
+          break
+        literals.add(segments[seg_idx])
+    self.literal_children = None if literals is None else sorted(literals)
+
+    # The suffix matcher for the files in this directory.
+    rules = gitutils.Unique(rule_set._globs[glob_idx][0]
+                    for glob_idx, seg_idx in positions
+                    if seg_idx == len(rule_set._globs[glob_idx][1]))
+    self.has_file_rules = bool(rules)
+    self._any_file_rules = tuple(r for r in rules if not r.extensions)
+    by_len = {}  # suffix length -> {suffix: (rules)}
+    for rule in rules:
+      for ext in rule.extensions:
+        suffixes = by_len.setdefault(len(ext), {})
+        suffixes[ext] = suffixes.get(ext, ()) + (rule,)
+    self._suffixes = sorted(by_len.iteritems())
+
+  def Child(self, name):
+    """Returns the DirState of the subdirectory |name|, or None if no rule
+    can affect it (i.e. it doesn't need to be rewritten)."""
+    try:
+      return self._children[name]
+    except KeyError:
+      child = self._rule_set._Advance(self, name)
+      self._children[name] = child
+      return child
+
+  def MatchFile(self, fname):
+    """Returns the tuple of rules selecting the file |fname| by its path and
+    name (i.e. regardless of their size and keep_if_at_tip)."""
+    matched = self._any_file_rules
+    for length, suffixes in self._suffixes:
+      if length >= len(fname):
+        break  # Sorted by length: the longer suffixes can't match either.
+      rules = suffixes.get(fname[-length:].lower())
+      if rules:
+        # A rule can match more than one suffix (e.g. '.png', '-expected.png').
+        matched += tuple(r for r in rules if r not in matched)
+    return matched
+
+  def CacheKey(self, tree_sha1):
+    """The key of the translation of |tree_sha1| rewritten in this state."""
+    if self.salt is None:
+      return tree_sha1
+    return hashlib.sha1(self.salt + tree_sha1).digest()
+
+
+def ShouldStrip(rules, sha1, whitelist, db):
+  """Whether any of the |rules| selecting a file (by its path, see
+  DirState.MatchFile) strips its blob |sha1|.
+
+  Args:
+    whitelist: the blobs that the keep_if_at_tip rules keep.
+    db: the gitutils object db to read |sha1| from, if its size matters.
+  """
+  for rule in rules:
+    if rule.keep_if_at_tip and sha1 in whitelist:
+      continue
+    if rule.min_size and _BlobSize(db, sha1) < rule.min_size:
+      continue
+    return True
+  return False
+
+
+def _BlobSize(db, sha1):
+  size = _blob_sizes.get(sha1)
+  if size is None:
+    size = _blob_sizes[sha1] = len(db.ReadBlob(sha1))
+  return size
+
+
+def _IsPattern(segment):
+  return segment == '**' or any(c in segment for c in '*?[')
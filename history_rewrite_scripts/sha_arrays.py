@@ -0,0 +1,107 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Compact collections of binary SHA1s, packed in flat byte buffers.
+
+A Python str object costs ~57 bytes (plus ~8-30 bytes for the reference held
+by a list or a set), which is ~4x the size of the SHA1 itself. The classes
+below store millions of SHA1s in a single buffer instead. Another nice
+property is that forked processes can read them without touching (hence
+un-sharing, due to refcounts) the pages of millions of objects.
+"""
+
+import struct
+
+
+_SHA1_LEN = 20
+
+
+class ShaArray(object):
+  """An append-only list of binary SHA1s."""
+  def __init__(self, sha1s=()):
+    self._data = bytearray()
+    self.Extend(sha1s)
+
+  def Append(self, sha1):
+    assert len(sha1) == _SHA1_LEN
+    self._data += sha1
+
+  def Extend(self, sha1s):
+    for sha1 in sha1s:
+      self.Append(sha1)
+
+  def __len__(self):
+    return len(self._data) // _SHA1_LEN
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError('ShaArray index out of range')
+    off = index * _SHA1_LEN
+    return str(self._data[off:off + _SHA1_LEN])
+
+  def __iter__(self):
+    data = self._data
+    for off in xrange(0, len(data), _SHA1_LEN):
+      yield str(data[off:off + _SHA1_LEN])
+
+  def __reversed__(self):
+    data = self._data
+    for off in xrange(len(data) - _SHA1_LEN, -1, -_SHA1_LEN):
+      yield str(data[off:off + _SHA1_LEN])
+
+
+class SortedShaSet(object):
+  """An immutable set of binary SHA1s, stored as a sorted table.
+
+  Lookups are a binary search restricted, like in the pack indexes, by a fanout
+  table on the first byte.
+  """
+  def __init__(self, sha1s=()):
+    self._data = ''.join(sorted(set(sha1s)))
+    self._len = len(self._data) // _SHA1_LEN
+    # _fanout[b] is the number of SHA1s whose first byte is < b.
+    fanout = [0] * 257
+    for off in xrange(0, len(self._data), _SHA1_LEN):
+      fanout[ord(self._data[off]) + 1] += 1
+    for i in xrange(1, 257):
+      fanout[i] += fanout[i - 1]
+    self._fanout = struct.pack('<257I', *fanout)
+
+  @staticmethod
+  def FromBytes(data):
+    """Builds the set from the concatenation of the SHA1s (see ToBytes())."""
+    assert len(data) % _SHA1_LEN == 0
+    return SortedShaSet(data[i:i + _SHA1_LEN]
+                        for i in xrange(0, len(data), _SHA1_LEN))
+
+  def ToBytes(self):
+    return self._data
+
+  def __contains__(self, sha1):
+    first_byte = ord(sha1[0])
+    lo, hi = struct.unpack_from('<2I', self._fanout, first_byte * 4)
+    data = self._data
+    while lo < hi:
+      mid = (lo + hi) // 2
+      off = mid * _SHA1_LEN
+      mid_sha1 = data[off:off + _SHA1_LEN]
+      if mid_sha1 < sha1:
+        lo = mid + 1
+      elif mid_sha1 > sha1:
+        hi = mid
+      else:
+        return True
+    return False
+
+  def __len__(self):
+    return self._len
+
+  def __iter__(self):
+    data = self._data
+    for off in xrange(0, len(data), _SHA1_LEN):
+      yield data[off:off + _SHA1_LEN]
@@ -0,0 +1,88 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A fixed-size SHA1 -> SHA1 hash table shared (via mmap) across processes."""
+
+import mmap
+import multiprocessing
+import struct
+
+
+_EMPTY = '\0'
+_FULL = '\1'
+_SLOT_LEN = 41  # State byte + 20 bytes key + 20 bytes value.
+_HASH = struct.Struct('<Q')
+
+
+class SharedShaTable(object):
+  """An open-addressing (linear probing) table of binary SHA1s.
+
+  The table lives in an anonymous shared mmap, hence it must be created before
+  forking the processes that use it. Lookups don't take any lock: a slot is
+  published by writing its state byte only after its key and value. Inserts
+  take the lock of the slot being claimed (locks are striped across slots).
+  Entries can't be removed and the table can't grow.
+  """
+  def __init__(self, num_slots, num_locks=256):
+    assert num_slots & (num_slots - 1) == 0, 'num_slots must be a power of 2'
+    self._num_slots = num_slots
+    self._mask = num_slots - 1
+    self._map = mmap.mmap(-1, num_slots * _SLOT_LEN)
+    self._locks = [multiprocessing.Lock() for _ in xrange(num_locks)]
+    # Number of entries inserted under each lock (see __len__).
+    self._counts = multiprocessing.RawArray('l', num_locks)
+
+  def Get(self, key, default=None):
+    mm = self._map
+    idx = _HASH.unpack_from(key)[0] & self._mask
+    for _ in xrange(self._num_slots):
+      off = idx * _SLOT_LEN
+      if mm[off] == _EMPTY:
+        break
+      if mm[off + 1:off + 21] == key:
+        return mm[off + 21:off + 41]
+      idx = (idx + 1) & self._mask
+    return default
+
+  def SetDefault(self, key, value):
+    """Inserts |key| if not present. Returns the value stored for |key|."""
+    assert len(key) == 20 and len(value) == 20
+    mm = self._map
+    idx = _HASH.unpack_from(key)[0] & self._mask
+    for _ in xrange(self._num_slots):
+      off = idx * _SLOT_LEN
+      if mm[off] == _EMPTY:
+        lock_idx = idx % len(self._locks)
+        with self._locks[lock_idx]:
+          if mm[off] == _EMPTY:  # Nobody claimed the slot in the meanwhile.
+            mm[off + 1:off + 41] = key + value
+            mm[off] = _FULL
+            self._counts[lock_idx] += 1
+            return value
+      # The slot is (now) full, either by |key| or by a colliding one.
+      if mm[off + 1:off + 21] == key:
+        return mm[off + 21:off + 41]
+      idx = (idx + 1) & self._mask
+    raise Exception('SharedShaTable is full (%d slots)' % self._num_slots)
+
+  def Update(self, items):
+    """Inserts the (key, value) pairs of the given dict or iterable."""
+    if isinstance(items, dict):
+      items = items.iteritems()
+    for key, value in items:
+      self.SetDefault(key, value)
+
+  def __contains__(self, key):
+    return self.Get(key) is not None
+
+  def __len__(self):
+    return sum(self._counts)
+
+  @property
+  def num_slots(self):
+    return self._num_slots
+
+  @property
+  def load_factor(self):
+    return float(len(self)) / self._num_slots
@@ -0,0 +1,81 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An append-only on-disk store of SHA1 translations (original -> rewritten).
+
+The file is a flat sequence of 40 bytes records: the binary SHA1 of the
+original object followed by the binary SHA1 of its translation. Records are
+buffered in memory and appended in one write() on Checkpoint(). A record that
+was truncated by a crash (i.e. a trailing partial record) is ignored by Load().
+"""
+
+import os
+
+
+_RECORD_LEN = 40
+
+
+class TranslationStore(object):
+  """The translations of one kind of objects (e.g., trees or commits)."""
+  def __init__(self, path):
+    self.path = path
+    self._buffer = []
+
+  def Load(self, is_valid=None):
+    """Returns a dict {binary orig SHA1: binary translated SHA1}.
+
+    Args:
+      is_valid: optional predicate (orig_bin_sha1, new_bin_sha1) -> bool. The
+          records which don't satisfy it are discarded.
+    """
+    if not os.path.exists(self.path):
+      return {}
+    with open(self.path, 'rb') as f:
+      data = f.read()
+    num_records = len(data) // _RECORD_LEN
+    translations = {}
+    for i in xrange(num_records):
+      off = i * _RECORD_LEN
+      orig = data[off:off + 20]
+      new = data[off + 20:off + _RECORD_LEN]
+      if is_valid is None or is_valid(orig, new):
+        translations[orig] = new
+    # Drop the partial record (if any), so that new records are aligned.
+    if len(data) != num_records * _RECORD_LEN:
+      with open(self.path, 'r+b') as f:
+        f.truncate(num_records * _RECORD_LEN)
+    return translations
+
+  def Add(self, orig_bin_sha1, new_bin_sha1):
+    """Buffers a translation. It is persisted by the next Checkpoint()."""
+    assert len(orig_bin_sha1) == 20 and len(new_bin_sha1) == 20
+    self._buffer.append(orig_bin_sha1 + new_bin_sha1)
+
+  def AddMany(self, records):
+    """Buffers a list of (orig_bin_sha1, new_bin_sha1)."""
+    for orig_bin_sha1, new_bin_sha1 in records:
+      self.Add(orig_bin_sha1, new_bin_sha1)
+
+  @property
+  def num_pending(self):
+    return len(self._buffer)
+
+  def Checkpoint(self):
+    """Appends the buffered translations to the file.
+
+    The caller must guarantee that the objects referenced by the buffered
+    translations are already durable (e.g. their pack has been finalized).
+    """
+    if not self._buffer:
+      return
+    fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+    try:
+      data = ''.join(self._buffer)
+      while data:
+        written = os.write(fd, data)
+        data = data[written:]
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    self._buffer = []
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Verifies the result of chromium_blink_merge.py, much faster than git fsck.
+
+A git fsck of the merged repo re-verifies all of chromium (via the alternates),
+which the merge didn't touch. This checks, instead, the invariants of what the
+merge did (run it in the dir where chromium_blink_merge.py ran):
+  - Each merge commit has the chromium head and the rewritten blink head as
+    parents, and its tree is the chromium one with .gitignore and DEPS cleaned
+    up (see _MergeBlinkIntoChrome) and third_party/WebKit added.
+  - Each rewritten blink commit has the author, committer, extra headers and
+    message of the original one, byte by byte, and its parents are the
+    rewritten parents of the original one (the histories are walked in
+    parallel, from the heads recorded in rewrite_state/heads).
+  - Its tree is the original one nested in third_party/WebKit, minus exactly
+    the files that the rewrite rules strip. The whitelist only grows across
+    incremental runs, and the trees rewritten by a run are reused by the next
+    ones: a blob kept only by the whitelist of the last run (e.g. a png back
+    at a tip) may be stripped, one kept by the whitelist of the first run too
+    must not (see rewrite_state/whitelist{,.first}).
+The commits are verified by a pool of workers. The subtrees that the rules
+can't affect must have the same SHA1 of the original ones, and are not read.
+The others are read, hashed (see gitutils.ObjectVerifier) and compared entry
+by entry, once per worker for each distinct (original, rewritten) pair.
+"""
+
+import hashlib
+import multiprocessing
+import optparse
+import os
+import subprocess
+import sys
+import traceback
+
+import blink_rewriter
+import config
+import deps_cleanup
+import eta_estimator
+import gitutils
+import rewrite_rules
+import sha_arrays
+
+
+# Each worker forgets the tree pairs it has verified beyond these many.
+_MAX_VERIFIED_TREES = 1 << 20
+
+# Global dir constants (set by main and read by the pool workers).
+class _DIRS:
+  BLINK = None
+  CHROMIUM = None
+  MERGEREPO = None  # Reads the new objects too, via its alternates.
+  STATE = None
+
+# Global options (set by main and read by the pool workers).
+class _OPTS:
+  READER = 'native'  # Key of gitutils.READONLY_OBJDB_CLASSES.
+  RULES = None  # The rewrite_rules.RuleSet of the rewrite.
+
+# Per-process instances of gitutils classes.
+class _GITDB:
+  ORIG = None  # The original blink objects.
+  NEW = None  # The objects of the merged repo (blink, chromium and new ones).
+
+# Blobs preserved by the keep_if_at_tip rules (a SortedShaSet), in the last run
+# and in the first one (a subset).
+_obj_whitelist = sha_arrays.SortedShaSet()
+_first_obj_whitelist = sha_arrays.SortedShaSet()
+
+# Keys of the (original tree, rewritten tree) pairs verified by this worker.
+_verified_trees = set()
+
+
+def VerifyMerges(branches_to_merge):
+  """Verifies the merge commits of the given config.BRANCHES_TO_MERGE.
+
+  Returns a list of error messages (empty if the merges are fine).
+  """
+  errors = []
+  heads = blink_rewriter.LoadRewrittenHeads(
+      os.path.join(_DIRS.STATE, 'heads'))
+  chromium_db = gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.CHROMIUM)
+  merge_db = gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.MERGEREPO)
+  for chromium_ref, blink_ref, _ in branches_to_merge:
+    if blink_ref not in heads:
+      errors.append('%s: no rewritten head recorded for %s' % (chromium_ref,
+                                                               blink_ref))
+      continue
+    chromium_sha1, merge_sha1 = [_RevParse(git_dir, chromium_ref) for git_dir
+                                 in (_DIRS.CHROMIUM, _DIRS.MERGEREPO)]
+    errors += ['%s: %s' % (chromium_ref, e) for e in _VerifyMerge(
+        chromium_db, merge_db, chromium_sha1, merge_sha1,
+        heads[blink_ref][1].decode('hex'))]
+  chromium_db.Close()
+  merge_db.Close()
+  return errors
+
+
+def VerifyRewrittenHistory(blink_refs):
+  """Verifies the rewritten history of the given blink branches.
+
+  Returns a tuple (number of commits verified, list of error messages).
+  """
+  errors = []
+  heads = blink_rewriter.LoadRewrittenHeads(
+      os.path.join(_DIRS.STATE, 'heads'))
+  head_pairs = []
+  for blink_ref in gitutils.Unique(blink_refs):
+    if blink_ref not in heads:
+      errors.append('%s: no rewritten head recorded' % blink_ref)
+      continue
+    orig_head, new_head = heads[blink_ref]
+    head_pairs.append((orig_head.decode('hex'), new_head.decode('hex')))
+  pairs = _PairCommits(head_pairs, errors)
+
+  eta = eta_estimator.ETA(len(pairs), unit='commits', verb='Verified')
+  job_size = 256
+  jobs = [pairs[i:i + job_size] for i in xrange(0, len(pairs), job_size)]
+  pool = multiprocessing.Pool(initializer=_InitPoolWorker)
+  for job_errors, num_commits in pool.imap_unordered(_VerifyCommitsWrapper,
+                                                     jobs):
+    errors += job_errors
+    eta.job_completed(num_commits)
+  pool.close()
+  pool.join()
+  return len(pairs), errors
+
+
+def _VerifyMerge(chromium_db, merge_db, chromium_sha1, merge_sha1,
+                 new_blink_head):
+  """Checks the merge commit |merge_sha1| against the chromium commit it was
+  made on top of. Returns a list of error messages."""
+  merge_commit = merge_db.ReadCommit(merge_sha1)
+  parents = merge_commit.parents + filter(None, [merge_commit.merged_parent])
+  if parents != [chromium_sha1, new_blink_head]:
+    return ['the parents of %s are %s, expected %s %s' % (
+        merge_sha1.encode('hex')[0:12],
+        ' '.join(p.encode('hex')[0:12] for p in parents),
+        chromium_sha1.encode('hex')[0:12], new_blink_head.encode('hex')[0:12])]
+  errors = []
+  automerger = '%s <%s> ' % (config.AUTOMERGER_NAME, config.AUTOMERGER_EMAIL)
+  if not all(merge_commit.headers[h].startswith(automerger)
+             for h in ('author', 'committer')):
+    errors.append('the merge is not authored by %s' % automerger.strip())
+
+  # The blink tree that the merge should have brought in.
+  blink_root = merge_db.ReadTree(merge_db.ReadCommit(new_blink_head).tree)
+  blink_third_party = merge_db.ReadTree(blink_root.Lookup('third_party'))
+  webkit_sha1 = blink_third_party.Lookup('WebKit')
+
+  # Redo the edits of _MergeBlinkIntoChrome, hashing instead of writing.
+  cr_root = chromium_db.ReadTree(chromium_db.ReadCommit(chromium_sha1).tree)
+  gitignore_lines = chromium_db.ReadBlob(
+      cr_root.Lookup('.gitignore')).splitlines()
+  expected = {
+      '.gitignore': '\n'.join(l for l in gitignore_lines
+                              if l != '/third_party/WebKit'),
+      'DEPS': deps_cleanup.CleanupDeps(
+          chromium_db.ReadBlob(cr_root.Lookup('DEPS'))),
+  }
+  merge_root = merge_db.ReadTree(merge_commit.tree)
+  for fname, data in sorted(expected.iteritems()):
+    if not gitutils.VerifyObject('blob', data, merge_root.Lookup(fname)):
+      errors.append('%s is not the one of %s cleaned up' % (
+          fname, chromium_sha1.encode('hex')[0:12]))
+  merge_third_party = merge_db.ReadTree(merge_root.Lookup('third_party'))
+  if merge_third_party.Lookup('WebKit') != webkit_sha1:
+    errors.append('third_party/WebKit is not the one of %s' %
+                  new_blink_head.encode('hex')[0:12])
+
+  # Anything else must be the same of chromium.
+  cr_third_party = chromium_db.ReadTree(cr_root.Lookup('third_party'))
+  third_party = cr_third_party.Edit([('40000', 'WebKit', webkit_sha1)])
+  upserts = [('40000', 'third_party', _TreeSha1(third_party))]
+  for fname in sorted(expected):
+    mode = cr_root[cr_root.Find(fname)][0]
+    upserts.append((mode, fname, merge_root.Lookup(fname)))
+  if _TreeSha1(cr_root.Edit(upserts)) != merge_commit.tree:
+    errors.append('the tree differs from the one of %s in more than '
+                  '.gitignore, DEPS and third_party/WebKit' %
+                  chromium_sha1.encode('hex')[0:12])
+  return errors
+
+
+def _PairCommits(head_pairs, errors):
+  """Walks the original and the rewritten histories in parallel.
+
+  Returns the list of (original, rewritten) commits reachable from
+  |head_pairs|. The rewritten parents of a commit must pair, in order, with
+  the original ones: the mismatches are appended to |errors|.
+  """
+  orig_parents = _RevListParents(_DIRS.BLINK, [o for o, _ in head_pairs])
+  new_parents = _RevListParents(_DIRS.MERGEREPO, [n for _, n in head_pairs])
+  translations = {}  # original commit -> rewritten commit.
+  pairs = []
+  todo = list(reversed(head_pairs))
+  while todo:
+    orig_sha1, new_sha1 = todo.pop()
+    known = translations.get(orig_sha1)
+    if known is not None:
+      if known != new_sha1:
+        errors.append('%s is rewritten both as %s and %s' % (
+            orig_sha1.encode('hex')[0:12], known.encode('hex')[0:12],
+            new_sha1.encode('hex')[0:12]))
+      continue
+    translations[orig_sha1] = new_sha1
+    pairs.append((orig_sha1, new_sha1))
+    if len(orig_parents[orig_sha1]) != len(new_parents[new_sha1]):
+      errors.append('%s has %d parents, its rewrite %s has %d' % (
+          orig_sha1.encode('hex')[0:12], len(orig_parents[orig_sha1]),
+          new_sha1.encode('hex')[0:12], len(new_parents[new_sha1])))
+      continue
+    # Depth-first, so that consecutive commits (i.e. the ones of a job) are
+    # likely to share most of their subtrees.
+    todo.extend(reversed(zip(orig_parents[orig_sha1], new_parents[new_sha1])))
+  return pairs
+
+
+def _RevListParents(git_dir, revs):
+  """Returns a dict {commit: tuple of its parents} of the commits reachable
+  from |revs| (binary SHA1s)."""
+  cmd = ['git', 'rev-list', '--parents'] + [r.encode('hex') for r in revs]
+  proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, cwd=git_dir,
+                          bufsize=1048576)
+  parents = {}
+  for line in proc.stdout:
+    shas = [s.decode('hex') for s in line.split()]
+    parents[shas[0]] = tuple(shas[1:])
+  assert proc.wait() == 0, 'Failed: %s' % ' '.join(cmd)
+  return parents
+
+
+def _InitPoolWorker():
+  """Initializer of the pool's subprocesses."""
+  # Every object read is hashed (the default ObjectVerifier).
+  _GITDB.ORIG = gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.BLINK)
+  _GITDB.NEW = gitutils.READONLY_OBJDB_CLASSES[_OPTS.READER](_DIRS.MERGEREPO)
+
+
+def _VerifyCommitsWrapper(pairs):
+  """Entry point of each subprocess job.
+
+  Returns a tuple (list of error messages, number of commits verified).
+  """
+  # Need this try block to deal properly with exceptions in multiprocessing.
+  try:
+    errors = []
+    for orig_sha1, new_sha1 in pairs:
+      errors += ['%s (rewritten as %s): %s' % (
+          orig_sha1.encode('hex')[0:12], new_sha1.encode('hex')[0:12], e)
+                 for e in _VerifyCommit(orig_sha1, new_sha1)]
+    return errors, len(pairs)
+  except Exception as e:
+    sys.stderr.write('\n' + traceback.format_exc())
+    raise
+
+
+def _VerifyCommit(orig_sha1, new_sha1):
+  """Checks a rewritten commit against the original one (but its parents,
+  see _PairCommits). Returns a list of error messages."""
+  orig = _GITDB.ORIG.ReadCommit(orig_sha1)
+  new = _GITDB.NEW.ReadCommit(new_sha1)
+  errors = []
+  for header in ('author', 'committer'):
+    if orig.headers[header] != new.headers[header]:
+      errors.append('the %s differs' % header)
+  if orig.extra_headers != new.extra_headers:
+    errors.append('the extra headers differ')
+  if orig.message != new.message:
+    errors.append('the message differs')
+
+  root = _GITDB.NEW.ReadTree(new.tree)
+  if [(m, n) for m, n, _ in root] != [('40000', 'third_party')]:
+    errors.append('the root tree is not just third_party/')
+    return errors
+  third_party = _GITDB.NEW.ReadTree(root[0][2])
+  if [(m, n) for m, n, _ in third_party] != [('40000', 'WebKit')]:
+    errors.append('third_party/ is not just WebKit/')
+    return errors
+  _VerifyTree(orig.tree, third_party[0][2], _OPTS.RULES.root, '', errors)
+  return errors
+
+
+def _VerifyTree(orig_sha1, new_sha1, state, path, errors):
+  """Checks that |new_sha1| is |orig_sha1|, in the directory of |state| (a
+  rewrite_rules.DirState, None if no rule can affect it), minus the files that
+  the rules strip. Appends the differences found to |errors|."""
+  if state is None:
+    if orig_sha1 != new_sha1:
+      errors.append('%s/ differs from the original' % path)
+    return
+  key = state.CacheKey(orig_sha1) + new_sha1
+  if key in _verified_trees:
+    return
+  orig = _GITDB.ORIG.ReadTree(orig_sha1)
+  new = orig if new_sha1 == orig_sha1 else _GITDB.NEW.ReadTree(new_sha1)
+  expected = []  # The original entries that must not be stripped.
+  for mode, fname, sha1 in orig:
+    if mode[0] == '1':  # It's a file
+      rules = state.MatchFile(fname)
+      if rules and rewrite_rules.ShouldStrip(rules, sha1, _obj_whitelist,
+                                             _GITDB.ORIG):
+        continue
+      # Stripped by a run with a smaller whitelist.
+      if (rules and new.Lookup(fname) is None and rewrite_rules.ShouldStrip(
+          rules, sha1, _first_obj_whitelist, _GITDB.ORIG)):
+        continue
+    expected.append((mode, fname, sha1))
+
+  num_errors = len(errors)
+  if [(m, n) for m, n, _ in expected] != [(m, n) for m, n, _ in new]:
+    errors.append('%s/ does not have the expected entries' % path)
+    return
+  for (mode, fname, sha1), (_, _, new_entry_sha1) in zip(expected, new):
+    child_path = path + '/' + fname if path else fname
+    if mode == '40000':
+      _VerifyTree(sha1, new_entry_sha1, state.Child(fname), child_path, errors)
+    elif sha1 != new_entry_sha1:
+      errors.append('%s differs from the original' % child_path)
+  if len(errors) == num_errors:
+    if len(_verified_trees) >= _MAX_VERIFIED_TREES:
+      _verified_trees.clear()
+    _verified_trees.add(key)
+
+
+def _TreeSha1(view):
+  """The SHA1 that the tree of the given TreeView would have, if written."""
+  return hashlib.sha1('tree %d\x00%s' % (len(view.payload), view.payload)
+                      ).digest()
+
+
+def _RevParse(git_dir, rev):
+  return subprocess.check_output(['git', 'rev-parse', rev],
+                                 cwd=git_dir).strip().decode('hex')
+
+
+def main():
+  parser = optparse.OptionParser()
+  parser.add_option('--reader', default='native',
+      choices=sorted(gitutils.READONLY_OBJDB_CLASSES.keys()),
+      help='How to read the objects: "native" parses the pack files '
+      ' in-process, "git" pipes them through git cat-file (default: %default)')
+  options, _ = parser.parse_args()
+
+  base_dir = os.path.abspath(os.getcwd())
+  _DIRS.BLINK = os.path.join(base_dir, 'blink.git')
+  _DIRS.CHROMIUM = os.path.join(base_dir, 'chromium.git')
+  _DIRS.MERGEREPO = os.path.join(base_dir, 'chrome-blink-merge.git')
+  _DIRS.STATE = os.path.join(base_dir, 'rewrite_state')
+  _OPTS.READER = options.reader
+  _OPTS.RULES = rewrite_rules.RuleSet.FromConfig(config.REWRITE_RULES)
+
+  global _obj_whitelist, _first_obj_whitelist
+  with open(os.path.join(_DIRS.STATE, 'rules')) as f:
+    assert f.read().strip() == _OPTS.RULES.fingerprint, (
+        'The rewrite rules changed since the merge, cannot verify it')
+  with open(os.path.join(_DIRS.STATE, 'whitelist'), 'rb') as f:
+    _obj_whitelist = sha_arrays.SortedShaSet.FromBytes(f.read())
+  _first_obj_whitelist = _obj_whitelist
+  first_whitelist_path = os.path.join(_DIRS.STATE, 'whitelist.first')
+  if os.path.exists(first_whitelist_path):
+    with open(first_whitelist_path, 'rb') as f:
+      _first_obj_whitelist = sha_arrays.SortedShaSet.FromBytes(f.read())
+
+  print 'Verifying the merge commits'
+  errors = VerifyMerges(config.BRANCHES_TO_MERGE)
+  print 'Verifying the rewritten blink history'
+  num_commits, history_errors = VerifyRewrittenHistory(
+      [b[1] for b in config.BRANCHES_TO_MERGE])
+  errors += history_errors
+
+  for error in errors[0:100]:
+    print 'ERROR:', error
+  if len(errors) > 100:
+    print '... and %d more errors' % (len(errors) - 100)
+  if errors:
+    print 'Verification FAILED'
+    return 1
+  print 'Verified %d merges and %d rewritten commits' % (
+      len(config.BRANCHES_TO_MERGE), num_commits)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())